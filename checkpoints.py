@@ -0,0 +1,133 @@
+"""
+On-disk checkpoints for long correction runs.
+
+A BatchCheckpoint keeps the potentials of the observations that are already
+finished in memory-mapped .npy files named after a digest of the run's inputs
+and settings (e.g. tesseroid_engine.unit_potential_key). The engine stores
+every batch (or tile) as soon as it is done, so a run interrupted by a
+browser reload or a server restart resumes from the finished batches when it
+is started again with the same inputs.
+
+The files live in ``GEOID_CHECKPOINT_DIR`` (default: ``geoid_checkpoints`` in
+the system temporary directory) until the caller discards them.
+MemoryCheckpoint has the same interface without files; it lets a caller watch
+the finished batches of a run (e.g. for a live preview) without persisting them.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+
+def checkpoint_dir():
+    """Directory holding the checkpoint files"""
+    return os.environ.get("GEOID_CHECKPOINT_DIR",
+                          os.path.join(tempfile.gettempdir(), "geoid_checkpoints"))
+
+
+class BatchCheckpoint:
+    """Finished rows of an (n_obs, n_classes) potential array, persisted on disk.
+
+    ``values`` holds the potentials, ``done`` flags the finished observations
+    and ``counts`` the kernel counts of the finished batches (summed by the
+    engine into its ``stats``). Files whose shape does not match the run are
+    replaced.
+    """
+
+    def __init__(self, key, n_obs, n_classes, directory=None):
+        self.key = key
+        self.directory = directory or checkpoint_dir()
+        os.makedirs(self.directory, exist_ok=True)
+        self.values = self._open("values", (n_obs, n_classes), np.float64)
+        self.counts = self._open("counts", (n_obs, 3), np.int64)
+        self.done = self._open("done", (n_obs,), np.bool_)
+
+    def _path(self, part):
+        return os.path.join(self.directory, f"{self.key}.{part}.npy")
+
+    def _open(self, part, shape, dtype):
+        path = self._path(part)
+        if os.path.exists(path):
+            try:
+                array = np.load(path, mmap_mode="r+")
+                if array.shape == shape and array.dtype == dtype:
+                    return array
+            except (OSError, ValueError):
+                pass
+        if part != "done":
+            # New or unusable data file: no finished rows can be trusted
+            done_path = self._path("done")
+            if os.path.exists(done_path):
+                os.remove(done_path)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    @property
+    def n_done(self):
+        """Number of finished observations"""
+        return int(np.count_nonzero(self.done))
+
+    def is_done(self, s, e):
+        """True if observations s:e are all finished"""
+        return bool(self.done[s:e].all())
+
+    def store(self, s, e, values, counts=None):
+        """Persist the potentials (and kernel counts) of observations s:e.
+
+        ``counts`` is either a per-observation (e - s, 3) array or the three
+        summed counts of the whole range. The values are flushed before the
+        rows are marked as finished, so an interrupted write is redone.
+        """
+        self.values[s:e] = np.reshape(values, (e - s, -1))
+        self.counts[s:e] = 0
+        if counts is not None:
+            counts = np.asarray(counts, dtype=np.int64)
+            if counts.ndim == 1:
+                self.counts[s] = counts
+            else:
+                self.counts[s:e] = counts
+        self.values.flush()
+        self.counts.flush()
+        self.done[s:e] = True
+        self.done.flush()
+
+    def discard(self):
+        """Delete the checkpoint files, e.g. once the result is stored elsewhere"""
+        self.values = self.counts = self.done = None
+        for part in ("values", "counts", "done"):
+            path = self._path(part)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class MemoryCheckpoint:
+    """BatchCheckpoint kept in memory: the same arrays and methods, nothing on disk"""
+
+    def __init__(self, n_obs, n_classes):
+        self.values = np.full((n_obs, n_classes), np.nan, dtype=np.float64)
+        self.counts = np.zeros((n_obs, 3), dtype=np.int64)
+        self.done = np.zeros(n_obs, dtype=np.bool_)
+
+    @property
+    def n_done(self):
+        """Number of finished observations"""
+        return int(np.count_nonzero(self.done))
+
+    def is_done(self, s, e):
+        """True if observations s:e are all finished"""
+        return bool(self.done[s:e].all())
+
+    def store(self, s, e, values, counts=None):
+        """Keep the potentials (and kernel counts) of observations s:e, see BatchCheckpoint.store"""
+        self.values[s:e] = np.reshape(values, (e - s, -1))
+        self.counts[s:e] = 0
+        if counts is not None:
+            counts = np.asarray(counts, dtype=np.int64)
+            if counts.ndim == 1:
+                self.counts[s] = counts
+            else:
+                self.counts[s:e] = counts
+        self.done[s:e] = True
+
+    def discard(self):
+        """Release the arrays"""
+        self.values = self.counts = self.done = None
@@ -0,0 +1,1008 @@
+"""
+Headless geoid correction engine.
+
+This is the physics behind "Compute Selected Correction" in gui.py without
+any Streamlit dependency, so corrections can be scripted, run from cron or
+profiled directly:
+
+    from correction_engine import CorrectionParameters, Grid, compute_correction
+
+    results = compute_correction("5", geoid=Grid(lons, lats, geoid_values),
+                                 topography=topo, crust=crust,
+                                 params=CorrectionParameters(reference_thickness=40.0))
+    residual = results['residual_geoid']
+
+Input grids are Grid objects (1-D lon/lat axes in degrees plus an
+(nlat, nlon) value array); topography, crust and sediments are resampled onto
+the geoid grid. The returned dict has the same keys as the GUI's results
+(``topographic_correction``, ``corrected_geoid``, ``residual_geoid``, ...);
+output_grids wraps its 2-D fields as Grid objects.
+"""
+import hashlib
+import math
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator, griddata
+from scipy.ndimage import gaussian_filter
+
+from checkpoints import BatchCheckpoint, MemoryCheckpoint
+from cost_model import CostEstimate, CostLimitExceeded, ThroughputModel, count_pairs, peak_memory
+from result_cache import result_key
+from tesseroid_engine import (ENGINE_METHODS, PRECISIONS, SourceSet, combine_unit_potentials, compute_potential,
+                              compute_potentials_fused, crustal_sources, sedimentary_sources,
+                              topographic_sources, unit_potential_key, unit_source_set)
+from tile_runner import TILED_METHODS, compute_potentials_tiled, default_layout
+
+# GRS80 ellipsoid
+A_ELL = 6378137.0
+B_ELL = 6356752.314245
+E2 = 1.0 - (B_ELL / A_ELL) ** 2
+
+CORRECTION_TYPES = {
+    "1": "1. Topographic Correction Only",
+    "2": "2. Crustal Thickness Correction Only",
+    "3": "3. Sedimentary Correction Only",
+    "4": "4. Combined Correction (All Three)",
+    "5": "5. Residual Geoid (Original - All Corrections)",
+}
+
+# Longest side of the live preview grid, in nodes
+PREVIEW_SIZE = 150
+
+# Observations of the float64 reference run that checks a mixed-precision pass
+PRECISION_SAMPLE = 2000
+
+# Display names of the unit-density source classes
+CLASS_LABELS = {
+    'rock': "🏔️ rock topography",
+    'water': "🌊 water (bathymetry)",
+    'moho_positive': "🌍 Moho above reference",
+    'moho_negative': "🌍 Moho below reference",
+    'sediment': "🏗️ sediments",
+    # Classes merged into one pass by the methods that cannot fuse them
+    'topographic': "🏔️ topography (rock and water)",
+    'crustal': "🌍 Moho (above and below reference)"
+}
+
+
+def _target_axes(bounds, resolution):
+    """Axes of a grid over ``bounds`` with ``resolution`` nodes along the longer side"""
+    lon_min, lon_max, lat_min, lat_max = bounds
+    # Grid dimensions maintaining aspect ratio
+    lon_span = lon_max - lon_min if lon_max != lon_min else 1.0
+    lat_span = lat_max - lat_min if lat_max != lat_min else 1.0
+    if lon_span >= lat_span:
+        nx = resolution
+        ny = max(10, int(np.round(resolution * (lat_span / lon_span))))
+    else:
+        ny = resolution
+        nx = max(10, int(np.round(resolution * (lon_span / lat_span))))
+    return np.linspace(lon_min, lon_max, nx), np.linspace(lat_min, lat_max, ny)
+
+
+def _smooth_and_clip(ZI, smoothing, clip_percentiles):
+    """Gaussian smoothing and percentile clipping of an interpolated grid"""
+    if smoothing > 0:
+        ZI = gaussian_filter(ZI, sigma=smoothing)
+    if clip_percentiles is not None:
+        valid = ZI[~np.isnan(ZI)]
+        if len(valid) > 0:
+            ZI = np.clip(ZI, np.percentile(valid, clip_percentiles[0]), np.percentile(valid, clip_percentiles[1]))
+    return ZI
+
+
+class Grid(NamedTuple):
+    """Regular lon/lat grid: 1-D axes in degrees and an (nlat, nlon) value array"""
+    lons: np.ndarray
+    lats: np.ndarray
+    values: np.ndarray
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """Grid from an interpolated dataset of the GUI (a dict with XI, YI, ZI)"""
+        return cls(np.unique(dataset['XI']), np.unique(dataset['YI']), np.asarray(dataset['ZI']))
+
+    @classmethod
+    def from_regular_points(cls, lons, lats, values, min_coverage=0.9):
+        """Grid of XYZ points that lie on a regular lon/lat lattice, or None.
+
+        The distinct longitudes (latitudes) must be spaced by multiples of
+        one step, every point must fall on its own node and at least
+        ``min_coverage`` of the nodes must be present; missing nodes are NaN.
+        """
+        lons, lats, values = (np.asarray(a, dtype=np.float64).ravel() for a in (lons, lats, values))
+        ok = np.isfinite(lons) & np.isfinite(lats)
+        lons, lats, values = lons[ok], lats[ok], values[ok]
+        axes = []
+        for coords in (lons, lats):
+            distinct = np.unique(coords)
+            if len(distinct) < 2:
+                return None
+            step = np.diff(distinct).min()
+            spacing = (distinct - distinct[0]) / step
+            if np.abs(spacing - np.rint(spacing)).max() > 1e-6:
+                return None
+            axes.append((distinct[0], step, int(np.rint(spacing[-1])) + 1))
+        (lon0, dlon, nlon), (lat0, dlat, nlat) = axes
+        cols = np.rint((lons - lon0) / dlon).astype(np.int64)
+        rows = np.rint((lats - lat0) / dlat).astype(np.int64)
+        cells = rows * nlon + cols
+        if len(np.unique(cells)) != len(cells) or len(cells) < min_coverage * nlat * nlon:
+            return None
+        grid = np.full(nlat * nlon, np.nan)
+        grid[cells] = values
+        return cls(lon0 + dlon * np.arange(nlon), lat0 + dlat * np.arange(nlat), grid.reshape(nlat, nlon))
+
+    @classmethod
+    def from_points(cls, lons, lats, values, bounds=None, resolution=200, method="linear",
+                    smoothing=1.0, clip_percentiles=(2.0, 98.0)):
+        """Interpolate scattered points onto a regular grid, as the Data Visualization section does.
+
+        ``bounds`` is (lon_min, lon_max, lat_min, lat_max), by default the
+        extent of the points; ``resolution`` is the number of nodes along the
+        longer side. ``method`` is a scipy griddata method or "rbf";
+        ``smoothing`` the Gaussian filter sigma (0 = off) and
+        ``clip_percentiles`` the (low, high) percentiles the values are
+        clipped to (None = off). Points on a regular lattice (see
+        from_regular_points) are interpolated on that grid directly instead
+        of being triangulated.
+        """
+        lons, lats, values = (np.asarray(a, dtype=np.float64) for a in (lons, lats, values))
+        ok = np.isfinite(lons) & np.isfinite(lats) & np.isfinite(values)
+        lons, lats, values = lons[ok], lats[ok], values[ok]
+        if len(values) < 3:
+            raise ValueError("Need at least 3 valid points to interpolate")
+        bounds = bounds or (lons.min(), lons.max(), lats.min(), lats.max())
+        method = method.lower()
+        regular = cls.from_regular_points(lons, lats, values) if method != "rbf" else None
+        if regular is not None:
+            return regular.regrid(bounds, resolution, method, smoothing, clip_percentiles)
+
+        xi, yi = _target_axes(bounds, resolution)
+        XI, YI = np.meshgrid(xi, yi)
+        if method == "rbf":
+            from scipy.interpolate import Rbf
+            ZI = Rbf(lons, lats, values, function='multiquadric')(XI, YI)
+        else:
+            try:
+                ZI = griddata((lons, lats), values, (XI, YI), method=method)
+            except Exception:
+                ZI = griddata((lons, lats), values, (XI, YI), method='nearest')
+        return cls(xi, yi, _smooth_and_clip(ZI, smoothing, clip_percentiles))
+
+    def regrid(self, bounds=None, resolution=200, method="linear", smoothing=1.0,
+               clip_percentiles=(2.0, 98.0)):
+        """This grid interpolated onto a new grid, with the settings of from_points.
+
+        ``bounds`` default to the extent of this grid; "rbf" goes through the
+        nodes as scattered points, the other methods use interpolate.
+        """
+        method = method.lower()
+        if method == "rbf":
+            XI, YI = np.meshgrid(self.lons, self.lats)
+            return Grid.from_points(XI.ravel(), YI.ravel(), self.values.ravel(), bounds, resolution,
+                                    method, smoothing, clip_percentiles)
+        bounds = bounds or (self.lons.min(), self.lons.max(), self.lats.min(), self.lats.max())
+        xi, yi = _target_axes(bounds, resolution)
+        return Grid(xi, yi, _smooth_and_clip(self.interpolate(xi, yi, method), smoothing, clip_percentiles))
+
+    @property
+    def shape(self):
+        return (len(self.lats), len(self.lons))
+
+    def coarsen(self, stride):
+        """Every ``stride``-th node along both axes"""
+        return Grid(self.lons[::stride], self.lats[::stride], self.values[::stride, ::stride])
+
+    def interpolate(self, lons, lats, method="linear"):
+        """Values at the nodes of the (lons, lats) grid by interpolation on this grid.
+
+        ``method`` is "linear", "nearest" or "cubic" (linear on grids too
+        small for cubic). Outside the grid the nodes behave as with griddata
+        on the grid's points: NaN for "linear" and "cubic", the nearest edge
+        node for "nearest".
+        """
+        lons, lats = np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)
+        if method == "nearest":
+            return self.nearest(*np.meshgrid(lons, lats))
+        if method == "cubic" and min(self.shape) < 4:
+            method = "linear"
+        interpolator = RegularGridInterpolator((self.lats, self.lons), self.values, method=method,
+                                               bounds_error=False, fill_value=np.nan)
+        YI, XI = np.meshgrid(lats, lons, indexing='ij')
+        return interpolator(np.stack([YI.ravel(), XI.ravel()], axis=-1)).reshape(YI.shape)
+
+    def nearest(self, lons, lats):
+        """Values of the nodes nearest to the points (lons, lats), of any shape.
+
+        Points outside the grid take the nearest edge node.
+        """
+        lons, lats = np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)
+        indices = []
+        for axis, coords in ((self.lats, lats), (self.lons, lons)):
+            if len(axis) == 1:
+                indices.append(np.zeros(coords.shape, dtype=np.int64))
+                continue
+            right = np.clip(np.searchsorted(axis, coords), 1, len(axis) - 1)
+            left = right - 1
+            # Ties go to the lower node, as np.argmin of the distance does
+            indices.append(np.where(np.abs(coords - axis[left]) <= np.abs(axis[right] - coords), left, right))
+        return self.values[indices[0], indices[1]]
+
+    def resample(self, lons, lats):
+        """Values at the nodes of the (lons, lats) grid: linear interpolation,
+        with nearest-neighbour values where the linear one is undefined"""
+        values = self.interpolate(lons, lats)
+        mask = np.isnan(values)
+        if mask.any():
+            values[mask] = self.nearest(*np.meshgrid(lons, lats))[mask]
+        return values
+
+
+class CorrectionParameters(NamedTuple):
+    """Physical parameters of the corrections (defaults as in the GUI).
+
+    Densities in kg/m^3, thicknesses in metres except ``reference_thickness``
+    (km), cutoffs in degrees; the batch sizes (observations per batch, or
+    "auto" to calibrate them, see tesseroid_engine.auto_batch_size) only
+    affect speed.
+    """
+    rho_rock: float = 2670.0
+    rho_water: float = 1030.0
+    topo_min_thickness: float = 0.01
+    cutoff_deg_topo: float = 12.0
+    batch_size_topo: int = 5000
+    rho_crust: float = 3000.0
+    rho_mantle: float = 3300.0
+    reference_thickness: float = 43.0
+    crust_min_thickness: float = 1000.0
+    cutoff_deg_crust: float = 4.0
+    batch_size_crust: int = 5000
+    rho_sediment_contrast: float = -200.0
+    sed_min_thickness: float = 0.5
+    cutoff_deg_sed: float = 12.0
+    batch_size_sed: int = 4000
+
+    def relevant(self, correction_num, has_sediment):
+        """The parameters the result of a correction depends on (batch sizes excluded)"""
+        names = []
+        if correction_num in ["1", "4", "5"]:
+            names += ['rho_rock', 'rho_water', 'topo_min_thickness', 'cutoff_deg_topo']
+        if correction_num in ["2", "4", "5"]:
+            names += ['rho_crust', 'rho_mantle', 'reference_thickness', 'crust_min_thickness', 'cutoff_deg_crust']
+        if correction_num in ["3", "4", "5"] and has_sediment:
+            names += ['rho_sediment_contrast', 'sed_min_thickness', 'cutoff_deg_sed']
+        return {name: getattr(self, name) for name in names}
+
+
+class EngineSettings(NamedTuple):
+    """Kernel and executor settings (see tesseroid_engine.compute_potential).
+
+    ``split_ratio = 0`` turns the adaptive near-field subdivision off;
+    ``n_workers`` runs the tileable methods in a process pool
+    (tile_runner) instead of in-process Numba threads. ``precision`` is one
+    of tesseroid_engine.PRECISIONS; "mixed" is not available for the
+    ``direct`` and ``regular`` methods.
+    """
+    method: str = "indexed"
+    fuse_passes: bool = True
+    near_cells: int = 2
+    tolerance: float = 1e-3
+    split_ratio: float = 0.0
+    max_depth: int = 4
+    n_workers: Optional[int] = None
+    threads_per_worker: Optional[int] = None
+    checkpoints: bool = True
+    precision: str = "float64"
+
+    def kernel_options(self):
+        """Method-specific keyword options of the potential kernels"""
+        options = {}
+        if self.method == "regular":
+            options['near_cells'] = int(self.near_cells)
+        elif self.method == "tree":
+            options['tolerance'] = float(self.tolerance)
+        if self.method != "direct" and self.split_ratio > 0:
+            options.update(split_ratio=float(self.split_ratio), max_depth=int(self.max_depth))
+        if self.precision != "float64":
+            options['precision'] = self.precision
+        return options
+
+
+def ellipsoidal_radius(lat_rad):
+    """Compute ellipsoidal radius at given latitude"""
+    sin_lat = np.sin(lat_rad)
+    return A_ELL * np.sqrt(1 - E2) / np.sqrt(1 - E2 * sin_lat * sin_lat)
+
+
+def somigliana_gamma(lat_rad):
+    """Compute normal gravity using Somigliana's formula"""
+    gamma_e = 9.7803253359
+    k = 0.00193185265241
+    s2 = np.sin(lat_rad) ** 2
+    return gamma_e * (1 + k * s2) / np.sqrt(1 - E2 * s2)
+
+
+def correction_number(correction):
+    """'1'..'5' from a correction number or a CORRECTION_TYPES label"""
+    number = str(correction).split(".")[0].strip()
+    if number not in CORRECTION_TYPES:
+        raise ValueError(f"Unknown correction type: {correction!r}")
+    return number
+
+
+def _used_grids(correction_num, crust, sediment):
+    """Crust and sediment grids, or None where the correction does not use them"""
+    return (crust if correction_num in ["2", "4", "5"] else None,
+            sediment if correction_num in ["3", "4", "5"] else None)
+
+
+def correction_key(correction, geoid, topography=None, crust=None, sediment=None, params=None, engine=None):
+    """Digest of the input grids and every parameter the result depends on"""
+    correction_num = correction_number(correction)
+    crust, sediment = _used_grids(correction_num, crust, sediment)
+    params = params or CorrectionParameters()
+    engine = engine or EngineSettings()
+    grids = [grid for grid in (geoid, topography, crust, sediment) if grid is not None]
+    settings = {'correction_type': CORRECTION_TYPES[correction_num], 'engine_method': engine.method,
+                **engine.kernel_options(), **params.relevant(correction_num, sediment is not None)}
+    return result_key([values for grid in grids for values in grid], settings)
+
+
+class PassPreview(NamedTuple):
+    """Snapshot of a running kernel pass, handed to compute_correction's ``preview``.
+
+    ``values`` is the correction (m) of the pass's density classes on a
+    coarse copy of the grid (``lons``/``lats``), NaN where the observations
+    are not computed yet; it is None for the ``regular`` method, which
+    finishes whole rows at once. ``pairs`` counts the observation-source
+    kernel pairs of this run so far and ``pairs_per_second`` is the measured
+    throughput (None when the method reports no counts); ``eta_seconds``
+    extrapolates it to the observations still to do.
+    """
+    stage: str
+    lons: np.ndarray
+    lats: np.ndarray
+    values: Optional[np.ndarray]
+    done_fraction: float
+    pairs: int
+    pairs_per_second: Optional[float]
+    eta_seconds: Optional[float]
+    elapsed: float
+
+
+class _PassMonitor:
+    """Builds PassPreview snapshots of one kernel pass from its checkpoint"""
+
+    def __init__(self, stage, checkpoint, valid, densities, gamma_grid, lons, lats, callback, interval):
+        self.stage = stage
+        self.checkpoint = checkpoint
+        self.valid = valid
+        self.n_valid = max(1, int(np.count_nonzero(valid)))
+        self.densities = densities
+        self.shape = (len(lats), len(lons))
+        self.stride = max(1, math.ceil(max(self.shape) / PREVIEW_SIZE))
+        self.gamma = gamma_grid[::self.stride]
+        self.lons = lons[::self.stride]
+        self.lats = lats[::self.stride]
+        self.callback = callback
+        self.interval = interval
+        # Batches restored from a checkpoint do not count towards the throughput
+        self.pairs0, self.valid0 = self._counts()
+        self.t0 = time.time()
+        self.last = 0.0
+
+    def _counts(self):
+        if self.checkpoint is None:
+            return 0, 0
+        pairs = int(self.checkpoint.counts[:, :2].sum())
+        return pairs, int(np.count_nonzero(self.checkpoint.done & self.valid))
+
+    def update(self, done, total):
+        now = time.time()
+        if done < total and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.t0
+        values = None
+        if self.checkpoint is None:
+            # Only batch progress is known
+            fraction = done / total if total else 1.0
+            new_fraction = fraction
+        else:
+            potentials = self.checkpoint.values @ self.densities
+            potentials[~self.checkpoint.done] = np.nan
+            grid = potentials.reshape(self.shape)[::self.stride, ::self.stride]
+            values = grid / self.gamma
+            pairs, valid_done = self._counts()
+            fraction = valid_done / self.n_valid
+            new_fraction = (valid_done - self.valid0) / self.n_valid
+        pairs_new = 0 if self.checkpoint is None else pairs - self.pairs0
+        rate = pairs_new / elapsed if pairs_new > 0 and elapsed > 0 else None
+        eta = elapsed * (1.0 - fraction) / new_fraction if new_fraction > 0 else None
+        self.callback(self.stage, PassPreview(
+            self.stage, self.lons, self.lats, values, fraction,
+            0 if self.checkpoint is None else pairs, rate, eta, elapsed
+        ))
+
+
+def _log_nothing(level, message):
+    pass
+
+
+def _group_batch_size(batch_sizes):
+    """Batch size of a pass over several classes: the smallest, or "auto" if any class asks for it"""
+    batch_sizes = list(batch_sizes)
+    if "auto" in batch_sizes:
+        return "auto"
+    return min(int(size) for size in batch_sizes)
+
+
+def _call_all(callbacks):
+    """Progress callback that forwards (done, total) to each of ``callbacks``"""
+    def call(done, total):
+        for callback in callbacks:
+            callback(done, total)
+    return call
+
+
+def _precision_error(obs_lats_rad, obs_lons_rad, obs_radii, unit_sets, group, potentials,
+                     densities, gamma, dlat, dlon, method, kernel_options):
+    """(max, RMS) geoid height difference (m) of a pass against a float64 run on a sample.
+
+    ``potentials`` are the unit potentials of the classes in ``group`` and
+    ``densities``/``gamma`` turn them into the geoid height of the pass; the
+    reference run uses the same method and options on at most
+    PRECISION_SAMPLE evenly spread valid observations.
+    """
+    valid = np.flatnonzero(np.isfinite(obs_radii))
+    if len(valid) == 0:
+        return 0.0, 0.0
+    sample = valid[np.unique(np.linspace(0, len(valid) - 1, min(len(valid), PRECISION_SAMPLE)).astype(np.int64))]
+    options = {key: value for key, value in kernel_options.items() if key != 'precision'}
+    difference = np.zeros(len(sample))
+    for name, potentials_flat in zip(group, potentials):
+        sources, cutoff_deg, _ = unit_sets[name]
+        reference = compute_potential(
+            obs_lats_rad[sample], obs_lons_rad[sample], obs_radii[sample], *sources, dlat, dlon,
+            math.cos(math.radians(cutoff_deg)), batch_size=len(sample), method=method, **options
+        )
+        difference += densities[name] * (potentials_flat[sample] - reference)
+    difference /= gamma[sample]
+    return float(np.max(np.abs(difference))), float(np.sqrt(np.mean(difference ** 2)))
+
+
+class _Setup(NamedTuple):
+    """Observation geometry and unit-density sources of a correction (see _setup_correction)"""
+    lons: np.ndarray
+    lats: np.ndarray
+    geoid_grid: np.ndarray
+    gamma_grid: np.ndarray
+    valid_obs_mask: np.ndarray
+    obs_lats_rad_flat: np.ndarray
+    obs_lons_rad_flat: np.ndarray
+    r_obs_flat: np.ndarray
+    dlat_rad: float
+    dlon_rad: float
+    unit_sets: dict
+    correction_densities: dict
+    source_grids: dict
+
+
+def _setup_correction(correction_num, geoid, topography, crust, sediment, params, log):
+    """Resample the inputs onto the geoid grid and build the unit-density source sets"""
+    # Grid of the geoid dataset
+    lons = np.asarray(geoid.lons, dtype=np.float64)
+    lats = np.asarray(geoid.lats, dtype=np.float64)
+    nlons, nlats = len(lons), len(lats)
+    dx_deg = lons[1] - lons[0]
+    geoid_grid = geoid.values
+    log('info', f"📐 Using grid from selected dataset: {nlats}×{nlons} = {nlats*nlons} cells, resolution = {dx_deg:.4f}°")
+
+    # Resample the source grids to the geoid grid
+    elev_grid = topography.resample(lons, lats) if topography is not None else None
+    crustal_grid = None
+    if crust is not None:
+        crustal_grid = crust.resample(lons, lats)
+        # Convert to meters if in km
+        if np.nanmax(np.abs(crustal_grid)) < 100:
+            crustal_grid = crustal_grid * 1000.0
+            log('info', "📏 Converted crustal thickness from km to meters")
+    sedimentary_grid = None
+    if sediment is not None:
+        sedimentary_grid = sediment.resample(lons, lats)
+        # Convert to meters if in km
+        if np.nanmax(np.abs(sedimentary_grid)) < 50:
+            sedimentary_grid = sedimentary_grid * 1000.0
+            log('info', "📏 Converted sedimentary thickness from km to meters")
+
+    # Prepare observation geometry
+    lats_rad = np.radians(lats)
+    ell_radii = np.array([ellipsoidal_radius(lat) for lat in lats_rad])
+    gamma_vals = np.array([somigliana_gamma(lat) for lat in lats_rad])
+    gamma_grid = gamma_vals[:, np.newaxis]
+
+    # Safe grids for radius computation
+    geoid_safe = np.where(np.isfinite(geoid_grid), geoid_grid, 0.0)
+    elev_safe = np.where(np.isfinite(elev_grid), elev_grid, 0.0) if elev_grid is not None else np.zeros_like(geoid_grid)
+
+    # Observation radius (at geoid surface)
+    r_obs_grid = ell_radii[:, np.newaxis] + elev_safe + geoid_safe
+    valid_obs_mask = np.isfinite(geoid_grid)
+    if elev_grid is not None:
+        valid_obs_mask &= np.isfinite(elev_grid)
+
+    # Observation geometry shared by every correction
+    obs_lats_rad_flat = np.radians(np.repeat(lats, nlons))
+    obs_lons_rad_flat = np.radians(np.tile(lons, nlats))
+    r_obs_flat = r_obs_grid.flatten().copy()
+    r_obs_flat[~valid_obs_mask.flatten()] = np.nan
+    dlat_rad = math.radians(dx_deg)
+    dlon_rad = math.radians(dx_deg)
+
+    # Unit-density source tesseroids per density class:
+    # class -> (SourceSet with rho = 1, cutoff (deg), batch size)
+    unit_sets = {}
+    # Signed density of every class, per correction
+    correction_densities = {}
+    # Resampled source grids, returned with the results
+    source_grids = {}
+
+    # ==============================
+    # TOPOGRAPHIC SOURCES
+    # ==============================
+    if correction_num in ["1", "4", "5"]:
+        topo_sources, is_rock = topographic_sources(
+            lats, lons, elev_grid, geoid_safe, ell_radii,
+            params.topo_min_thickness, params.rho_rock, params.rho_water
+        )
+        log('info', f"Building {len(topo_sources.lat)} topographic source tesseroids...")
+        for name, mask in (('rock', is_rock), ('water', ~is_rock)):
+            unit_sets[name] = (
+                unit_source_set(SourceSet(*(values[mask] for values in topo_sources))),
+                params.cutoff_deg_topo, params.batch_size_topo
+            )
+        correction_densities['topographic'] = {'rock': params.rho_rock, 'water': params.rho_water}
+        source_grids['topography'] = elev_grid
+
+    # ==============================
+    # CRUSTAL SOURCES
+    # ==============================
+    if correction_num in ["2", "4", "5"]:
+        delta_rho = params.rho_mantle - params.rho_crust
+        crust_sources, is_thin = crustal_sources(
+            lats, lons, crustal_grid, elev_safe, geoid_safe, ell_radii,
+            params.reference_thickness * 1000.0, params.crust_min_thickness, delta_rho
+        )
+        log('info', f"Building {len(crust_sources.lat)} crustal source tesseroids...")
+        for name, mask in (('moho_positive', is_thin), ('moho_negative', ~is_thin)):
+            unit_sets[name] = (
+                unit_source_set(SourceSet(*(values[mask] for values in crust_sources))),
+                params.cutoff_deg_crust, params.batch_size_crust
+            )
+        correction_densities['crustal'] = {'moho_positive': delta_rho, 'moho_negative': -delta_rho}
+        source_grids['crustal_thickness'] = crustal_grid
+
+    # ==============================
+    # SEDIMENTARY SOURCES
+    # ==============================
+    if correction_num in ["3", "4", "5"] and sedimentary_grid is not None:
+        sed_sources = sedimentary_sources(
+            lats, lons, sedimentary_grid, elev_safe, geoid_safe, ell_radii,
+            params.sed_min_thickness, params.rho_sediment_contrast
+        )
+        log('info', f"Valid sedimentary tesseroids: {len(sed_sources.lat)}")
+        unit_sets['sediment'] = (unit_source_set(sed_sources), params.cutoff_deg_sed, params.batch_size_sed)
+        correction_densities['sedimentary'] = {'sediment': params.rho_sediment_contrast}
+        source_grids['sedimentary_thickness'] = sedimentary_grid
+
+    return _Setup(lons, lats, geoid_grid, gamma_grid, valid_obs_mask,
+                  obs_lats_rad_flat, obs_lons_rad_flat, r_obs_flat, dlat_rad, dlon_rad,
+                  unit_sets, correction_densities, source_grids)
+
+
+def _merge_classes(setup):
+    """Setup in which the classes of every correction form one source set, and the merged densities.
+
+    Methods other than ``indexed`` cannot fuse source classes into one
+    sweep, so a pass per class would repeat the whole pass (for the
+    regular-grid kernel its FFTs). The sources of a correction with several
+    classes are merged instead, each keeping its class density; the merged
+    set is a class of density 1 named after the correction. Returns the new
+    setup and {correction: {class: density}} of the merged corrections.
+    """
+    unit_sets = {}
+    correction_densities = {}
+    merged = {}
+    for kind, densities in setup.correction_densities.items():
+        if len(densities) == 1:
+            unit_sets.update((name, setup.unit_sets[name]) for name in densities)
+            correction_densities[kind] = densities
+            continue
+        sets = [setup.unit_sets[name] for name in densities]
+        sources = SourceSet(*(np.concatenate([s[0][k] for s in sets]) for k in range(4)),
+                            np.concatenate([rho * s[0].rho for s, rho in zip(sets, densities.values())]))
+        # The classes of a correction share its cutoff and batch size
+        unit_sets[kind] = (sources, sets[0][1], sets[0][2])
+        correction_densities[kind] = {kind: 1.0}
+        merged[kind] = densities
+    return setup._replace(unit_sets=unit_sets, correction_densities=correction_densities), merged
+
+
+def _engine_threads(engine):
+    """Threads the kernels of ``engine`` run on"""
+    if engine.n_workers and engine.method in TILED_METHODS:
+        n_workers, threads_per_worker = default_layout(engine.n_workers)
+        return n_workers * int(engine.threads_per_worker or threads_per_worker)
+    import numba
+    return numba.get_num_threads()
+
+
+def _estimate(setup, engine, model):
+    """CostEstimate of a prepared correction"""
+    shape = (len(setup.lats), len(setup.lons))
+    lat0, lon0 = math.radians(setup.lats[0]), math.radians(setup.lons[0])
+    lat_step = math.radians(setup.lats[1] - setup.lats[0]) if len(setup.lats) > 1 else 1.0
+    lon_step = math.radians(setup.lons[1] - setup.lons[0]) if len(setup.lons) > 1 else 1.0
+    sources = {}
+    pairs = {}
+    for name, (source_set, cutoff_deg, _) in setup.unit_sets.items():
+        sources[name] = len(source_set.lat)
+        # Sources sit on the grid nodes
+        rows = np.rint((source_set.lat - lat0) / lat_step).astype(np.int64)
+        cols = np.rint((source_set.lon - lon0) / lon_step).astype(np.int64)
+        counts = np.zeros(shape, dtype=np.int64)
+        np.add.at(counts, (np.clip(rows, 0, shape[0] - 1), np.clip(cols, 0, shape[1] - 1)), 1)
+        pairs[name] = count_pairs(setup.lats, setup.lons, counts, setup.valid_obs_mask,
+                                  math.cos(math.radians(cutoff_deg)))
+    rate = model.rate(engine.method, engine.kernel_options()) if model is not None else None
+    total_pairs = sum(pairs.values())
+    seconds = total_pairs / (rate * _engine_threads(engine)) if rate else None
+    n_obs = setup.r_obs_flat.size
+    return CostEstimate(n_obs, sources, pairs, seconds,
+                        peak_memory(n_obs, sum(sources.values()), len(sources)))
+
+
+def estimate_correction(correction, geoid, topography=None, crust=None, sediment=None,
+                        params=None, engine=None, model=None):
+    """Predict the sources, observation-source pairs, run time and peak memory of a correction.
+
+    Arguments are as in compute_correction; ``model`` is the
+    cost_model.ThroughputModel that converts pairs to seconds (default: the
+    one stored for this machine, calibrated on first use).
+    Returns a cost_model.CostEstimate.
+    """
+    correction_num = correction_number(correction)
+    crust, sediment = _used_grids(correction_num, crust, sediment)
+    setup = _setup_correction(correction_num, geoid, topography, crust, sediment,
+                              params or CorrectionParameters(), _log_nothing)
+    return _estimate(setup, engine or EngineSettings(), model or ThroughputModel())
+
+
+def describe_estimate(estimate):
+    """One-line summary of a CostEstimate"""
+    text = (f"{estimate.total_sources:,} source tesseroids, {estimate.total_pairs:.3g} observation-source pairs, "
+            f"~{estimate.peak_bytes / 1024 ** 2:,.0f} MB peak memory")
+    if estimate.seconds is not None:
+        text += f", ~{estimate.seconds / 60:.1f} min" if estimate.seconds > 90 else f", ~{estimate.seconds:.0f} s"
+    return text
+
+
+def compute_correction(correction, geoid, topography=None, crust=None, sediment=None,
+                       params=None, engine=None, unit_cache=None, store=None, log=None, progress=None,
+                       preview=None, preview_interval=1.0, limits=None, cost_model=None):
+    """Compute one of the CORRECTION_TYPES on the geoid grid.
+
+    ``correction`` is the number ('1'-'5') or label of the correction;
+    ``geoid`` and the source grids are Grid objects; crust and sediment
+    thicknesses are in metres, or in km when their largest value is below 100
+    (crust) or 50 (sediment).
+    ``params`` and ``engine`` default to CorrectionParameters() and
+    EngineSettings().
+
+    ``unit_cache`` (a dict) maps unit_potential_key digests to unit-density
+    potentials: matching classes skip the kernels and on return it holds
+    exactly the unit potentials of this run. ``store`` (a
+    result_cache.ResultCache) is checked for the whole result and for the
+    unit potentials before computing and receives both afterwards.
+    ``log(level, message)`` receives progress messages with a level of
+    'info', 'success' or 'caption'; ``progress(stage, done, total)`` is
+    called after every batch of every kernel pass. ``preview(stage, snapshot)``
+    receives a PassPreview with the partial correction, the throughput in
+    observation-source pairs per second and the estimated time remaining, at
+    most every ``preview_interval`` seconds and at the end of every pass.
+
+    With ``limits`` (a cost_model.ResourceLimits) or ``cost_model`` (a
+    cost_model.ThroughputModel) the run is estimated first and the estimate
+    logged. A run over the limits raises CostLimitExceeded, or with the
+    "downsample" action is computed on a strided geoid grid that fits.
+    The measured throughput of every pass is recorded in the model.
+    With ``engine.precision = "mixed"`` every pass is also run in float64 on
+    a sample of PRECISION_SAMPLE observations and the maximum and RMS geoid
+    height difference (m) of each pass are stored in
+    ``results['precision_report']``.
+    Returns the results dict.
+    """
+    correction_num = correction_number(correction)
+    correction_type = CORRECTION_TYPES[correction_num]
+    params = params or CorrectionParameters()
+    engine = engine or EngineSettings()
+    log = log or _log_nothing
+    if engine.method not in ENGINE_METHODS:
+        raise ValueError(f"Unknown engine method: {engine.method}")
+    if engine.precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {engine.precision}")
+    if engine.precision != "float64" and engine.method in ("direct", "regular"):
+        raise ValueError(f"Engine method {engine.method!r} only runs in float64")
+    if correction_num in ["1", "4", "5"] and topography is None:
+        raise ValueError(f"{correction_type} needs a topography grid")
+    if correction_num in ["2", "4", "5"] and crust is None:
+        raise ValueError(f"{correction_type} needs a crustal thickness grid")
+    if correction_num == "3" and sediment is None:
+        raise ValueError(f"{correction_type} needs a sediment thickness grid")
+    crust, sediment = _used_grids(correction_num, crust, sediment)
+
+    if store is not None:
+        cache_key = correction_key(correction_num, geoid, topography, crust, sediment, params, engine)
+        cached = store.get(cache_key)
+        if cached is not None:
+            log('success', "⚡ Loaded from the result cache: identical inputs and parameters were computed before")
+            return cached
+
+    setup = _setup_correction(correction_num, geoid, topography, crust, sediment, params, log)
+    merged = {}
+    if engine.method != "indexed":
+        setup, merged = _merge_classes(setup)
+    lons, lats = setup.lons, setup.lats
+    nlons, nlats = len(lons), len(lats)
+    grid_lons, grid_lats = np.meshgrid(lons, lats)
+    geoid_grid, gamma_grid, valid_obs_mask = setup.geoid_grid, setup.gamma_grid, setup.valid_obs_mask
+    obs_lats_rad_flat, obs_lons_rad_flat, r_obs_flat = setup.obs_lats_rad_flat, setup.obs_lons_rad_flat, setup.r_obs_flat
+    dlat_rad, dlon_rad = setup.dlat_rad, setup.dlon_rad
+    unit_sets, correction_densities = setup.unit_sets, setup.correction_densities
+
+    # ==============================
+    # COST ESTIMATE AND LIMITS
+    # ==============================
+    estimate = None
+    if cost_model is not None or (limits is not None and limits.active):
+        cost_model = cost_model or ThroughputModel()
+        estimate = _estimate(setup, engine, cost_model)
+        log('caption', f"Estimated cost: {describe_estimate(estimate)}")
+        exceeded = limits.violations(estimate) if limits is not None else []
+        if exceeded:
+            message = f"{correction_type} exceeds the resource limits: {'; '.join(exceeded)}"
+            stride = limits.downsample_stride(estimate)
+            if limits.action != "downsample" or min(nlats, nlons) // stride < 2:
+                raise CostLimitExceeded(message)
+            log('warning', f"⚠️ {message}. Computing on a {stride}× coarser geoid grid "
+                           f"({len(lats[::stride])}×{len(lons[::stride])} nodes) instead.")
+            return compute_correction(
+                correction_num, geoid.coarsen(stride), topography, crust, sediment, params=params,
+                engine=engine, unit_cache=unit_cache, store=store, log=log, progress=progress,
+                preview=preview, preview_interval=preview_interval, limits=limits, cost_model=cost_model
+            )
+
+    results = {
+        'original_geoid': geoid_grid,
+        'lons': lons,
+        'lats': lats,
+        'grid_lons': grid_lons,
+        'grid_lats': grid_lats,
+        **setup.source_grids
+    }
+
+    # ==============================
+    # POTENTIAL COMPUTATION
+    # ==============================
+    # The potential is linear in density, so the kernels are run once per
+    # density class with rho = 1 and the unit potentials can be reused by a
+    # run that only changes densities. Merged classes (see _merge_classes)
+    # carry their densities, which are then part of the key.
+    kernel_options = engine.kernel_options()
+    class_kind = {name: kind for kind, classes in correction_densities.items() for name in classes}
+    unit_cache = {} if unit_cache is None else unit_cache
+    unit_keys = {
+        name: unit_potential_key(
+            obs_lats_rad_flat, obs_lons_rad_flat, r_obs_flat, sources,
+            math.cos(math.radians(cutoff_deg)), dlat_rad, dlon_rad,
+            engine.method, **kernel_options,
+            **({'densities': sorted(merged[name].items())} if name in merged else {})
+        )
+        for name, (sources, cutoff_deg, _) in unit_sets.items()
+    }
+    unit_potentials = {}
+    pending = []
+    for name, (sources, _, _) in unit_sets.items():
+        if unit_keys[name] not in unit_cache and store is not None:
+            stored = store.get(f"unit-{unit_keys[name]}")
+            if stored is not None:
+                unit_cache[unit_keys[name]] = stored
+        if unit_keys[name] in unit_cache:
+            unit_potentials[name] = unit_cache[unit_keys[name]]
+        elif len(sources.lat) == 0:
+            unit_potentials[name] = np.where(np.isfinite(r_obs_flat), 0.0, np.nan)
+        else:
+            pending.append(name)
+
+    reused = [name for name in unit_sets if unit_keys[name] in unit_cache]
+    if reused:
+        log('info', f"♻️ Reusing unit-density potentials: {', '.join(CLASS_LABELS[name] for name in reused)}")
+
+    # Classes computed in one kernel call: everything when fused, one
+    # correction at a time with the spatial-index kernel, else one (possibly
+    # merged) class at a time
+    if engine.method == "indexed" and engine.fuse_passes:
+        groups = [pending] if pending else []
+    elif engine.method == "indexed":
+        groups = [[name for name in pending if class_kind[name] == kind] for kind in correction_densities]
+        groups = [group for group in groups if group]
+    else:
+        groups = [[name] for name in pending]
+    pool_layout = None
+    if engine.n_workers and engine.method in TILED_METHODS:
+        pool_layout = {'n_workers': engine.n_workers, 'threads_per_worker': engine.threads_per_worker}
+
+    class_density = {name: rho for densities in correction_densities.values() for name, rho in densities.items()}
+    gamma_grid_safe = np.where(gamma_grid > 1e-8, gamma_grid, 1e-8)
+    precision_report = {}
+    checkpoints = []
+    for group in groups:
+        stage = ', '.join(CLASS_LABELS[name] for name in group)
+        log('info', f"Computing {'potential' if merged else 'unit-density potential'}: {stage}...")
+        kernel_stats = {}
+        checkpoint = None
+        resumed = False
+        if engine.checkpoints and engine.method != "regular":
+            group_key = hashlib.sha1("|".join(unit_keys[name] for name in group).encode()).hexdigest()
+            checkpoint = BatchCheckpoint(group_key, len(r_obs_flat), len(group))
+            checkpoints.append(checkpoint)
+            resumed = checkpoint.n_done > 0
+            if resumed:
+                log('info', f"⏯️ Resuming from checkpoint: {checkpoint.n_done:,} of {len(r_obs_flat):,} observations already computed")
+        elif preview is not None and engine.method != "regular":
+            # The preview reads the finished batches from an in-memory checkpoint
+            checkpoint = MemoryCheckpoint(len(r_obs_flat), len(group))
+
+        callbacks = []
+        if progress is not None:
+            callbacks.append(lambda done, total, stage=stage: progress(stage, done, total))
+        if preview is not None:
+            monitor = _PassMonitor(stage, checkpoint, np.isfinite(r_obs_flat),
+                                   np.array([class_density[name] for name in group]),
+                                   gamma_grid_safe, lons, lats, preview, preview_interval)
+            callbacks.append(monitor.update)
+        callback = _call_all(callbacks) if callbacks else None
+        t0 = time.time()
+
+        if pool_layout is not None:
+            group_potentials = compute_potentials_tiled(
+                obs_lats_rad_flat, obs_lons_rad_flat, r_obs_flat,
+                [unit_sets[name][0] for name in group],
+                [math.cos(math.radians(unit_sets[name][1])) for name in group],
+                dlat_rad, dlon_rad, method=engine.method,
+                batch_size=_group_batch_size(unit_sets[name][2] for name in group),
+                progress_callback=callback, stats=kernel_stats, checkpoint=checkpoint,
+                **pool_layout, **kernel_options
+            )
+        elif len(group) > 1:
+            group_potentials = compute_potentials_fused(
+                obs_lats_rad_flat, obs_lons_rad_flat, r_obs_flat,
+                [unit_sets[name][0] for name in group],
+                [math.cos(math.radians(unit_sets[name][1])) for name in group],
+                dlat_rad, dlon_rad,
+                batch_size=_group_batch_size(unit_sets[name][2] for name in group),
+                progress_callback=callback, stats=kernel_stats, checkpoint=checkpoint, **kernel_options
+            )
+        else:
+            sources, cutoff_deg, batch_size = unit_sets[group[0]]
+            group_potentials = [compute_potential(
+                obs_lats_rad_flat, obs_lons_rad_flat, r_obs_flat,
+                *sources, dlat_rad, dlon_rad, math.cos(math.radians(cutoff_deg)),
+                batch_size=batch_size, method=engine.method, progress_callback=callback,
+                grid_shape=(nlats, nlons), stats=kernel_stats, checkpoint=checkpoint,
+                **kernel_options
+            )]
+        unit_potentials.update(zip(group, group_potentials))
+        if store is not None:
+            for name, potentials_flat in zip(group, group_potentials):
+                store.put(f"unit-{unit_keys[name]}", potentials_flat,
+                          label=f"Unit-density potential: {CLASS_LABELS[name]}")
+
+        t_elapsed = time.time() - t0
+        log('success', f"✅ Computed in {t_elapsed:.1f} s")
+        utilisation = kernel_stats.get('thread_utilisation', [])
+        if len(utilisation) > 1:
+            log('caption', f"Estimated thread utilisation: {' '.join(f'{u:.0%}' for u in utilisation)} "
+                           f"(mean {np.mean(utilisation):.0%}; from kernel evaluations per thread, not measured time)")
+        if 'batch_size' in kernel_stats:
+            log('caption', f"Automatic batch size: {kernel_stats['batch_size']:,} observations per batch "
+                           f"(calibration sample: {kernel_stats['calibration_seconds'] * 1000:.0f} ms)")
+        if estimate is not None and not resumed:
+            cost_model.record(engine.method, kernel_options, sum(estimate.pairs[name] for name in group),
+                              t_elapsed, _engine_threads(engine))
+        if kernel_stats.get('refined_sources'):
+            refined_share = kernel_stats['refined_evaluations'] / (
+                kernel_stats['kernel_evaluations'] + kernel_stats['refined_evaluations'])
+            log('caption',
+                f"Near-field subdivision: {kernel_stats['refined_sources']:,} tesseroids split into "
+                f"{kernel_stats['refined_evaluations']:,} pieces, {refined_share:.1%} of the kernel "
+                f"evaluations (≈ {refined_share * t_elapsed:.1f} s)")
+        if engine.precision != "float64":
+            max_error, rms_error = _precision_error(
+                obs_lats_rad_flat, obs_lons_rad_flat, r_obs_flat, unit_sets, group, group_potentials,
+                class_density, gamma_grid_safe.ravel(), dlat_rad, dlon_rad, engine.method, kernel_options
+            )
+            precision_report[stage] = {'max': max_error, 'rms': rms_error}
+            log('caption', f"{PRECISIONS[engine.precision]}: max {max_error * 1000:.3g} mm, "
+                           f"RMS {rms_error * 1000:.3g} mm from a float64 run on "
+                           f"{min(PRECISION_SAMPLE, int(np.isfinite(r_obs_flat).sum())):,} observations")
+
+    # Keep only the unit potentials of this run; the checkpoints are no longer needed
+    unit_cache.clear()
+    unit_cache.update({unit_keys[name]: unit_potentials[name] for name in unit_sets})
+    for checkpoint in checkpoints:
+        checkpoint.discard()
+
+    # Potential to geoid height per unit density: deltaN = V / gamma
+    unit_corrections = {}
+    for name, potentials_flat in unit_potentials.items():
+        unit_deltaN = potentials_flat.reshape((nlats, nlons)) / gamma_grid_safe
+        unit_deltaN[~valid_obs_mask] = np.nan
+        unit_corrections[name] = unit_deltaN
+
+    for kind, densities in correction_densities.items():
+        results[f'{kind}_correction'] = combine_unit_potentials(unit_corrections, densities)
+    if not merged:
+        # Density sweeps need one unit potential per class
+        results['unit_corrections'] = unit_corrections
+        results['correction_densities'] = correction_densities
+    if precision_report:
+        results['precision_report'] = precision_report
+
+    # ==============================
+    # ASSEMBLE FINAL RESULTS
+    # ==============================
+    if correction_num == "1":
+        results['correction'] = results['topographic_correction']
+        results['corrected_geoid'] = geoid_grid - results['topographic_correction']
+        results['total_correction'] = results['topographic_correction']
+
+    elif correction_num == "2":
+        results['correction'] = results['crustal_correction']
+        results['corrected_geoid'] = geoid_grid - results['crustal_correction']
+        results['total_correction'] = results['crustal_correction']
+
+    elif correction_num == "3":
+        results['correction'] = results['sedimentary_correction']
+        results['corrected_geoid'] = geoid_grid - results['sedimentary_correction']
+        results['total_correction'] = results['sedimentary_correction']
+
+    elif correction_num == "4":
+        total_corr = results['topographic_correction'] + results['crustal_correction']
+        if 'sedimentary_correction' in results:
+            total_corr += results['sedimentary_correction']
+        results['total_correction'] = total_corr
+        results['corrected_geoid'] = geoid_grid - total_corr
+
+    elif correction_num == "5":
+        total_corr = results['topographic_correction'] + results['crustal_correction']
+        if 'sedimentary_correction' in results:
+            total_corr += results['sedimentary_correction']
+        results['total_correction'] = total_corr
+        results['residual_geoid'] = geoid_grid - total_corr
+
+    if store is not None:
+        store.put(cache_key, results, label=f"{correction_type} ({nlats}×{nlons})")
+    return results
+
+
+def output_grids(results):
+    """The (nlat, nlon) fields of a results dict as Grid objects, by key"""
+    lons, lats = results['lons'], results['lats']
+    shape = (len(lats), len(lons))
+    return {key: Grid(lons, lats, values) for key, values in results.items()
+            if isinstance(values, np.ndarray) and values.shape == shape
+            and key not in ('grid_lons', 'grid_lats')}
@@ -0,0 +1,248 @@
+"""
+Cost estimates and resource limits for corrections.
+
+The work of a correction is measured in observation-source pairs: for every
+valid observation, the number of source tesseroids inside its cutoff cap.
+count_pairs estimates it from a grid of source counts, ThroughputModel turns
+pairs into seconds with the pairs/s measured on this machine, and
+ResourceLimits holds the budget an administrator sets through the
+environment:
+
+    GEOID_MAX_PAIRS       observation-source pairs per correction
+    GEOID_MAX_RUNTIME_S   predicted run time in seconds
+    GEOID_MAX_MEMORY_MB   predicted peak memory in megabytes
+    GEOID_LIMIT_ACTION    "refuse" (default) or "downsample"
+
+The throughput model is calibrated on a small synthetic problem the first
+time a method is used. Every finished run then refines it. It is stored in
+``GEOID_THROUGHPUT_FILE`` (default ``~/.cache/geoid_throughput.json``).
+"""
+import json
+import math
+import os
+import tempfile
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+# Rough float64 arrays held per observation point (input, resampled and
+# result grids, observation tables, potentials) and per source tesseroid
+# (source sets, kernel table, index), plus the per-class potentials
+_OBS_ARRAYS = 30
+_OBS_ARRAYS_PER_CLASS = 3
+_SOURCE_ARRAYS = 26
+
+
+class CostLimitExceeded(ValueError):
+    """Raised when a correction exceeds the configured resource limits"""
+
+
+class CostEstimate(NamedTuple):
+    """Predicted size of a correction run.
+
+    ``sources`` and ``pairs`` map every density class to its source count
+    and its estimated observation-source pairs; ``seconds`` is None when no
+    throughput is known for the engine settings.
+    """
+    n_obs: int
+    sources: dict
+    pairs: dict
+    seconds: Optional[float]
+    peak_bytes: int
+
+    @property
+    def total_pairs(self):
+        return int(sum(self.pairs.values()))
+
+    @property
+    def total_sources(self):
+        return int(sum(self.sources.values()))
+
+
+def count_pairs(lats, lons, source_counts, valid, cos_cutoff, max_samples=4096):
+    """Estimated observation-source pairs inside the cutoff on a regular grid.
+
+    ``lats``/``lons`` are the grid axes in degrees, ``source_counts`` the
+    number of sources per cell and ``valid`` the mask of observation points.
+    The pairs of an evenly strided subset of at most ``max_samples``
+    observations are counted row by row from prefix sums and scaled to all
+    valid observations.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    n_valid = int(np.count_nonzero(valid))
+    if n_valid == 0 or not np.any(source_counts):
+        return 0
+    nlat, nlon = source_counts.shape
+    stride = max(1, math.ceil(math.sqrt(nlat * nlon / max_samples)))
+    sample_rows, sample_cols = np.nonzero(valid[::stride, ::stride])
+    if len(sample_rows) == 0:
+        sample_rows, sample_cols = np.nonzero(valid)
+    else:
+        sample_rows, sample_cols = sample_rows * stride, sample_cols * stride
+
+    dlon = abs(lons[1] - lons[0]) if nlon > 1 else 360.0
+    periodic = nlon * dlon >= 360.0 - 1e-6
+    counts = np.asarray(source_counts, dtype=np.int64)
+    if periodic:
+        # Windows may wrap around: prefix sums over three copies of each row
+        counts = np.concatenate([counts, counts, counts], axis=1)
+    prefix = np.zeros((nlat, counts.shape[1] + 1), dtype=np.int64)
+    np.cumsum(counts, axis=1, out=prefix[:, 1:])
+    offset = nlon if periodic else 0
+
+    lat_o = np.radians(lats[sample_rows])
+    sin_o, cos_o = np.sin(lat_o), np.cos(lat_o)
+    col_o = sample_cols.astype(np.float64)
+    cos_cutoff = min(1.0, max(-1.0, float(cos_cutoff)))
+    cutoff_deg = math.degrees(math.acos(cos_cutoff))
+    pairs = np.zeros(len(sample_rows), dtype=np.int64)
+    for j in np.nonzero(counts[:, :nlon].any(axis=1))[0]:
+        lat_s = math.radians(lats[j])
+        near = np.abs(lats[sample_rows] - lats[j]) <= cutoff_deg
+        if not near.any():
+            continue
+        # cos(psi) >= cos_cutoff  <=>  cos(dlon) >= (cos_cutoff - sin_o sin_s) / (cos_o cos_s)
+        denominator = np.maximum(cos_o[near] * math.cos(lat_s), 1e-12)
+        ratio = (cos_cutoff - sin_o[near] * math.sin(lat_s)) / denominator
+        half = np.degrees(np.arccos(np.clip(ratio, -1.0, 1.0))) / dlon
+        half = np.where(ratio > 1.0, -1.0, np.minimum(half, (nlon - 1) / 2.0 if periodic else nlon))
+        lo = np.ceil(col_o[near] - half).astype(np.int64) + offset
+        hi = np.floor(col_o[near] + half).astype(np.int64) + offset
+        lo = np.clip(lo, 0, counts.shape[1])
+        hi = np.clip(hi + 1, 0, counts.shape[1])
+        pairs[near] += np.maximum(prefix[j, hi] - prefix[j, lo], 0)
+    return int(round(pairs.mean() * n_valid))
+
+
+def peak_memory(n_obs, n_sources, n_classes):
+    """Rough peak memory (bytes) of a correction run"""
+    return int(8 * (n_obs * (_OBS_ARRAYS + _OBS_ARRAYS_PER_CLASS * n_classes) + n_sources * _SOURCE_ARRAYS))
+
+
+def default_throughput_file():
+    """File holding the throughput measured on this machine"""
+    return os.environ.get("GEOID_THROUGHPUT_FILE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "geoid_throughput.json"))
+
+
+class ThroughputModel:
+    """Observation-source pairs per second and per thread, per engine setting.
+
+    Rates are keyed by the engine method, whether near-field subdivision
+    is on and the source-table precision. ``rate`` calibrates a missing key on a synthetic grid; ``record``
+    blends in the throughput of a finished run.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_throughput_file()
+        try:
+            with open(self.path) as f:
+                self.rates = json.load(f)
+        except (OSError, ValueError):
+            self.rates = {}
+
+    @staticmethod
+    def key(method, options):
+        key = f"{method}/{'split' if options.get('split_ratio', 0) > 0 else 'plain'}"
+        precision = options.get('precision', 'float64')
+        return key if precision == 'float64' else f"{key}/{precision}"
+
+    def _save(self):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".json.tmp", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.rates, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def rate(self, method, options, calibrate=True):
+        """Pairs per second and thread, calibrating first if nothing is known yet"""
+        key = self.key(method, options)
+        if key not in self.rates and calibrate:
+            self.calibrate(method, options)
+        entry = self.rates.get(key)
+        return entry["pairs_per_thread_second"] if entry else None
+
+    def record(self, method, options, pairs, seconds, threads, weight=0.5):
+        """Blend the throughput of a finished run into the model"""
+        if pairs <= 0 or seconds <= 0:
+            return
+        key = self.key(method, options)
+        measured = pairs / seconds / max(1, threads)
+        entry = self.rates.get(key)
+        if entry is not None:
+            measured = weight * measured + (1.0 - weight) * entry["pairs_per_thread_second"]
+        self.rates[key] = {"pairs_per_thread_second": measured, "updated": time.time()}
+        self._save()
+
+    def calibrate(self, method, options, n_side=60, cutoff_deg=12.0):
+        """Time ``method`` on a synthetic n_side x n_side problem and record its throughput"""
+        import numba
+        from tesseroid_engine import compute_potential, make_synthetic_problem, warmup_kernels
+        warmup_kernels()
+        problem = make_synthetic_problem(n_side=n_side)
+        axis = np.degrees(problem[0][::n_side])
+        lons = np.degrees(problem[1][:n_side])
+        cos_cutoff = math.cos(math.radians(cutoff_deg))
+        pairs = count_pairs(axis, lons, np.ones((n_side, n_side), dtype=np.int64),
+                            np.ones((n_side, n_side), dtype=bool), cos_cutoff, max_samples=n_side * n_side)
+        t0 = time.perf_counter()
+        compute_potential(*problem, cos_cutoff, method=method, grid_shape=(n_side, n_side), **options)
+        seconds = time.perf_counter() - t0
+        self.rates.pop(self.key(method, options), None)
+        self.record(method, options, pairs, seconds, numba.get_num_threads(), weight=1.0)
+
+
+class ResourceLimits(NamedTuple):
+    """Budget of one correction; None means unlimited.
+
+    ``action`` is "refuse" (raise CostLimitExceeded) or "downsample" (run on
+    a coarser observation grid that fits the budget).
+    """
+    max_pairs: Optional[float] = None
+    max_seconds: Optional[float] = None
+    max_memory_mb: Optional[float] = None
+    action: str = "refuse"
+
+    @classmethod
+    def from_env(cls):
+        """Limits from GEOID_MAX_PAIRS, GEOID_MAX_RUNTIME_S, GEOID_MAX_MEMORY_MB and GEOID_LIMIT_ACTION"""
+        def number(name):
+            value = os.environ.get(name, "").strip()
+            return float(value) if value else None
+        action = os.environ.get("GEOID_LIMIT_ACTION", "refuse").strip().lower()
+        if action not in ("refuse", "downsample"):
+            raise ValueError(f"GEOID_LIMIT_ACTION must be 'refuse' or 'downsample', not {action!r}")
+        return cls(number("GEOID_MAX_PAIRS"), number("GEOID_MAX_RUNTIME_S"), number("GEOID_MAX_MEMORY_MB"), action)
+
+    @property
+    def active(self):
+        return any(limit is not None for limit in (self.max_pairs, self.max_seconds, self.max_memory_mb))
+
+    def violations(self, estimate):
+        """Descriptions of the limits the estimate exceeds (empty if it fits)"""
+        exceeded = []
+        if self.max_pairs is not None and estimate.total_pairs > self.max_pairs:
+            exceeded.append(f"{estimate.total_pairs:.3g} observation-source pairs > limit {self.max_pairs:.3g}")
+        if self.max_seconds is not None and estimate.seconds is not None and estimate.seconds > self.max_seconds:
+            exceeded.append(f"predicted {estimate.seconds:.0f} s > limit {self.max_seconds:.0f} s")
+        if self.max_memory_mb is not None and estimate.peak_bytes > self.max_memory_mb * 1024 ** 2:
+            exceeded.append(f"predicted {estimate.peak_bytes / 1024 ** 2:.0f} MB > limit {self.max_memory_mb:.0f} MB")
+        return exceeded
+
+    def downsample_stride(self, estimate):
+        """Grid stride expected to bring the estimate within the limits.
+
+        Pairs and run time fall with the fourth power of the stride (fewer
+        observations and fewer sources), memory with its square.
+        """
+        ratio = 1.0
+        if self.max_pairs is not None:
+            ratio = max(ratio, (estimate.total_pairs / self.max_pairs) ** 0.25)
+        if self.max_seconds is not None and estimate.seconds is not None:
+            ratio = max(ratio, (estimate.seconds / self.max_seconds) ** 0.25)
+        if self.max_memory_mb is not None:
+            ratio = max(ratio, (estimate.peak_bytes / (self.max_memory_mb * 1024 ** 2)) ** 0.5)
+        return max(1, math.ceil(ratio - 1e-9))
@@ -0,0 +1,251 @@
+"""
+Command-line batch pipeline for geoid corrections.
+
+Each run is described by a TOML or YAML run file holding the inputs and
+parameters of the Geoid Corrections section; the pipeline reads the input
+files, grids them onto a common grid, computes the correction with
+correction_engine and writes the results:
+
+    python geoid_pipeline.py runs/*.toml --workers 16 --jobs 4
+
+Example run file (paths are relative to the run file):
+
+    correction = "5"                  # 1-5 as in the GUI
+    output = "results"                # directory for <name>.npz / <name>.csv
+
+    [grid]                            # common grid (default: geoid extent)
+    bounds = [-128.0, -100.0, 40.0, 51.0]   # lon_min, lon_max, lat_min, lat_max
+    resolution = 200                  # nodes along the longer side
+    method = "linear"                 # linear, cubic, nearest or rbf
+    smoothing = 1.0                   # Gaussian sigma in cells, 0 = off
+    clip_percentiles = [2.0, 98.0]    # or false
+
+    [inputs.geoid]
+    path = "geoid_residual (1).gdf"
+    [inputs.crust]
+    path = "crsthk.xyz"
+    columns = ["long", "lat", "thk"]  # lon, lat, value (names or indices)
+    [inputs.sediment]
+    path = "sedthk.xyz"
+    [inputs.topography]
+    path = "ETOPO_2022_v1_60s_N90W180_surface.nc"
+    stride = 2                        # NetCDF/GeoTIFF: every 2nd node of the grid window
+
+    [parameters]                      # CorrectionParameters fields
+    reference_thickness = 40.0
+    batch_size_topo = "auto"          # batch sizes: observations or "auto"
+    [engine]                          # EngineSettings fields
+    method = "indexed"
+
+Several run files (or globs) are processed concurrently. ``--workers`` is
+the total core budget; it is split evenly between the ``--jobs`` runs that
+execute at the same time, each of which runs its kernels on its share of
+Numba threads. Every run logs its estimated cost first and obeys the
+resource limits of cost_model (GEOID_MAX_* environment variables).
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from correction_engine import (CORRECTION_TYPES, CorrectionParameters, EngineSettings, Grid,
+                               compute_correction, correction_number)
+from cost_model import ResourceLimits, ThroughputModel
+from grid_io import describe_parse, grid_to_frame, open_grid, point_columns, read_delimited
+from result_cache import ResultCache
+from tile_runner import default_layout, get_pool, shutdown_pools
+
+# Input grids of a run file and the compute_correction argument they feed
+INPUT_NAMES = ("geoid", "topography", "crust", "sediment")
+
+# Input files read lazily as grids (see grid_io.open_grid)
+GRID_EXTENSIONS = ('.nc', '.grd', '.tif', '.tiff', '.gdf')
+
+# Grid settings of a run file and their defaults
+GRID_DEFAULTS = {'bounds': None, 'resolution': 200, 'method': "linear", 'smoothing': 1.0,
+                 'clip_percentiles': (2.0, 98.0)}
+
+
+def load_run_file(path):
+    """Parse a TOML (.toml) or YAML (.yaml/.yml) run file into a dict"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    if ext in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError("YAML run files need PyYAML (pip install pyyaml)") from None
+        with open(path) as f:
+            return yaml.safe_load(f) or {}
+    raise ValueError(f"Run files must be .toml, .yaml or .yml: {path}")
+
+
+def read_table(path, stats=None):
+    """DataFrame of a point file: NetCDF/GRD, GeoTIFF, GDF or delimited text (CSV/XYZ).
+
+    ``stats`` receives the parse statistics of delimited text (see
+    grid_io.read_delimited).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in GRID_EXTENSIONS:
+        return grid_to_frame(open_grid(path))
+    return read_delimited(path, stats=stats)
+
+
+def grid_input(spec, base_dir, grid_settings, bounds, log=None):
+    """Read one [inputs.*] entry and interpolate it onto the common grid"""
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = os.path.join(base_dir, spec['path'])
+    settings = {**grid_settings, **{k: spec[k] for k in GRID_DEFAULTS if k in spec}}
+    clip = settings['clip_percentiles']
+    if os.path.splitext(path)[1].lower() in GRID_EXTENSIONS:
+        # Gridded files: read only the window of the common grid, no points
+        return open_grid(path, bounds=bounds, stride=int(spec.get('stride', 1))).regrid(
+            bounds, resolution=int(settings['resolution']), method=settings['method'],
+            smoothing=float(settings['smoothing']), clip_percentiles=tuple(clip) if clip else None
+        )
+    parse_stats = {}
+    df = read_table(path, stats=parse_stats)
+    if parse_stats and log is not None:
+        log('info', f"Parsed {os.path.basename(path)}: {describe_parse(parse_stats)}")
+    lon_col, lat_col, val_col = point_columns(df, spec.get('columns'))
+    return Grid.from_points(
+        pd.to_numeric(df[lon_col], errors='coerce'), pd.to_numeric(df[lat_col], errors='coerce'),
+        pd.to_numeric(df[val_col], errors='coerce'),
+        bounds=bounds, resolution=int(settings['resolution']), method=settings['method'],
+        smoothing=float(settings['smoothing']), clip_percentiles=tuple(clip) if clip else None
+    )
+
+
+def write_results(results, output_dir, name):
+    """Write <name>.npz (every grid) and <name>.csv (the GUI's download table)"""
+    os.makedirs(output_dir, exist_ok=True)
+    grids = {key: value for key, value in results.items()
+             if isinstance(value, np.ndarray) and key not in ('grid_lons', 'grid_lats')}
+    grids.update({f"unit_correction_{k}": v for k, v in results.get('unit_corrections', {}).items()})
+    np.savez_compressed(os.path.join(output_dir, f"{name}.npz"), **grids)
+
+    table = {
+        'Longitude': results['grid_lons'].flatten(),
+        'Latitude': results['grid_lats'].flatten(),
+        'Original_Geoid': results['original_geoid'].flatten()
+    }
+    for key, column in (('corrected_geoid', 'Corrected_Geoid'), ('correction', 'Correction'),
+                        ('total_correction', 'Total_Correction'), ('residual_geoid', 'Residual_Geoid')):
+        if key in results:
+            table[column] = results[key].flatten()
+    pd.DataFrame(table).to_csv(os.path.join(output_dir, f"{name}.csv"), index=False)
+
+
+def run(path, use_cache=True, threads=None):
+    """Execute one run file; returns (name, output directory, elapsed seconds)"""
+    if threads:
+        import numba
+        numba.set_num_threads(max(1, min(int(threads), numba.config.NUMBA_NUM_THREADS)))
+    t0 = time.time()
+    config = load_run_file(path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    name = config.get('name', os.path.splitext(os.path.basename(path))[0])
+    correction_num = correction_number(config.get('correction', "5"))
+    inputs = config.get('inputs', {})
+    unknown = set(inputs) - set(INPUT_NAMES)
+    if unknown:
+        raise ValueError(f"{path}: unknown inputs {sorted(unknown)}; expected {INPUT_NAMES}")
+    if 'geoid' not in inputs:
+        raise ValueError(f"{path}: [inputs.geoid] is required")
+
+    def log(level, message):
+        # One write per line keeps the output of concurrent runs readable
+        sys.stdout.write(f"[{name}] {message}\n")
+        sys.stdout.flush()
+
+    # The geoid sets the common grid unless bounds are given
+    grid_settings = {**GRID_DEFAULTS, **config.get('grid', {})}
+    geoid = grid_input(inputs['geoid'], base_dir, grid_settings, grid_settings['bounds'], log)
+    bounds = (geoid.lons[0], geoid.lons[-1], geoid.lats[0], geoid.lats[-1])
+    grids = {'geoid': geoid}
+    for key in INPUT_NAMES[1:]:
+        if key in inputs:
+            grids[key] = grid_input(inputs[key], base_dir, grid_settings, bounds, log)
+            log('info', f"Gridded {key} onto {geoid.shape[0]}×{geoid.shape[1]} nodes")
+
+    results = compute_correction(
+        correction_num, **grids,
+        params=CorrectionParameters(**config.get('parameters', {})),
+        engine=EngineSettings(**config.get('engine', {})),
+        store=ResultCache() if use_cache else None,
+        log=log,
+        limits=ResourceLimits.from_env(),
+        cost_model=ThroughputModel()
+    )
+    output_dir = os.path.join(base_dir, config.get('output', "results"))
+    write_results(results, output_dir, name)
+    elapsed = time.time() - t0
+    log('success', f"{CORRECTION_TYPES[correction_num]} written to {output_dir} in {elapsed:.1f} s")
+    return name, output_dir, elapsed
+
+
+def expand_run_files(patterns):
+    """Run files matching the given paths or glob patterns, in order, without duplicates"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise FileNotFoundError(f"No run files match {pattern}")
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run geoid corrections from TOML/YAML run files")
+    parser.add_argument("run_files", nargs="+", help="run files or glob patterns")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="total number of cores to use (default: all available)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="runs executed at the same time (default: one per core, at most one per run file)")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the result cache")
+    args = parser.parse_args(argv)
+
+    paths = expand_run_files(args.run_files)
+    budget = default_layout(args.workers)[0]
+    jobs = max(1, min(args.jobs or budget, budget, len(paths)))
+    threads = max(1, budget // jobs)
+    print(f"{len(paths)} run file(s), {jobs} at a time with {threads} thread(s) each", flush=True)
+
+    failures = 0
+    try:
+        if jobs == 1:
+            for path in paths:
+                try:
+                    run(path, not args.no_cache, threads)
+                except Exception as e:
+                    failures += 1
+                    print(f"[{path}] failed: {e}", file=sys.stderr, flush=True)
+        else:
+            pool = get_pool(jobs, threads)
+            futures = {pool.submit(run, path, not args.no_cache, threads): path for path in paths}
+            for future, path in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    failures += 1
+                    print(f"[{path}] failed: {e}", file=sys.stderr, flush=True)
+    finally:
+        # Stop the worker processes of get_pool, for jobs and tiled runs alike
+        shutdown_pools()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,465 @@
+"""
+Fast readers for the point files of the app and the pipeline.
+
+Crust and sediment grids arrive as delimited text (CSV, or whitespace
+separated XYZ such as the bundled crsthk.xyz, with or without a
+``long lat thk`` header). read_delimited sniffs the delimiter and the header
+once from the first few kilobytes and then parses the whole file with a
+compiled parser: the multithreaded Arrow CSV reader when pyarrow is installed
+and the delimiter is a single character, pandas' C parser otherwise.
+Whitespace-separated files always use the C parser, which collapses runs of
+blanks natively.
+
+    df = read_delimited("crsthk.xyz", stats=stats)
+    stats['rows'] / stats['seconds']       # parse throughput
+
+NetCDF/GRD and GeoTIFF grids are opened lazily by open_grid: only the
+region of interest, decimated by ``stride``, is ever read from the file, and
+it is returned as a Grid rather than a long DataFrame.
+
+Most inputs are regular lon/lat grids written as XYZ triples; detect_grid
+recognises them so they can be kept as 1-D axes plus a 2-D value array and
+interpolated on the grid instead of being triangulated as scattered points.
+"""
+import contextlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from correction_engine import Grid
+
+# Bytes read to detect the delimiter and the header
+SNIFF_BYTES = 64 * 1024
+
+# Delimiters tried before falling back to runs of whitespace
+DELIMITERS = (",", ";", "\t", "|")
+
+# Column names of a headerless file with three columns
+XYZ_COLUMNS = ['longitude', 'latitude', 'value']
+
+# Magic bytes of the gridded formats
+GRID_MAGIC = ((b"CDF", "netcdf3"), (b"\x89HDF\r\n\x1a\n", "netcdf4"),
+              (b"II*\x00", "geotiff"), (b"MM\x00*", "geotiff"))
+
+# Last line of the header of an ICGEM grid
+ICGEM_END_OF_HEAD = b"end_of_head"
+
+# Header words that mark a text file as an ICGEM grid
+ICGEM_MARKERS = (ICGEM_END_OF_HEAD, b"product_type", b"gravity_field")
+
+# xarray engine that reads each NetCDF flavour from a file object
+FILE_OBJECT_ENGINES = {"netcdf3": "scipy", "netcdf4": "h5netcdf"}
+
+# Block size when a file object has to be spooled to disk
+COPY_BLOCK = 16 * 1024 * 1024
+
+_LON_NAMES = ('lon', 'long', 'longitude', 'x')
+_LAT_NAMES = ('lat', 'latitude', 'y')
+
+_NUMBER = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$|^[+-]?(nan|inf)$", re.IGNORECASE)
+
+
+def _is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+def _head(source, n_bytes):
+    """First bytes of ``source`` (path or binary file object) without consuming it"""
+    if _is_path(source):
+        with open(source, "rb") as f:
+            return f.read(n_bytes)
+    position = source.tell()
+    source.seek(0)
+    head = source.read(n_bytes)
+    source.seek(position)
+    return head
+
+
+def _sample_lines(source):
+    """First lines of ``source`` (path or binary file object) without consuming it"""
+    head = _head(source, SNIFF_BYTES)
+    if isinstance(head, bytes):
+        head = head.decode("utf-8", errors="replace")
+    lines = head.splitlines()
+    if len(head) == SNIFF_BYTES and len(lines) > 1:
+        # The last line may be cut off
+        lines = lines[:-1]
+    return [line for line in lines if line.strip()]
+
+
+def sniff_format(lines):
+    """(delimiter, has_header) of a delimited text file from its first lines.
+
+    The delimiter is the first of DELIMITERS that occurs the same, non-zero
+    number of times on every sampled line, else None for runs of whitespace.
+    The file has a header when a field of its first line is not a number.
+    """
+    if not lines:
+        raise ValueError("The file holds no data")
+    sample = lines[:50]
+    delimiter = None
+    for candidate in DELIMITERS:
+        counts = {line.count(candidate) for line in sample}
+        if len(counts) == 1 and counts.pop() > 0:
+            delimiter = candidate
+            break
+    first = lines[0].split(delimiter) if delimiter else lines[0].split()
+    has_header = any(not _NUMBER.match(field.strip()) for field in first if field.strip())
+    return delimiter, has_header
+
+
+def _source_size(source):
+    """Size in bytes of a path or a seekable file object"""
+    if _is_path(source):
+        return os.path.getsize(source)
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer().nbytes
+    position = source.tell()
+    size = source.seek(0, io.SEEK_END)
+    source.seek(position)
+    return size
+
+
+def _has_module(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def read_delimited(source, stats=None):
+    """DataFrame of a delimited text file (CSV or whitespace-separated XYZ).
+
+    ``source`` is a path or a binary file object such as a Streamlit upload.
+    Headerless files with three columns get the columns of XYZ_COLUMNS.
+    ``stats`` (a dict) receives the delimiter, the parser ('pyarrow' or
+    'c'), the rows, bytes and parse seconds.
+    """
+    t0 = time.time()
+    sample = _sample_lines(source)
+    lines = [line for line in sample if not line.lstrip().startswith("#")]
+    delimiter, has_header = sniff_format(lines)
+    options = {'header': 0 if has_header else None, 'comment': '#', 'skip_blank_lines': True}
+    if delimiter is None:
+        options['sep'] = r"\s+"
+    else:
+        options['sep'] = delimiter
+    # The Arrow reader neither takes comments nor strips blanks around the
+    # fields, so it only gets files whose sample is free of both
+    plain = delimiter is not None and len(lines) == len(sample) and not any(
+        field != field.strip() for line in lines[:50] for field in line.split(delimiter))
+    parser = "pyarrow" if plain and _has_module("pyarrow") else "c"
+    if parser == "pyarrow":
+        del options['comment']
+    elif delimiter is not None:
+        options['skipinitialspace'] = True
+    if not _is_path(source):
+        source.seek(0)
+    df = pd.read_csv(source, engine=parser, **options)
+    if has_header:
+        df.columns = [str(col).strip() for col in df.columns]
+    elif len(df.columns) == len(XYZ_COLUMNS):
+        df.columns = XYZ_COLUMNS
+    else:
+        df.columns = [f"column_{i + 1}" for i in range(len(df.columns))]
+    if stats is not None:
+        stats.update(delimiter="whitespace" if delimiter is None else delimiter, parser=parser,
+                     rows=len(df), bytes=_source_size(source), seconds=time.time() - t0)
+    return df
+
+
+def describe_parse(stats):
+    """One-line summary of the stats of read_delimited"""
+    seconds = max(stats['seconds'], 1e-9)
+    delimiter = {"\t": "tab", ",": "comma", ";": "semicolon", "|": "pipe"}.get(stats['delimiter'],
+                                                                             stats['delimiter'])
+    return (f"{stats['rows']:,} rows in {stats['seconds']:.2f} s ({stats['rows'] / seconds:,.0f} rows/s, "
+            f"{stats['bytes'] / seconds / 1e6:.1f} MB/s; {delimiter}-separated, {stats['parser']} parser)")
+
+
+def point_columns(df, columns=None):
+    """(lon, lat, value) column labels: given names/indices, or detected by name"""
+    if columns is not None:
+        return [df.columns[c] if isinstance(c, int) else c for c in columns]
+    lowered = {str(col).lower(): col for col in df.columns}
+    lon = next((lowered[name] for name in _LON_NAMES if name in lowered), None)
+    lat = next((lowered[name] for name in _LAT_NAMES if name in lowered), None)
+    if lon is None or lat is None:
+        return list(df.columns[:3])
+    values = [col for col in df.columns if col not in (lon, lat) and col not in ('band', 'spatial_ref')]
+    if not values:
+        raise ValueError(f"No value column among {list(df.columns)}")
+    return [lon, lat, values[0]]
+
+
+def detect_grid(df, columns=None, min_coverage=0.9):
+    """(lon, lat, value) column labels and the Grid of a table of XYZ points, or None.
+
+    The columns are found as in point_columns; the table is a grid when its
+    points lie on a regular lattice covering at least ``min_coverage`` of
+    the nodes (see Grid.from_regular_points).
+    """
+    if df is None or len(df.columns) < 3:
+        return None
+    try:
+        labels = point_columns(df, columns)
+    except ValueError:
+        return None
+    lons, lats, values = (pd.to_numeric(df[label], errors='coerce').to_numpy(dtype=np.float64)
+                          for label in labels)
+    grid = Grid.from_regular_points(lons, lats, values, min_coverage=min_coverage)
+    return None if grid is None else (labels, grid)
+
+
+def describe_grid(grid):
+    """One-line summary of a detected grid"""
+    dlon = grid.lons[1] - grid.lons[0]
+    dlat = grid.lats[1] - grid.lats[0]
+    return (f"{grid.shape[0]} × {grid.shape[1]} nodes, {dlon:g}° × {dlat:g}° spacing, "
+            f"{np.isfinite(grid.values).mean():.1%} of the nodes filled")
+
+
+class _NeedsPath(Exception):
+    """The backend of a file object can only read from a path"""
+
+
+def sniff_grid_format(source):
+    """'netcdf3', 'netcdf4', 'geotiff', 'icgem', 'text' or None, from the content of a path or file object.
+
+    The binary formats are recognised by their magic bytes and ICGEM grids
+    by their header words (ICGEM_MARKERS). Any other text, such as a
+    headerless .gdf or .xyz, is 'text' and goes to the delimited reader.
+    """
+    head = _head(source, SNIFF_BYTES)
+    fmt = next((fmt for magic, fmt in GRID_MAGIC if head.startswith(magic)), None)
+    if fmt is not None:
+        return fmt
+    if any(marker in head for marker in ICGEM_MARKERS):
+        return "icgem"
+    if head and b"\x00" not in head:
+        try:
+            head.decode("utf-8")
+        except UnicodeDecodeError:
+            # The sample may end inside a multi-byte character
+            return "text" if len(head) == SNIFF_BYTES else None
+        return "text"
+    return None
+
+
+def _icgem_value(text):
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def read_icgem_gdf(source, info=None):
+    """Grid of an ICGEM .gdf file (path or binary file object).
+
+    The header keywords up to ``end_of_head`` (latlimit_north,
+    longlimit_west, gridstep, nodata, ...) are parsed into a dict, numbers
+    as floats; ``info`` receives it as ``header``. The data block is read
+    in one pass by the C parser (the first three columns are longitude,
+    latitude and value) and scattered into the grid the header describes.
+    Files without a header must hold a regular grid (see
+    Grid.from_regular_points). Nodata values become NaN.
+    """
+    head = _head(source, SNIFF_BYTES)
+    header = {}
+    n_header_lines = 0
+    end = head.find(ICGEM_END_OF_HEAD)
+    if end >= 0:
+        header_text = head[:end].decode("latin-1")
+        n_header_lines = header_text.count("\n") + 1
+        for line in header_text.splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                header[fields[0].lower()] = _icgem_value(fields[1].strip())
+    if not _is_path(source):
+        source.seek(0)
+    data = pd.read_csv(source, sep=r"\s+", header=None, skiprows=n_header_lines, usecols=[0, 1, 2],
+                       engine="c").to_numpy(dtype=np.float64)
+    lons, lats, values = data[:, 0], data[:, 1], data[:, 2]
+    nodata = header.get('nodata', header.get('gapvalue'))
+    if isinstance(nodata, float):
+        values[values == nodata] = np.nan
+    if info is not None:
+        info['header'] = header
+
+    limits = ('latlimit_south', 'latlimit_north', 'longlimit_west', 'longlimit_east', 'gridstep')
+    if all(isinstance(header.get(key), float) for key in limits):
+        south, north, west, east, step = (header[key] for key in limits)
+        nlat = int(header.get('latitude_parallels') or np.rint((north - south) / step) + 1)
+        nlon = int(header.get('longitude_parallels') or np.rint((east - west) / step) + 1)
+        rows = np.rint((lats - south) / step).astype(np.int64)
+        cols = np.rint((lons - west) / step).astype(np.int64)
+        ok = (rows >= 0) & (rows < nlat) & (cols >= 0) & (cols < nlon)
+        grid = np.full((nlat, nlon), np.nan)
+        grid[rows[ok], cols[ok]] = values[ok]
+        return Grid(west + step * np.arange(nlon), south + step * np.arange(nlat), grid)
+    grid = Grid.from_regular_points(lons, lats, values)
+    if grid is None:
+        raise ValueError("The .gdf file has no grid header and its points do not form a regular grid")
+    return grid
+
+
+@contextlib.contextmanager
+def spooled_path(source, suffix=""):
+    """Path of ``source``: the path itself, or a temporary file the file object is streamed into.
+
+    The copy is written in COPY_BLOCK pieces (no second copy of the
+    upload in memory) and deleted on exit.
+    """
+    if _is_path(source):
+        yield source
+        return
+    position = source.tell()
+    source.seek(0)
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(source, f, COPY_BLOCK)
+        source.seek(position)
+        yield path
+    finally:
+        os.remove(path)
+
+
+def _open_raster(source):
+    """(DataArray, opened object) of a NetCDF/GRD or GeoTIFF path or file object, opened lazily.
+
+    The arrays are chunked with dask when it is installed; the second value
+    must be closed once the data has been read. File objects are read in
+    memory; _NeedsPath is raised when no installed backend can do that.
+    """
+    dask = _has_module("dask")
+    fmt = sniff_grid_format(source)
+    if fmt == "geotiff" or (fmt is None and _is_path(source)
+                            and os.path.splitext(str(source))[1].lower() in ('.tif', '.tiff')):
+        import rioxarray
+        if not _is_path(source):
+            source.seek(0)
+        data = rioxarray.open_rasterio(source, chunks=True if dask else None, mask_and_scale=True)
+        return data, data
+    import xarray as xr
+    engine = None
+    if not _is_path(source):
+        engine = FILE_OBJECT_ENGINES.get(fmt)
+        if engine is None or not _has_module(engine):
+            raise _NeedsPath()
+        source.seek(0)
+    ds = xr.open_dataset(source, engine=engine, chunks={} if dask else None)
+    try:
+        lon_dim, lat_dim = _grid_dims(ds)
+        for variable in ds.data_vars.values():
+            if lon_dim in variable.dims and lat_dim in variable.dims:
+                return variable, ds
+        raise ValueError(f"No variable on the {lat_dim}/{lon_dim} grid")
+    except Exception:
+        ds.close()
+        raise
+
+
+def _grid_dims(data):
+    """(lon, lat) dimension names of a Dataset or DataArray"""
+    lowered = {str(dim).lower(): dim for dim in data.dims}
+    lon = next((lowered[name] for name in _LON_NAMES if name in lowered), None)
+    lat = next((lowered[name] for name in _LAT_NAMES if name in lowered), None)
+    if lon is None or lat is None:
+        raise ValueError(f"No longitude/latitude dimensions among {list(data.dims)}")
+    return lon, lat
+
+
+def _window(axis, low, high, stride):
+    """Slice of the nodes of ``axis`` covering [low, high], every ``stride``-th.
+
+    One node on either side of the interval is included, so interpolation
+    reaches the bounds.
+    """
+    inside = np.flatnonzero((axis >= min(low, high)) & (axis <= max(low, high)))
+    if len(inside) == 0:
+        raise ValueError(f"The region [{low}, {high}] lies outside the grid ({axis.min()} to {axis.max()})")
+    first = max(int(inside[0]) - int(stride), 0)
+    last = min(int(inside[-1]) + int(stride), len(axis) - 1)
+    return slice(first, last + 1, int(stride))
+
+
+def open_grid(source, bounds=None, stride=1, info=None):
+    """Grid of a region of a NetCDF/GRD, GeoTIFF or ICGEM .gdf file, reading only that region.
+
+    ``source`` is a path or a binary file object such as a Streamlit upload,
+    which is read in memory where the backend allows it (NetCDF3 with
+    scipy, NetCDF4 with h5netcdf, GeoTIFF with rasterio) and spooled to a
+    temporary file otherwise. ``bounds`` is (lon_min, lon_max, lat_min,
+    lat_max), by default the whole file, and ``stride`` keeps every
+    ``stride``-th node along both axes. Other dimensions (band, time, ...)
+    are reduced to their first entry. The file is opened lazily, the window
+    is selected by index and only then read, so a global ETOPO file costs no
+    more than the window. ``info`` (a dict) receives the extent (lon_min,
+    lon_max, lat_min, lat_max) and shape of the whole file. The format is
+    sniffed from the content (sniff_grid_format); ICGEM grids are read
+    whole with read_icgem_gdf, other text grids (e.g. a headerless .gdf)
+    with read_delimited and detect_grid, and then cut to the window.
+    """
+    fmt = sniff_grid_format(source)
+    if fmt in ("icgem", "text"):
+        if fmt == "icgem":
+            grid = read_icgem_gdf(source, info)
+        else:
+            detected = detect_grid(read_delimited(source))
+            if detected is None:
+                raise ValueError("The points of the file do not form a regular lon/lat grid")
+            grid = detected[1]
+        if info is not None:
+            info.update(extent=(float(grid.lons[0]), float(grid.lons[-1]), float(grid.lats[0]), float(grid.lats[-1])),
+                        shape=grid.shape)
+        bounds = bounds or (grid.lons[0], grid.lons[-1], grid.lats[0], grid.lats[-1])
+        rows = _window(grid.lats, bounds[2], bounds[3], stride)
+        cols = _window(grid.lons, bounds[0], bounds[1], stride)
+        return Grid(grid.lons[cols], grid.lats[rows], np.ascontiguousarray(grid.values[rows, cols]))
+    try:
+        return _read_window(source, bounds, stride, info)
+    except _NeedsPath:
+        # Keep the extension: some GDAL/netCDF backends dispatch on it
+        suffix = os.path.splitext(str(getattr(source, 'name', '')))[1]
+        with spooled_path(source, suffix) as path:
+            return _read_window(path, bounds, stride, info)
+
+
+def _read_window(source, bounds, stride, info):
+    data, opened = _open_raster(source)
+    try:
+        lon_dim, lat_dim = _grid_dims(data)
+        data = data.isel({dim: 0 for dim in data.dims if dim not in (lon_dim, lat_dim)})
+        lons, lats = data[lon_dim].values, data[lat_dim].values
+        if info is not None:
+            info.update(extent=(float(lons.min()), float(lons.max()), float(lats.min()), float(lats.max())),
+                        shape=(len(lats), len(lons)))
+        if bounds is None:
+            bounds = (lons.min(), lons.max(), lats.min(), lats.max())
+        window = {lon_dim: _window(lons, bounds[0], bounds[1], stride),
+                  lat_dim: _window(lats, bounds[2], bounds[3], stride)}
+        data = data.isel(window).transpose(lat_dim, lon_dim)
+        values = np.asarray(data.values, dtype=np.float64)
+        lons, lats = data[lon_dim].values.astype(np.float64), data[lat_dim].values.astype(np.float64)
+    finally:
+        opened.close()
+    # Grids are kept with ascending axes
+    if len(lons) > 1 and lons[1] < lons[0]:
+        lons, values = lons[::-1], values[:, ::-1]
+    if len(lats) > 1 and lats[1] < lats[0]:
+        lats, values = lats[::-1], values[::-1]
+    return Grid(lons, lats, np.ascontiguousarray(values))
+
+
+def grid_to_frame(grid):
+    """Long DataFrame (longitude, latitude, value) of a Grid"""
+    XI, YI = np.meshgrid(grid.lons, grid.lats)
+    return pd.DataFrame({'longitude': XI.ravel(), 'latitude': YI.ravel(), 'value': grid.values.ravel()})
@@ -1,5 +1,4 @@
 import streamlit as st
-import tempfile
 import pandas as pd
 import numpy as np 
 import matplotlib.pyplot as plt
@@ -13,13 +12,20 @@ import os
 import requests
 import io
 import zipfile
-import tempfile
 import urllib.request
 from datetime import datetime
-import xarray as xr
 import math
 import time
-from numba import jit, prange
+import atexit
+import threading
+from tesseroid_engine import ENGINE_METHODS, PRECISIONS, combine_unit_potentials, warmup_kernels
+from tile_runner import TILED_METHODS, default_layout, shutdown_pools
+from result_cache import ResultCache
+from correction_engine import (CLASS_LABELS, CorrectionParameters, EngineSettings, Grid, compute_correction,
+                               correction_number, estimate_correction)
+from cost_model import ResourceLimits, ThroughputModel
+from job_runner import JobManager
+from grid_io import describe_grid, describe_parse, detect_grid, grid_to_frame, open_grid, read_delimited
 
 # ==============================
 # App Configuration & Header
@@ -43,6 +49,40 @@ if 'df_topo' not in st.session_state:
     st.session_state.df_topo = None
 if 'df_geoid' not in st.session_state:
     st.session_state.df_geoid = None
+# Uploads that are regular lon/lat grids: dataset -> ((lon, lat, value) columns, Grid)
+if 'regular_grids' not in st.session_state:
+    st.session_state.regular_grids = {}
+
+# Compile the tesseroid kernels once per server process, in a background
+# thread so the first page renders at once; a correction started before it
+# finishes compiles what it needs itself (set GEOID_KERNEL_WARMUP=0 to skip)
+@st.cache_resource
+def warm_up_correction_kernels():
+    thread = threading.Thread(target=warmup_kernels, name="kernel-warmup", daemon=True)
+    thread.start()
+    return thread
+
+if os.environ.get("GEOID_KERNEL_WARMUP", "1") != "0":
+    warm_up_correction_kernels()
+
+# Worker pools of the process-pool executor are reused between runs; stop
+# them when the server exits (registered once per server process)
+@st.cache_resource
+def stop_worker_pools_at_exit():
+    atexit.register(shutdown_pools)
+
+stop_worker_pools_at_exit()
+
+# Corrections run as background jobs shared by every session of this server
+# (GEOID_JOB_WORKERS jobs at a time)
+@st.cache_resource
+def get_job_manager():
+    return JobManager(max_workers=int(os.environ.get("GEOID_JOB_WORKERS", "1")))
+
+# Reruns only the decorated status panel every second, where Streamlit supports it
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+def polling_fragment(func):
+    return _fragment(run_every=1.0)(func) if _fragment else func
 
 # ==============================
 # SIDEBAR NAVIGATION (Petrel-like interface)
@@ -96,6 +136,9 @@ with st.sidebar:
     
     st.metric("Interpolated Sets", len(st.session_state.interpolated_data))
     st.metric("Corrections", len(st.session_state.geoid_correction_results))
+    running_jobs = [job for job in get_job_manager().jobs() if job.active]
+    if running_jobs:
+        st.caption(f"⚙️ {len(running_jobs)} correction job(s) running in the background")
 
 # ==============================
 # HELP PAGE
@@ -763,7 +806,7 @@ elif st.session_state.current_section == "Data Upload":
     with col3:
         st.subheader("3. Topographic Data")
         uploaded_topo = st.file_uploader("Upload topographic data (CSV/GeoTIFF/NetCDF)", 
-                                        type=['csv', 'nc', 'grd'], 
+                                        type=['csv', 'nc', 'grd', 'tif', 'tiff'], 
                                         key="topo")
 
     with col4:
@@ -772,93 +815,64 @@ elif st.session_state.current_section == "Data Upload":
                                          type=['csv', 'nc', 'grd', 'gdf'], 
                                          key="geoid")
 
+    # Region of interest of gridded files: only this window is read from NetCDF/GeoTIFF
+    with st.expander("🗺️ Region of Interest for NetCDF/GeoTIFF Grids"):
+        st.caption("Large grids such as ETOPO are opened lazily and only the window below, "
+                   "decimated by the stride, is read from the file")
+        use_roi = st.checkbox("Read only a region", value=False, key="roi_enabled")
+        col_roi1, col_roi2, col_roi3, col_roi4, col_roi5 = st.columns(5)
+        with col_roi1:
+            roi_lon_min = st.number_input("Longitude Min", -360.0, 360.0, -180.0, 0.5, key="roi_lon_min",
+                                          disabled=not use_roi)
+        with col_roi2:
+            roi_lon_max = st.number_input("Longitude Max", -360.0, 360.0, 180.0, 0.5, key="roi_lon_max",
+                                          disabled=not use_roi)
+        with col_roi3:
+            roi_lat_min = st.number_input("Latitude Min", -90.0, 90.0, -90.0, 0.5, key="roi_lat_min",
+                                          disabled=not use_roi)
+        with col_roi4:
+            roi_lat_max = st.number_input("Latitude Max", -90.0, 90.0, 90.0, 0.5, key="roi_lat_max",
+                                          disabled=not use_roi)
+        with col_roi5:
+            roi_stride = st.number_input("Stride", min_value=1, max_value=100, value=1, step=1,
+                                         help="Keep every n-th node along both axes", key="roi_stride")
+        roi_bounds = (roi_lon_min, roi_lon_max, roi_lat_min, roi_lat_max) if use_roi else None
+
     # File reading function (same as original)
-    def read_geospatial_file(uploaded_file):
-        """Read various geospatial formats and return a DataFrame with lon, lat, value"""
-        
+    def read_geospatial_file(uploaded_file, bounds=None, stride=1):
+        """Read various geospatial formats and return (DataFrame with lon, lat, value, Grid or None).
+
+        NetCDF/GRD and GeoTIFF files are read lazily: only the ``bounds``
+        window, every ``stride``-th node, is loaded and also returned as a Grid.
+        ICGEM .gdf grids are read natively (header keywords plus one pass over
+        the data block). Uploads are parsed from the upload buffer; a temporary
+        file is only written (streamed) for backends that need a path.
+        """
+        grid = None
 
         # [Keep the same implementation as original...]
-        tmp_path = None
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_path = tmp_file.name
-            
             file_ext = os.path.splitext(uploaded_file.name)[1].lower()
             
             if file_ext in ['.csv']:
-                df = pd.read_csv(tmp_path, sep=None, engine='python', skipinitialspace=True)
-                df.columns = df.columns.str.strip()
+                df = read_delimited(uploaded_file)
                 
-            elif file_ext in ['.tif', '.tiff']:
-                # [Keep TIFF reading implementation...]
-                try:
-                    import rioxarray
-                    ds = rioxarray.open_rasterio(tmp_path)
-                    df = ds.squeeze().to_dataframe(name='value').reset_index()
-                    
-                    if 'x' in df.columns and 'y' in df.columns:
-                        df = df.rename(columns={'x': 'longitude', 'y': 'latitude'})
-                    elif 'lon' in df.columns and 'lat' in df.columns:
-                        df = df.rename(columns={'lon': 'longitude', 'lat': 'latitude'})
-                        
-                except ImportError:
-                    # [Fallback implementation...]
-                    pass
-                    
-            elif file_ext in ['.nc', '.grd', '.gdf']:
-                # [Keep NetCDF reading implementation...]
-                try:
-                    engines_to_try = ['netcdf4', 'scipy']
-                    df = None
-                    
-                    for engine in engines_to_try:
-                        try:
-                            with xr.open_dataset(tmp_path, engine=engine) as ds:
-                                df = ds.to_dataframe().reset_index()
-                            break
-                        except Exception as e:
-                            continue
-                    
-                    if df is None:
-                        try:
-                            with xr.open_dataset(tmp_path) as ds:
-                                df = ds.to_dataframe().reset_index()
-                        except Exception as e:
-                            if file_ext == '.gdf':
-                                try:
-                                    df = pd.read_csv(tmp_path, delim_whitespace=True, header=None, 
-                                                   names=['longitude', 'latitude', 'value'])
-                                except:
-                                    return None
-                            else:
-                                return None
-                    
-                    if df is not None:
-                        coord_cols = [col for col in df.columns if col.lower() in ['x', 'y', 'lon', 'long', 'longitude', 'lat', 'latitude']]
-                        value_cols = [col for col in df.columns if col not in coord_cols and col != 'band' and col != 'spatial_ref']
-                        
-                        if len(coord_cols) >= 2 and len(value_cols) >= 1:
-                            df = df[coord_cols[:2] + value_cols[:1]]
-                            rename_dict = {}
-                            for col in coord_cols[:2]:
-                                col_lower = col.lower()
-                                if any(x in col_lower for x in ['x', 'lon', 'long']):
-                                    rename_dict[col] = 'longitude'
-                                elif any(x in col_lower for x in ['y', 'lat']):
-                                    rename_dict[col] = 'latitude'
-                            
-                            for col in value_cols[:1]:
-                                rename_dict[col] = 'value'
-                            
-                            df = df.rename(columns=rename_dict)
-                        
-                except Exception as e:
-                    return None
-                    
+            elif file_ext in ['.tif', '.tiff', '.nc', '.grd', '.gdf']:
+                file_info = {}
+                grid = open_grid(uploaded_file, bounds=bounds, stride=stride, info=file_info)
+                df = grid_to_frame(grid)
+                extent = file_info['extent']
+                st.caption(f"File grid: {file_info['shape'][0]} × {file_info['shape'][1]} nodes over lon "
+                           f"{extent[0]:g}° to {extent[1]:g}°, lat {extent[2]:g}° to {extent[3]:g}°; "
+                           f"read {grid.shape[0]} × {grid.shape[1]} nodes")
+                if file_info.get('header', {}).get('modelname'):
+                    header = file_info['header']
+                    st.caption(f"ICGEM grid: {header['modelname']}, {header.get('functional', 'unknown functional')}"
+                               f" ({header.get('unit', 'unknown unit')})")
+
             else:
                 st.error(f"Unsupported file format: {file_ext}")
-                return None
+                return None, None
                 
             required_cols = ['longitude', 'latitude', 'value']
             if not all(col in df.columns for col in required_cols):
@@ -873,52 +887,49 @@ elif st.session_state.current_section == "Data Upload":
                     df = df.rename(columns=col_mapping)
                 else:
                     st.warning(f"Could not automatically identify required columns. Found: {list(df.columns)}")
-                    return df
+                    return df, grid
             
-            return df
+            return df, grid
             
         except Exception as e:
             st.error(f"Error processing file: {e}")
-            return None
-        finally:
-            if tmp_path and os.path.exists(tmp_path):
-                try:
-                    os.unlink(tmp_path)
-                except Exception as e:
-                    pass
+            return None, None
+
+    def register_grid(dataset, df, grid=None):
+        """Keep the axes and 2-D values of an upload that is (or was read as) a regular grid"""
+        detected = (['longitude', 'latitude', 'value'], grid) if grid is not None else detect_grid(df)
+        if detected is None:
+            st.session_state.regular_grids.pop(dataset, None)
+        else:
+            st.session_state.regular_grids[dataset] = detected
+            st.caption(f"🧮 Regular grid detected: {describe_grid(detected[1])}")
 
     # Process uploaded files
     if uploaded_crust is not None:
-        st.session_state.df_crust = pd.read_csv(
-            uploaded_crust, 
-            sep=None,
-            engine='python',
-            skipinitialspace=True,
-            skip_blank_lines=True
-        )
-        st.session_state.df_crust.columns = st.session_state.df_crust.columns.str.strip()
+        parse_stats = {}
+        st.session_state.df_crust = read_delimited(uploaded_crust, stats=parse_stats)
         st.success(f"✅ Crustal thickness CSV loaded successfully! Found {len(st.session_state.df_crust.columns)} columns.")
+        st.caption(f"Parsed {describe_parse(parse_stats)}")
+        register_grid("Crustal thickness", st.session_state.df_crust)
 
     if uploaded_sed is not None:
-        st.session_state.df_sed = pd.read_csv(
-            uploaded_sed,
-            sep=None,
-            engine='python',
-            skipinitialspace=True,
-            skip_blank_lines=True
-        )
-        st.session_state.df_sed.columns = st.session_state.df_sed.columns.str.strip()
+        parse_stats = {}
+        st.session_state.df_sed = read_delimited(uploaded_sed, stats=parse_stats)
         st.success(f"✅ Sedimentary thickness CSV loaded successfully! Found {len(st.session_state.df_sed.columns)} columns.")
+        st.caption(f"Parsed {describe_parse(parse_stats)}")
+        register_grid("Sedimentary thickness", st.session_state.df_sed)
 
     if uploaded_topo is not None:
-        st.session_state.df_topo = read_geospatial_file(uploaded_topo)
+        st.session_state.df_topo, topo_grid = read_geospatial_file(uploaded_topo, roi_bounds, roi_stride)
         if st.session_state.df_topo is not None:
             st.success(f"✅ Topographic data loaded successfully! Found {len(st.session_state.df_topo.columns)} columns.")
+            register_grid("Topographic thickness", st.session_state.df_topo, topo_grid)
 
     if uploaded_geoid is not None:
-        st.session_state.df_geoid = read_geospatial_file(uploaded_geoid)
+        st.session_state.df_geoid, geoid_grid = read_geospatial_file(uploaded_geoid, roi_bounds, roi_stride)
         if st.session_state.df_geoid is not None:
             st.success(f"✅ Geoid data loaded successfully! Found {len(st.session_state.df_geoid.columns)} columns.")
+            register_grid("Geoid data", st.session_state.df_geoid, geoid_grid)
 
     # Show data previews
     if any([st.session_state.df_crust is not None, st.session_state.df_sed is not None, 
@@ -2301,9 +2312,13 @@ elif st.session_state.current_section == "Data Visualization":
                         yi = np.linspace(lat_min, lat_max, ny)
                         XI, YI = np.meshgrid(xi, yi)
 
-                        # Interpolate
+                        # Interpolate: on the grid itself when the upload is a regular grid
                         method = interp_method.lower()
-                        if method == "rbf":
+                        regular = st.session_state.regular_grids.get(option)
+                        if regular is not None and method != "rbf" and \
+                                list(regular[0]) == [lon_col_label, lat_col_label, val_col_label]:
+                            ZI = regular[1].interpolate(xi, yi, method)
+                        elif method == "rbf":
                             from scipy.interpolate import Rbf
                             rbf = Rbf(lons, lats, vals, function='multiquadric')
                             ZI = rbf(XI, YI)
@@ -2804,12 +2819,6 @@ elif st.session_state.current_section == "Geoid Corrections":
         else:
             st.success("✅ All required datasets selected!")
             
-            # Physical constants
-            G = 6.67430e-11
-            a_ell = 6378137.0
-            b_ell = 6356752.314245
-            e2 = 1.0 - (b_ell / a_ell) ** 2
-            
             # Physical parameters expander
             st.markdown("#### 🔧 Physical Parameters")
             
@@ -2864,13 +2873,16 @@ elif st.session_state.current_section == "Geoid Corrections":
                         )
                     
                     with col_topo5:
+                        auto_batch_topo = st.checkbox("Auto batch size", value=True, key="auto_batch_topo",
+                                                      help="Calibrate the batch size on a sample of the observations")
                         batch_size_topo = st.number_input(
                             "Batch Size",
                             min_value=1000,
                             max_value=10000,
                             value=5000,
                             step=1000,
-                            help="Number of observations per batch"
+                            help="Number of observations per batch",
+                            disabled=auto_batch_topo
                         )
             
             # CRUSTAL CORRECTION PARAMETERS
@@ -2935,6 +2947,8 @@ elif st.session_state.current_section == "Geoid Corrections":
                         )
                     
                     with col_crust6:
+                        auto_batch_crust = st.checkbox("Auto batch size", value=True, key="auto_batch_crust",
+                                                       help="Calibrate the batch size on a sample of the observations")
                         batch_size_crust = st.number_input(
                             "Batch Size",
                             min_value=1000,
@@ -2942,7 +2956,8 @@ elif st.session_state.current_section == "Geoid Corrections":
                             value=5000,
                             step=1000,
                             help="Number of observations per batch",
-                            key="batch_crust"
+                            key="batch_crust",
+                            disabled=auto_batch_crust
                         )
             
             # SEDIMENTARY CORRECTION PARAMETERS
@@ -2987,6 +3002,8 @@ elif st.session_state.current_section == "Geoid Corrections":
                         )
                     
                     with col_sed4:
+                        auto_batch_sed = st.checkbox("Auto batch size", value=True, key="auto_batch_sed",
+                                                     help="Calibrate the batch size on a sample of the observations")
                         batch_size_sed = st.number_input(
                             "Batch Size",
                             min_value=1000,
@@ -2994,89 +3011,152 @@ elif st.session_state.current_section == "Geoid Corrections":
                             value=4000,
                             step=1000,
                             help="Number of observations per batch",
-                            key="batch_sed"
+                            key="batch_sed",
+                            disabled=auto_batch_sed
                         )
             
-            # ==============================
-            # HELPER FUNCTIONS
-            # ==============================
-            
-            def ellipsoidal_radius(lat_rad):
-                """Compute ellipsoidal radius at given latitude"""
-                sin_lat = np.sin(lat_rad)
-                return a_ell * np.sqrt(1 - e2) / np.sqrt(1 - e2 * sin_lat * sin_lat)
-            
-            def somigliana_gamma(lat_rad):
-                """Compute normal gravity using Somigliana's formula"""
-                gamma_e = 9.7803253359
-                k = 0.00193185265241
-                s2 = np.sin(lat_rad) ** 2
-                return gamma_e * (1 + k * s2) / np.sqrt(1 - e2 * s2)
+            # ENGINE SETTINGS
+            with st.expander("⚙️ Engine Settings"):
+                engine_method = st.selectbox(
+                    "Potential kernel",
+                    options=list(ENGINE_METHODS.keys()),
+                    format_func=lambda m: ENGINE_METHODS[m],
+                    index=list(ENGINE_METHODS.keys()).index("indexed"),
+                    help="Direct, trig and indexed give the same result; the table-driven kernels avoid recomputing sin/cos for every observation-source pair and the spatial index only visits sources inside the angular cutoff. Regular and tree approximate the far field (tree within its multipole tolerance)",
+                    key="engine_method"
+                )
+                fuse_passes = False
+                if engine_method == "indexed" and correction_type in ["4. Combined Correction (All Three)", "5. Residual Geoid (Original - All Corrections)"]:
+                    fuse_passes = st.checkbox(
+                        "Fused single pass for topography, crust and sediments",
+                        value=True,
+                        help="Evaluate all density classes (rock, water, Moho, sediments) in one sweep over the observations, sharing the observation geometry",
+                        key="engine_fuse_passes"
+                    )
+                # Method-specific options passed to compute_potential
+                engine_options = {}
+                if engine_method == "regular":
+                    engine_options['near_cells'] = st.number_input(
+                        "Exact near-field radius (cells)",
+                        min_value=0,
+                        max_value=20,
+                        value=2,
+                        step=1,
+                        help="Sources within this many rows/columns of an observation use the exact kernel; farther sources use the longitude convolution with one reference radius per row",
+                        key="engine_near_cells"
+                    )
+                elif engine_method == "tree":
+                    engine_options['tolerance'] = st.select_slider(
+                        "Far-field tolerance",
+                        options=[1e-2, 3e-3, 1e-3, 3e-4, 1e-4],
+                        value=1e-3,
+                        format_func=lambda v: f"{v:g}",
+                        help="A block of sources is replaced by its multipole expansion when (block radius / distance)³ is below this value; smaller is more accurate and slower. Near-field cells always use the exact kernel",
+                        key="engine_tree_tolerance"
+                    )
+                # Adaptive subdivision of tesseroids close to the observation
+                refine_options = {}
+                if engine_method != "direct" and st.checkbox(
+                    "Adaptive near-field subdivision",
+                    value=False,
+                    help="Tesseroids closer to an observation than the ratio below times their largest dimension are split recursively instead of being evaluated as a single kernel; the rest of the grid is unchanged",
+                    key="engine_refine"
+                ):
+                    col_ref1, col_ref2 = st.columns(2)
+                    with col_ref1:
+                        split_ratio = st.number_input(
+                            "Distance/size ratio",
+                            min_value=0.5,
+                            max_value=8.0,
+                            value=4.0,
+                            step=0.5,
+                            help="Larger values split more tesseroids: more accurate and slower",
+                            key="engine_split_ratio"
+                        )
+                    with col_ref2:
+                        max_depth = st.number_input(
+                            "Maximum subdivision depth",
+                            min_value=1,
+                            max_value=8,
+                            value=4,
+                            step=1,
+                            help="Each level splits the tesseroid into eight pieces by halving all three dimensions",
+                            key="engine_max_depth"
+                        )
+                    refine_options = {'split_ratio': float(split_ratio), 'max_depth': int(max_depth)}
+                # Where the kernels run: Numba threads in this process or a pool of worker processes
+                pool_layout = None
+                if engine_method in TILED_METHODS and st.radio(
+                    "Executor",
+                    options=["threads", "processes"],
+                    format_func=lambda e: {"threads": "Numba threads in the app process",
+                                           "processes": "Process pool with shared-memory tiles"}[e],
+                    help="The process pool splits the observations into tiles evaluated by separate worker processes (e.g. one per socket) that map the same source arrays; the app stays responsive while they run",
+                    key="engine_executor"
+                ) == "processes":
+                    default_workers, default_threads = default_layout()
+                    col_pool1, col_pool2 = st.columns(2)
+                    with col_pool1:
+                        n_workers = st.number_input(
+                            "Worker processes",
+                            min_value=1,
+                            max_value=256,
+                            value=default_workers,
+                            step=1,
+                            key="engine_n_workers"
+                        )
+                    with col_pool2:
+                        threads_per_worker = st.number_input(
+                            "Threads per worker",
+                            min_value=1,
+                            max_value=256,
+                            value=default_threads,
+                            step=1,
+                            key="engine_threads_per_worker"
+                        )
+                    pool_layout = {'n_workers': int(n_workers), 'threads_per_worker': int(threads_per_worker)}
+                precision = "float64"
+                if engine_method not in ("direct", "regular"):
+                    precision = st.radio(
+                        "Precision",
+                        options=list(PRECISIONS.keys()),
+                        format_func=lambda p: PRECISIONS[p],
+                        help="Mixed precision stores the per-source coefficients in float32 for quick-look runs (geometry stays float64); each pass is then checked against a float64 run on a sample of the observations and the maximum and RMS difference are shown in the log",
+                        key="engine_precision"
+                    )
+                use_checkpoints = engine_method != "regular" and st.checkbox(
+                    "Checkpoint finished batches to disk",
+                    value=True,
+                    help="Every finished batch is saved under a digest of the inputs and settings; if the page reloads or the server restarts mid-run, the same run resumes from the saved batches",
+                    key="engine_checkpoints"
+                )
             
-            # Define Numba JIT kernels
-            @jit(nopython=True)
-            def tesseroid_potential_contrib(lat_obs, lon_obs, r_obs, lat_t, lon_t, r1, r2, rho, dlat, dlon):
-                """Single tesseroid potential contribution (Heck & Seitz series expansion)"""
-                cos_psi = (math.sin(lat_obs) * math.sin(lat_t) + 
-                          math.cos(lat_obs) * math.cos(lat_t) * math.cos(lon_obs - lon_t))
-                if cos_psi > 1.0:
-                    cos_psi = 1.0
-                elif cos_psi < -1.0:
-                    cos_psi = -1.0
-                psi = math.acos(cos_psi)
-                r_t = 0.5 * (r1 + r2)
-                l0_sq = r_obs * r_obs + r_t * r_t - 2.0 * r_obs * r_t * cos_psi
-                if l0_sq <= 0.0:
-                    return 0.0
-                l0 = math.sqrt(l0_sq)
-                if l0 < 1e-12:
-                    l0 = 1e-12
-                K000 = 1.0 / l0
-                K200 = (3.0 * (r_obs - r_t * cos_psi) ** 2 - l0_sq) / (l0_sq ** 2.5)
-                sin_psi = math.sin(psi)
-                if sin_psi > 1e-12:
-                    K020 = (3.0 * (r_t * psi) ** 2 - l0_sq) / (l0_sq ** 2.5)
-                    K002 = (3.0 * (r_t * sin_psi) ** 2 - l0_sq) / (l0_sq ** 2.5)
-                else:
-                    K020 = 0.0
-                    K002 = 0.0
-                dr = r2 - r1
-                K = K000 + (dr * dr / 24.0) * K200 + (dlat * dlat / 24.0) * K020 + (dlon * dlon / 24.0) * K002
-                cos_lat_t = math.cos(lat_t)
-                if cos_lat_t < 0.0:
-                    cos_lat_t = 0.0
-                dV = r_t * r_t * cos_lat_t * dr * dlat * dlon
-                return G * rho * dV * K
+            # RESULT CACHE
+            result_cache = ResultCache()
+            with st.expander("🗄️ Result Cache"):
+                use_result_cache = st.checkbox(
+                    "Reuse cached results",
+                    value=True,
+                    help="Results are stored on the server under a digest of the input grids, the correction type and every physical and engine parameter; an identical run from any session loads them from disk instead of recomputing",
+                    key="use_result_cache"
+                )
+                cache_entries = result_cache.entries()
+                col_cache1, col_cache2 = st.columns(2)
+                with col_cache1:
+                    st.metric("Cached entries", len(cache_entries))
+                with col_cache2:
+                    st.metric("Disk usage", f"{sum(e['size'] for e in cache_entries) / 1024**2:.1f} / {result_cache.max_bytes / 1024**2:.0f} MB")
+                if cache_entries:
+                    st.dataframe(pd.DataFrame({
+                        'Entry': [e['label'] or e['key'][:12] for e in cache_entries],
+                        'Size (MB)': [round(e['size'] / 1024**2, 2) for e in cache_entries],
+                        'Created': [datetime.fromtimestamp(e['created']).strftime('%Y-%m-%d %H:%M') for e in cache_entries],
+                        'Last used': [datetime.fromtimestamp(e['last_used']).strftime('%Y-%m-%d %H:%M') for e in cache_entries],
+                    }), use_container_width=True)
+                    if st.button("🗑️ Clear result cache", key="clear_result_cache"):
+                        result_cache.clear()
+                        st.success("Result cache cleared")
             
-            @jit(nopython=True, parallel=True)
-            def compute_potential_batch(obs_lats_rad, obs_lons_rad, obs_radii,
-                                       src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho,
-                                       dlat, dlon, cos_cutoff, results):
-                """Compute potential for a batch of observations"""
-                n_obs = len(obs_lats_rad)
-                n_src = len(src_lats_rad)
-                for ii in prange(n_obs):
-                    ro = obs_radii[ii]
-                    if np.isnan(ro):
-                        results[ii] = np.nan
-                        continue
-                    lat_o = obs_lats_rad[ii]
-                    lon_o = obs_lons_rad[ii]
-                    pot_sum = 0.0
-                    for ss in range(n_src):
-                        r1 = src_r1[ss]
-                        r2 = src_r2[ss]
-                        rho = src_rho[ss]
-                        if np.isnan(r1) or np.isnan(r2):
-                            continue
-                        cos_psi = (math.sin(lat_o) * math.sin(src_lats_rad[ss]) +
-                                  math.cos(lat_o) * math.cos(src_lats_rad[ss]) * math.cos(lon_o - src_lons_rad[ss]))
-                        if cos_psi < cos_cutoff:
-                            continue
-                        pot_sum += tesseroid_potential_contrib(lat_o, lon_o, ro, src_lats_rad[ss], src_lons_rad[ss], 
-                                                              r1, r2, rho, dlat, dlon)
-                    results[ii] = pot_sum
-
             # ==============================
             # PLOTTING SETTINGS SECTION
             # ==============================
@@ -3216,417 +3296,168 @@ elif st.session_state.current_section == "Geoid Corrections":
             # ==============================
             # COMPUTATION BUTTON
             # ==============================
-            if st.button("🚀 Compute Selected Correction", type="primary"):
-                with st.spinner(f"Computing {correction_type}..."):
-                    try:
-                        # Extract grid from selected geoid dataset
-                        geoid_data = stored_datasets[selected_geoid]
-                        lons = np.unique(geoid_data['XI'])
-                        lats = np.unique(geoid_data['YI'])
-                        nlons, nlats = len(lons), len(lats)
-                        dx_deg = lons[1] - lons[0]
-                        
-                        grid_lons, grid_lats = np.meshgrid(lons, lats)
-                        geoid_grid = geoid_data['ZI']
-                        
-                        st.info(f"📐 Using grid from selected dataset: {nlats}×{nlons} = {nlats*nlons} cells, resolution = {dx_deg:.4f}°")
-                        
-                        # Get topography if needed
-                        elev_grid = None
-                        if selected_topo:
-                            topo_data = stored_datasets[selected_topo]
-                            # Resample to geoid grid
-                            elev_grid = griddata(
-                                (topo_data['XI'].flatten(), topo_data['YI'].flatten()),
-                                topo_data['ZI'].flatten(),
-                                (grid_lons, grid_lats),
-                                method='linear'
-                            )
-                            mask = np.isnan(elev_grid)
-                            if mask.any():
-                                elev_grid[mask] = griddata(
-                                    (topo_data['XI'].flatten(), topo_data['YI'].flatten()),
-                                    topo_data['ZI'].flatten(),
-                                    (grid_lons, grid_lats),
-                                    method='nearest'
-                                )[mask]
-                        
-                        # Get crustal thickness if needed
-                        crustal_grid = None
-                        if selected_crust:
-                            crust_data = stored_datasets[selected_crust]
-                            crustal_grid = griddata(
-                                (crust_data['XI'].flatten(), crust_data['YI'].flatten()),
-                                crust_data['ZI'].flatten(),
-                                (grid_lons, grid_lats),
-                                method='linear'
-                            )
-                            mask = np.isnan(crustal_grid)
-                            if mask.any():
-                                crustal_grid[mask] = griddata(
-                                    (crust_data['XI'].flatten(), crust_data['YI'].flatten()),
-                                    crust_data['ZI'].flatten(),
-                                    (grid_lons, grid_lats),
-                                    method='nearest'
-                                )[mask]
-                            # Convert to meters if in km
-                            if np.nanmax(np.abs(crustal_grid)) < 100:
-                                crustal_grid = crustal_grid * 1000.0
-                                st.info("📏 Converted crustal thickness from km to meters")
-                        
-                        # Get sedimentary thickness if needed
-                        sedimentary_grid = None
-                        if selected_sed:
-                            sed_data = stored_datasets[selected_sed]
-                            sedimentary_grid = griddata(
-                                (sed_data['XI'].flatten(), sed_data['YI'].flatten()),
-                                sed_data['ZI'].flatten(),
-                                (grid_lons, grid_lats),
-                                method='linear'
-                            )
-                            mask = np.isnan(sedimentary_grid)
-                            if mask.any():
-                                sedimentary_grid[mask] = griddata(
-                                    (sed_data['XI'].flatten(), sed_data['YI'].flatten()),
-                                    sed_data['ZI'].flatten(),
-                                    (grid_lons, grid_lats),
-                                    method='nearest'
-                                )[mask]
-                            # Convert to meters if in km
-                            if np.nanmax(np.abs(sedimentary_grid)) < 50:
-                                sedimentary_grid = sedimentary_grid * 1000.0
-                                st.info("📏 Converted sedimentary thickness from km to meters")
-                        
-                        # Prepare observation geometry
-                        lats_rad = np.radians(lats)
-                        ell_radii = np.array([ellipsoidal_radius(lat) for lat in lats_rad])
-                        gamma_vals = np.array([somigliana_gamma(lat) for lat in lats_rad])
-                        gamma_grid = gamma_vals[:, np.newaxis]
-                        
-                        # Safe grids for radius computation
-                        geoid_safe = np.where(np.isfinite(geoid_grid), geoid_grid, 0.0)
-                        elev_safe = np.where(np.isfinite(elev_grid), elev_grid, 0.0) if elev_grid is not None else np.zeros_like(geoid_grid)
-                        
-                        # Observation radius (at geoid surface)
-                        r_obs_grid = ell_radii[:, np.newaxis] + elev_safe + geoid_safe
-                        valid_obs_mask = np.isfinite(geoid_grid)
-                        if elev_grid is not None:
-                            valid_obs_mask &= np.isfinite(elev_grid)
-                        
-                        # Initialize results
-                        results = {
-                            'original_geoid': geoid_grid,
-                            'lons': lons,
-                            'lats': lats,
-                            'grid_lons': grid_lons,
-                            'grid_lats': grid_lats
-                        }
-                        
-                        correction_num = correction_type.split(".")[0]
-                        
-                        # ==============================
-                        # TOPOGRAPHIC CORRECTION
-                        # ==============================
-                        if correction_num == "1" or correction_num in ["4", "5"]:
-                            st.info("🏔️ Computing topographic correction...")
-                            
-                            # Build source tesseroids
-                            src_rows, src_cols = np.where(np.isfinite(elev_grid) & (np.abs(elev_grid) > topo_min_thickness))
-                            n_src = len(src_rows)
-                            st.info(f"Building {n_src} topographic source tesseroids...")
-                            
-                            src_lat_rad = np.empty(n_src, dtype=np.float64)
-                            src_lon_rad = np.empty(n_src, dtype=np.float64)
-                            src_r1 = np.empty(n_src, dtype=np.float64)
-                            src_r2 = np.empty(n_src, dtype=np.float64)
-                            src_rho = np.empty(n_src, dtype=np.float64)
-                            
-                            for k, (i, j) in enumerate(zip(src_rows, src_cols)):
-                                H = elev_grid[i, j]
-                                lat = lats[i]
-                                lon = lons[j]
-                                src_lat_rad[k] = math.radians(lat)
-                                src_lon_rad[k] = math.radians(lon)
-                                
-                                Nval = geoid_grid[i, j] if np.isfinite(geoid_grid[i, j]) else 0.0
-                                r_top = ell_radii[i] + H + Nval
-                                r_bottom = ell_radii[i]
-                                
-                                src_r1[k] = min(r_top, r_bottom)
-                                src_r2[k] = max(r_top, r_bottom)
-                                src_rho[k] = rho_rock if H >= 0 else rho_water
-                            
-                            # Compute potential
-                            dlat_rad = math.radians(dx_deg)
-                            dlon_rad = math.radians(dx_deg)
-                            cutoff_rad = math.radians(cutoff_deg_topo)
-                            cos_cutoff = math.cos(cutoff_rad)
-                            
-                            obs_lats_rad_flat = np.radians(np.repeat(lats, nlons))
-                            obs_lons_rad_flat = np.radians(np.tile(lons, nlats))
-                            r_obs_flat = r_obs_grid.flatten().copy()
-                            r_obs_flat[~valid_obs_mask.flatten()] = np.nan
-                            
-                            n_obs = len(r_obs_flat)
-                            potentials_flat = np.full(n_obs, np.nan, dtype=np.float64)
-                            
-                            n_batches = (n_obs + batch_size_topo - 1) // batch_size_topo
-                            progress_bar = st.progress(0)
-                            t0 = time.time()
-                            
-                            for b in range(n_batches):
-                                s = b * batch_size_topo
-                                e = min((b+1) * batch_size_topo, n_obs)
-                                results_batch = np.full(e - s, np.nan, dtype=np.float64)
-                                
-                                compute_potential_batch(
-                                    obs_lats_rad_flat[s:e], obs_lons_rad_flat[s:e], r_obs_flat[s:e],
-                                    src_lat_rad, src_lon_rad, src_r1, src_r2, src_rho,
-                                    dlat_rad, dlon_rad, cos_cutoff, results_batch
-                                )
-                                potentials_flat[s:e] = results_batch
-                                progress_bar.progress((b + 1) / n_batches)
-                            
-                            t_elapsed = time.time() - t0
-                            st.success(f"✅ Topographic potential computed in {t_elapsed:.1f} s")
-                            
-                            potential_grid = potentials_flat.reshape((nlats, nlons))
-                            gamma_grid_safe = np.where(gamma_grid > 1e-8, gamma_grid, 1e-8)
-                            deltaN_topo = potential_grid / gamma_grid_safe
-                            deltaN_topo[~valid_obs_mask] = np.nan
-                            
-                            results['topography'] = elev_grid
-                            results['topographic_correction'] = deltaN_topo
-                        
-                        # ==============================
-                        # CRUSTAL CORRECTION
-                        # ==============================
-                        if correction_num == "2" or correction_num in ["4", "5"]:
-                            st.info("🌍 Computing crustal thickness correction...")
-                            
-                            ref_thk_m = reference_thickness * 1000.0
-                            delta_rho = rho_mantle - rho_crust
-                            
-                            # Build source tesseroids
-                            src_rows, src_cols = np.where(np.isfinite(crustal_grid))
-                            n_src_candidates = len(src_rows)
-                            
-                            src_lat_rad = []
-                            src_lon_rad = []
-                            src_r1 = []
-                            src_r2 = []
-                            src_rho = []
-                            
-                            for i, j in zip(src_rows, src_cols):
-                                ct = crustal_grid[i, j]
-                                delta_moho = ct - ref_thk_m
-                                
-                                if abs(delta_moho) < crust_min_thickness:
-                                    continue
-                                
-                                H = elev_safe[i, j]
-                                N = geoid_safe[i, j]
-                                
-                                # Moho depth from surface
-                                r_m = (ell_radii[i] + H + N) - ct
-                                r_ref = (ell_radii[i] + H + N) - ref_thk_m
-                                
-                                if r_m <= 0 or r_ref <= 0 or abs(r_ref - r_m) < 1e-6:
-                                    continue
-                                
-                                src_lat_rad.append(math.radians(lats[i]))
-                                src_lon_rad.append(math.radians(lons[j]))
-                                src_r1.append(min(r_m, r_ref))
-                                src_r2.append(max(r_m, r_ref))
-                                # Positive where crust < reference, negative where crust > reference
-                                src_rho.append(delta_rho if ct < ref_thk_m else -delta_rho)
-                            
-                            src_lat_rad = np.array(src_lat_rad, dtype=np.float64)
-                            src_lon_rad = np.array(src_lon_rad, dtype=np.float64)
-                            src_r1 = np.array(src_r1, dtype=np.float64)
-                            src_r2 = np.array(src_r2, dtype=np.float64)
-                            src_rho = np.array(src_rho, dtype=np.float64)
-                            n_src = len(src_r1)
-                            
-                            st.info(f"Building {n_src} crustal source tesseroids...")
-                            
-                            # Compute potential
-                            dlat_rad = math.radians(dx_deg)
-                            dlon_rad = math.radians(dx_deg)
-                            cutoff_rad = math.radians(cutoff_deg_crust)
-                            cos_cutoff = math.cos(cutoff_rad)
-                            
-                            obs_lats_rad_flat = np.radians(np.repeat(lats, nlons))
-                            obs_lons_rad_flat = np.radians(np.tile(lons, nlats))
-                            r_obs_flat = r_obs_grid.flatten().copy()
-                            r_obs_flat[~valid_obs_mask.flatten()] = np.nan
-                            
-                            n_obs = len(r_obs_flat)
-                            potentials_flat = np.full(n_obs, np.nan, dtype=np.float64)
-                            
-                            n_batches = (n_obs + batch_size_crust - 1) // batch_size_crust
-                            progress_bar = st.progress(0)
-                            t0 = time.time()
-                            
-                            for b in range(n_batches):
-                                s = b * batch_size_crust
-                                e = min((b+1) * batch_size_crust, n_obs)
-                                results_batch = np.full(e - s, np.nan, dtype=np.float64)
-                                
-                                compute_potential_batch(
-                                    obs_lats_rad_flat[s:e], obs_lons_rad_flat[s:e], r_obs_flat[s:e],
-                                    src_lat_rad, src_lon_rad, src_r1, src_r2, src_rho,
-                                    dlat_rad, dlon_rad, cos_cutoff, results_batch
-                                )
-                                potentials_flat[s:e] = results_batch
-                                progress_bar.progress((b + 1) / n_batches)
-                            
-                            t_elapsed = time.time() - t0
-                            st.success(f"✅ Crustal potential computed in {t_elapsed:.1f} s")
-                            
-                            potential_grid = potentials_flat.reshape((nlats, nlons))
-                            gamma_grid_safe = np.where(gamma_grid > 1e-8, gamma_grid, 1e-8)
-                            deltaN_crust = potential_grid / gamma_grid_safe
-                            deltaN_crust[~valid_obs_mask] = np.nan
-                            
-                            results['crustal_thickness'] = crustal_grid
-                            results['crustal_correction'] = deltaN_crust
-                        
-                        # ==============================
-                        # SEDIMENTARY CORRECTION
-                        # ==============================
-                        if (correction_num == "3" or correction_num in ["4", "5"]) and sedimentary_grid is not None:
-                            st.info("🏗️ Computing sedimentary correction...")
-                            
-                            # Build source tesseroids
-                            src_rows, src_cols = np.where(sedimentary_grid > sed_min_thickness)
-                            n_src = len(src_rows)
-                            
-                            st.info(f"Building {n_src} sedimentary source tesseroids...")
-                            
-                            src_lat_rad = np.empty(n_src, dtype=np.float64)
-                            src_lon_rad = np.empty(n_src, dtype=np.float64)
-                            src_r1 = np.empty(n_src, dtype=np.float64)
-                            src_r2 = np.empty(n_src, dtype=np.float64)
-                            src_rho = np.empty(n_src, dtype=np.float64)
-                            
-                            for k, (i, j) in enumerate(zip(src_rows, src_cols)):
-                                src_lat_rad[k] = math.radians(lats[i])
-                                src_lon_rad[k] = math.radians(lons[j])
-                                
-                                H = elev_safe[i, j]
-                                N = geoid_safe[i, j]
-                                r_top = ell_radii[i] + H + N
-                                r_bottom = r_top - sedimentary_grid[i, j]
-                                
-                                if r_bottom >= r_top:
-                                    src_r1[k] = np.nan
-                                    src_r2[k] = np.nan
-                                    src_rho[k] = 0.0
-                                else:
-                                    src_r1[k] = r_bottom
-                                    src_r2[k] = r_top
-                                    src_rho[k] = rho_sediment_contrast
-                            
-                            # Remove invalid
-                            valid_mask = np.isfinite(src_r1) & np.isfinite(src_r2)
-                            src_lat_rad = src_lat_rad[valid_mask]
-                            src_lon_rad = src_lon_rad[valid_mask]
-                            src_r1 = src_r1[valid_mask]
-                            src_r2 = src_r2[valid_mask]
-                            src_rho = src_rho[valid_mask]
-                            n_src = len(src_r1)
-                            
-                            st.info(f"Valid sedimentary tesseroids: {n_src}")
-                            
-                            # Compute potential
-                            dlat_rad = math.radians(dx_deg)
-                            dlon_rad = math.radians(dx_deg)
-                            cutoff_rad = math.radians(cutoff_deg_sed)
-                            cos_cutoff = math.cos(cutoff_rad)
-                            
-                            obs_lats_rad_flat = np.radians(np.repeat(lats, nlons))
-                            obs_lons_rad_flat = np.radians(np.tile(lons, nlats))
-                            r_obs_flat = r_obs_grid.flatten().copy()
-                            r_obs_flat[~valid_obs_mask.flatten()] = np.nan
-                            
-                            n_obs = len(r_obs_flat)
-                            potentials_flat = np.full(n_obs, np.nan, dtype=np.float64)
-                            
-                            n_batches = (n_obs + batch_size_sed - 1) // batch_size_sed
-                            progress_bar = st.progress(0)
-                            t0 = time.time()
-                            
-                            for b in range(n_batches):
-                                s = b * batch_size_sed
-                                e = min((b+1) * batch_size_sed, n_obs)
-                                results_batch = np.full(e - s, np.nan, dtype=np.float64)
-                                
-                                compute_potential_batch(
-                                    obs_lats_rad_flat[s:e], obs_lons_rad_flat[s:e], r_obs_flat[s:e],
-                                    src_lat_rad, src_lon_rad, src_r1, src_r2, src_rho,
-                                    dlat_rad, dlon_rad, cos_cutoff, results_batch
-                                )
-                                potentials_flat[s:e] = results_batch
-                                progress_bar.progress((b + 1) / n_batches)
-                            
-                            t_elapsed = time.time() - t0
-                            st.success(f"✅ Sedimentary potential computed in {t_elapsed:.1f} s")
-                            
-                            potential_grid = potentials_flat.reshape((nlats, nlons))
-                            gamma_grid_safe = np.where(gamma_grid > 1e-8, gamma_grid, 1e-8)
-                            deltaN_sed = potential_grid / gamma_grid_safe
-                            deltaN_sed[~valid_obs_mask] = np.nan
-                            
-                            results['sedimentary_thickness'] = sedimentary_grid
-                            results['sedimentary_correction'] = deltaN_sed
-                        
-                        # ==============================
-                        # ASSEMBLE FINAL RESULTS
-                        # ==============================
-                        if correction_num == "1":
-                            results['correction'] = results['topographic_correction']
-                            results['corrected_geoid'] = geoid_grid - results['topographic_correction']
-                            results['total_correction'] = results['topographic_correction']
-                        
-                        elif correction_num == "2":
-                            results['correction'] = results['crustal_correction']
-                            results['corrected_geoid'] = geoid_grid - results['crustal_correction']
-                            results['total_correction'] = results['crustal_correction']
-                        
-                        elif correction_num == "3":
-                            results['correction'] = results['sedimentary_correction']
-                            results['corrected_geoid'] = geoid_grid - results['sedimentary_correction']
-                            results['total_correction'] = results['sedimentary_correction']
-                        
-                        elif correction_num == "4":
-                            total_corr = results['topographic_correction'] + results['crustal_correction']
-                            if 'sedimentary_correction' in results:
-                                total_corr += results['sedimentary_correction']
-                            results['total_correction'] = total_corr
-                            results['corrected_geoid'] = geoid_grid - total_corr
-                        
-                        elif correction_num == "5":
-                            total_corr = results['topographic_correction'] + results['crustal_correction']
-                            if 'sedimentary_correction' in results:
-                                total_corr += results['sedimentary_correction']
-                            results['total_correction'] = total_corr
-                            results['residual_geoid'] = geoid_grid - total_corr
-
-                        # ==============================
-                        # CORRECTED PLOTTING SECTION
-                        # ==============================
-                        st.markdown("---")
-                        st.markdown(f"#### 📊 {correction_type} Results - Publication Quality")
-
-                        # Store results in session state for replotting - FIXED: Use different keys
-                        st.session_state.correction_results = results
-                        st.session_state.current_correction_num = correction_num  # Changed key
-                        st.session_state.current_correction_type = correction_type  # Changed key
-
-                    except Exception as e:
-                        st.error(f"❌ Error during computation: {str(e)}")
-                        st.exception(e)
+            # The correction is submitted as a background job: the script returns at
+            # once, the status panel polls the job and the other sections stay usable
+            job_manager = get_job_manager()
+            correction_job = job_manager.get(st.session_state.get('correction_job_id'))
+            st.checkbox("🛰️ Live preview of the partial correction", value=True, key="live_preview",
+                        help="Show the observations finished so far as a coarse map that updates while the correction runs")
+            correction_num = correction_type.split(".")[0]
+            grids = [Grid.from_dataset(stored_datasets[name]) if name else None
+                     for name in (selected_geoid, selected_topo, selected_crust, selected_sed)]
+            
+            # Parameters of the expanders shown for this correction
+            param_values = {}
+            if correction_num in ["1", "4", "5"]:
+                param_values.update(rho_rock=rho_rock, rho_water=rho_water, topo_min_thickness=topo_min_thickness,
+                                    cutoff_deg_topo=cutoff_deg_topo,
+                                    batch_size_topo="auto" if auto_batch_topo else batch_size_topo)
+            if correction_num in ["2", "4", "5"]:
+                param_values.update(rho_crust=rho_crust, rho_mantle=rho_mantle, reference_thickness=reference_thickness,
+                                    crust_min_thickness=crust_min_thickness, cutoff_deg_crust=cutoff_deg_crust,
+                                    batch_size_crust="auto" if auto_batch_crust else batch_size_crust)
+            if correction_num in ["3", "4", "5"] and selected_sed:
+                param_values.update(rho_sediment_contrast=rho_sediment_contrast, sed_min_thickness=sed_min_thickness,
+                                    cutoff_deg_sed=cutoff_deg_sed,
+                                    batch_size_sed="auto" if auto_batch_sed else batch_size_sed)
+            engine_settings = EngineSettings(
+                method=engine_method,
+                fuse_passes=fuse_passes,
+                near_cells=engine_options.get('near_cells', 2),
+                tolerance=engine_options.get('tolerance', 1e-3),
+                split_ratio=refine_options.get('split_ratio', 0.0),
+                max_depth=refine_options.get('max_depth', 4),
+                n_workers=pool_layout['n_workers'] if pool_layout else None,
+                threads_per_worker=pool_layout['threads_per_worker'] if pool_layout else None,
+                checkpoints=use_checkpoints,
+                precision=precision
+            )
+            
+            # Resource limits set by the administrator (GEOID_MAX_* environment variables)
+            resource_limits = ResourceLimits.from_env()
+            if resource_limits.active:
+                limit_texts = []
+                if resource_limits.max_pairs is not None:
+                    limit_texts.append(f"{resource_limits.max_pairs:.3g} pairs")
+                if resource_limits.max_seconds is not None:
+                    limit_texts.append(f"{resource_limits.max_seconds:.0f} s")
+                if resource_limits.max_memory_mb is not None:
+                    limit_texts.append(f"{resource_limits.max_memory_mb:,.0f} MB")
+                st.caption(f"🔒 Server limits per correction: {', '.join(limit_texts)}; larger runs are "
+                           f"{'downsampled' if resource_limits.action == 'downsample' else 'refused'}.")
+            
+            if st.button("📏 Estimate Cost"):
+                try:
+                    with st.spinner("Counting sources and observation-source pairs..."):
+                        cost_estimate = estimate_correction(correction_type, *grids,
+                                                            params=CorrectionParameters(**param_values),
+                                                            engine=engine_settings)
+                    col_est1, col_est2, col_est3, col_est4 = st.columns(4)
+                    col_est1.metric("Source tesseroids", f"{cost_estimate.total_sources:,}")
+                    col_est2.metric("Observation-source pairs", f"{cost_estimate.total_pairs:.3g}")
+                    col_est3.metric("Predicted run time",
+                                    "unknown" if cost_estimate.seconds is None else
+                                    f"{cost_estimate.seconds / 60:.1f} min" if cost_estimate.seconds > 90 else
+                                    f"{cost_estimate.seconds:.0f} s")
+                    col_est4.metric("Peak memory", f"{cost_estimate.peak_bytes / 1024 ** 2:,.0f} MB")
+                    st.dataframe(pd.DataFrame({
+                        'Class': [CLASS_LABELS[name] for name in cost_estimate.sources],
+                        'Sources': list(cost_estimate.sources.values()),
+                        'Pairs': [f"{pairs:.3g}" for pairs in cost_estimate.pairs.values()]
+                    }), use_container_width=True, hide_index=True)
+                    exceeded = resource_limits.violations(cost_estimate)
+                    if exceeded and resource_limits.action == "downsample":
+                        st.warning(f"⚠️ Over the server limits ({'; '.join(exceeded)}): the run will use a "
+                                   f"{resource_limits.downsample_stride(cost_estimate)}× coarser grid.")
+                    elif exceeded:
+                        st.error(f"❌ Over the server limits ({'; '.join(exceeded)}): reduce the grid or the cutoffs.")
+                except Exception as e:
+                    st.error(f"❌ Error during estimation: {str(e)}")
+            
+            if st.button("🚀 Compute Selected Correction", type="primary",
+                         disabled=correction_job is not None and correction_job.active):
+                try:
+                    correction_job = job_manager.submit(
+                        correction_type, compute_correction,
+                        correction_type, *grids,
+                        params=CorrectionParameters(**param_values),
+                        engine=engine_settings,
+                        unit_cache=st.session_state.setdefault('unit_potential_cache', {}),
+                        store=result_cache if use_result_cache else None,
+                        limits=resource_limits,
+                        cost_model=ThroughputModel()
+                    )
+                    st.session_state.correction_job_id = correction_job.id
+                except Exception as e:
+                    st.error(f"❌ Error during computation: {str(e)}")
+                    st.exception(e)
+            
+            @polling_fragment
+            def correction_job_status():
+                """Status, progress and log of this session's correction job"""
+                job = get_job_manager().get(st.session_state.get('correction_job_id'))
+                if job is None:
+                    return
+                if job.status == "done":
+                    # Store results in session state for replotting
+                    st.session_state.correction_results = job.result
+                    st.session_state.current_correction_num = correction_number(job.label)
+                    st.session_state.current_correction_type = job.label
+                    st.session_state.correction_job_log = job.messages
+                    st.session_state.correction_job_id = None
+                    get_job_manager().forget(job.id)
+                    st.rerun()
+                
+                status_icons = {"queued": "⏳", "running": "⚙️", "failed": "❌", "cancelled": "🛑"}
+                st.markdown(f"{status_icons[job.status]} **{job.label}**: {job.status}, {job.elapsed:.0f} s elapsed")
+                snapshot = job.snapshot if job.snapshot is not None and job.snapshot.stage == job.stage else None
+                if job.active and job.total:
+                    progress_text = f"{job.stage}: batch {job.done} of {job.total}"
+                    if snapshot is not None and snapshot.pairs_per_second:
+                        progress_text += f" · {snapshot.pairs_per_second:.3g} pairs/s"
+                    if snapshot is not None and snapshot.eta_seconds is not None and snapshot.done_fraction < 1.0:
+                        eta = snapshot.eta_seconds
+                        progress_text += f" · ~{eta / 60:.1f} min left" if eta > 90 else f" · ~{eta:.0f} s left"
+                    st.progress(job.fraction, text=progress_text)
+                if (job.active and snapshot is not None and snapshot.values is not None
+                        and st.session_state.get('live_preview', True) and np.isfinite(snapshot.values).any()):
+                    fig_preview, ax_preview = plt.subplots(figsize=(6, 4))
+                    im_preview = ax_preview.imshow(
+                        snapshot.values,
+                        extent=[snapshot.lons[0], snapshot.lons[-1], snapshot.lats[0], snapshot.lats[-1]],
+                        origin='lower',
+                        cmap='RdBu_r',
+                        aspect='auto'
+                    )
+                    ax_preview.set_title(f"Partial correction: {snapshot.done_fraction:.0%} of the observations", fontsize=10)
+                    ax_preview.set_xlabel('Longitude (°)', fontsize=9)
+                    ax_preview.set_ylabel('Latitude (°)', fontsize=9)
+                    plt.colorbar(im_preview, ax=ax_preview, shrink=0.8, pad=0.02).set_label('Correction (m)', fontsize=9)
+                    st.pyplot(fig_preview)
+                    plt.close(fig_preview)
+                for level, message in job.messages:
+                    getattr(st, level)(message)
+                
+                if job.active:
+                    if job.cancel_requested:
+                        st.caption("Stopping after the current batch...")
+                    elif st.button("🛑 Cancel correction", key="cancel_correction_job"):
+                        job.cancel()
+                    if _fragment is None:
+                        st.button("🔄 Refresh job status", key="refresh_correction_job")
+                else:
+                    if job.status == "failed":
+                        st.error(f"❌ Error during computation: {job.error.splitlines()[0]}")
+                        with st.expander("Traceback"):
+                            st.code(job.error)
+                    elif job.status == "cancelled":
+                        st.info("Cancelled. Finished batches are checkpointed, so running the same correction again resumes from them.")
+                    if st.button("Dismiss", key="dismiss_correction_job"):
+                        st.session_state.correction_job_id = None
+                        get_job_manager().forget(job.id)
+                        st.rerun()
+            
+            correction_job_status()
 
             # ==============================
             # PLOTTING SECTION (USES SESSION STATE)
@@ -3636,6 +3467,13 @@ elif st.session_state.current_section == "Geoid Corrections":
                 correction_num = st.session_state.get('current_correction_num', '1')  # Use get with default
                 correction_type = st.session_state.get('current_correction_type', '1. Topographic Correction Only')  # Use get with default
 
+                st.markdown("---")
+                st.markdown(f"#### 📊 {correction_type} Results - Publication Quality")
+                if st.session_state.get('correction_job_log'):
+                    with st.expander("📜 Computation log"):
+                        for level, message in st.session_state.correction_job_log:
+                            getattr(st, level)(message)
+
                 # CORRECTED: Use proper extent
                 lon_min, lon_max = results['lons'][0], results['lons'][-1]
                 lat_min, lat_max = results['lats'][0], results['lats'][-1]
@@ -3942,6 +3780,99 @@ elif st.session_state.current_section == "Geoid Corrections":
                 else:
                     st.error("❌ Plotting failed: axes not properly initialized")
 
+                # ==============================
+                # DENSITY SWEEP
+                # ==============================
+                if 'unit_corrections' in results:
+                    with st.expander("🎚️ Density Sweep"):
+                        st.markdown("The correction is linear in density, so it is rebuilt from the stored unit-density potentials without re-running the kernels.")
+                        
+                        correction_densities = results['correction_densities']
+                        unit_corrections = results['unit_corrections']
+                        
+                        # Sweepable parameter -> (correction, {class: sign})
+                        sweep_parameters = {
+                            "Rock density (kg/m³)": ('topographic', {'rock': 1.0}),
+                            "Water density (kg/m³)": ('topographic', {'water': 1.0}),
+                            "Mantle-crust density contrast (kg/m³)": ('crustal', {'moho_positive': 1.0, 'moho_negative': -1.0}),
+                            "Sediment density contrast (kg/m³)": ('sedimentary', {'sediment': 1.0})
+                        }
+                        sweep_parameters = {
+                            label: spec for label, spec in sweep_parameters.items() if spec[0] in correction_densities
+                        }
+                        
+                        col_sw1, col_sw2 = st.columns(2)
+                        with col_sw1:
+                            sweep_label = st.selectbox(
+                                "Parameter",
+                                options=list(sweep_parameters.keys()),
+                                key="density_sweep_parameter"
+                            )
+                        sweep_kind, sweep_signs = sweep_parameters[sweep_label]
+                        sweep_class = next(iter(sweep_signs))
+                        current_value = correction_densities[sweep_kind][sweep_class] * sweep_signs[sweep_class]
+                        with col_sw2:
+                            sweep_text = st.text_input(
+                                "Densities (comma separated)",
+                                value=", ".join(f"{current_value + step:g}" for step in (-200, -100, 0, 100, 200)),
+                                key=f"density_sweep_values_{sweep_class}"
+                            )
+                        
+                        try:
+                            sweep_values = [float(v) for v in sweep_text.replace(";", ",").split(",") if v.strip()]
+                        except ValueError:
+                            sweep_values = []
+                            st.error("❌ Densities must be numbers separated by commas")
+                        
+                        if sweep_values:
+                            t0 = time.time()
+                            sweep_rows = []
+                            sweep_grids = {}
+                            for value in sweep_values:
+                                densities = {cls: dict(classes) for cls, classes in correction_densities.items()}
+                                for name, sign in sweep_signs.items():
+                                    densities[sweep_kind][name] = sign * value
+                                total_corr = None
+                                for classes in densities.values():
+                                    corr = combine_unit_potentials(unit_corrections, classes)
+                                    total_corr = corr if total_corr is None else total_corr + corr
+                                sweep_grids[value] = total_corr
+                                sweep_rows.append({
+                                    'Density (kg/m³)': value,
+                                    'Mean ΔN (m)': np.nanmean(total_corr),
+                                    'Std ΔN (m)': np.nanstd(total_corr),
+                                    'Min ΔN (m)': np.nanmin(total_corr),
+                                    'Max ΔN (m)': np.nanmax(total_corr),
+                                    'RMS change vs current (m)': np.sqrt(np.nanmean((total_corr - results['total_correction']) ** 2))
+                                })
+                            t_elapsed = time.time() - t0
+                            st.success(f"✅ {len(sweep_values)} corrections in {t_elapsed * 1000:.0f} ms")
+                            
+                            df_sweep = pd.DataFrame(sweep_rows)
+                            st.dataframe(df_sweep, use_container_width=True)
+                            
+                            fig_sweep, ax_sweep = plt.subplots(figsize=(6, 3.5))
+                            ax_sweep.errorbar(df_sweep['Density (kg/m³)'], df_sweep['Mean ΔN (m)'],
+                                              yerr=df_sweep['Std ΔN (m)'], marker='o', capsize=3, color='black')
+                            ax_sweep.set_xlabel(sweep_label, fontsize=font_size)
+                            ax_sweep.set_ylabel('Total correction ΔN (m)', fontsize=font_size)
+                            ax_sweep.tick_params(axis='both', which='major', labelsize=font_size-1)
+                            plt.tight_layout()
+                            st.pyplot(fig_sweep)
+                            
+                            sweep_download = {
+                                'Longitude': results['grid_lons'].flatten(),
+                                'Latitude': results['grid_lats'].flatten()
+                            }
+                            for value, grid in sweep_grids.items():
+                                sweep_download[f'Total_Correction_{value:g}'] = grid.flatten()
+                            st.download_button(
+                                label="📥 Download Sweep CSV",
+                                data=pd.DataFrame(sweep_download).to_csv(index=False),
+                                file_name=f"density_sweep_{sweep_class}.csv",
+                                mime="text/csv"
+                            )
+
 
 
 
@@ -4307,12 +4238,9 @@ elif st.session_state.current_section == "Draw Profiling Line":
                         # Extract values for selected fields
                         for field in selected_fields:
                             if field not in profile['values']:
-                                field_values = []
-                                for i in range(profile['num_points']):
-                                    lon_idx = np.argmin(np.abs(results['lons'] - profile['profile_lons'][i]))
-                                    lat_idx = np.argmin(np.abs(results['lats'] - profile['profile_lats'][i]))
-                                    field_values.append(available_fields[field]['data'][lat_idx, lon_idx])
-                                profile['values'][field] = field_values
+                                field_grid = Grid(results['lons'], results['lats'], available_fields[field]['data'])
+                                profile['values'][field] = list(field_grid.nearest(profile['profile_lons'],
+                                                                                   profile['profile_lats']))
                         
                         # ==============================
                         # NEW LAYOUT: Map first, then profile plots with individual scales
@@ -4684,12 +4612,10 @@ elif st.session_state.current_section == "Draw Profiling Line":
                             
                             # Ensure values are extracted
                             if field_to_compare not in profile['values']:
-                                field_values = []
-                                for i in range(profile['num_points']):
-                                    lon_idx = np.argmin(np.abs(results['lons'] - profile['profile_lons'][i]))
-                                    lat_idx = np.argmin(np.abs(results['lats'] - profile['profile_lats'][i]))
-                                    field_values.append(available_fields[field_to_compare]['data'][lat_idx, lon_idx])
-                                profile['values'][field_to_compare] = field_values
+                                field_grid = Grid(results['lons'], results['lats'],
+                                                  available_fields[field_to_compare]['data'])
+                                profile['values'][field_to_compare] = list(field_grid.nearest(
+                                    profile['profile_lons'], profile['profile_lats']))
                             
                             # Normalize distances for comparison
                             normalized_distances = np.array(profile['distances']) / profile['distances'][-1]
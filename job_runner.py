@@ -0,0 +1,146 @@
+"""
+Background execution of corrections.
+
+A JobManager runs functions with the ``log(level, message)`` /
+``progress(stage, done, total)`` / ``preview(stage, snapshot)`` callback
+signature of correction_engine.compute_correction on a thread pool, so the Streamlit
+script that submits a job returns immediately and can poll it on later
+reruns. The Numba kernels release the GIL, and with the process-pool
+executor they run in worker processes, so the server stays responsive while
+a job runs.
+
+Cancellation is cooperative: once a job is asked to stop, its next progress
+or log call raises JobCancelled, which ends the run after the current batch
+(checkpointed batches are kept, so a rerun resumes).
+"""
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    """Raised inside a job whose cancellation was requested"""
+
+
+class Job:
+    """State of one background job, updated by the worker thread.
+
+    ``status`` is one of queued, running, done, failed or cancelled;
+    ``stage``/``done``/``total`` describe the current kernel pass and
+    ``messages`` collects the (level, message) pairs the job logged and
+    ``snapshot`` holds the latest preview (e.g. a correction_engine.PassPreview).
+    """
+
+    def __init__(self, job_id, label):
+        self.id = job_id
+        self.label = label
+        self.status = "queued"
+        self.stage = ""
+        self.done = 0
+        self.total = 0
+        self.messages = []
+        self.snapshot = None
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self._cancel = threading.Event()
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    @property
+    def elapsed(self):
+        """Seconds spent running (so far)"""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def fraction(self):
+        """Completed fraction of the current stage"""
+        return self.done / self.total if self.total else 0.0
+
+    def cancel(self):
+        """Ask the job to stop; a job that has not started yet is dropped at once"""
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self.status = "cancelled"
+            self.finished = time.time()
+
+    def log(self, level, message):
+        """``log`` callback handed to the job function"""
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.messages.append((level, message))
+
+    def progress(self, stage, done, total):
+        """``progress`` callback handed to the job function"""
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.stage, self.done, self.total = stage, done, total
+
+    def preview(self, stage, snapshot):
+        """``preview`` callback handed to the job function"""
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.snapshot = snapshot
+
+
+class JobManager:
+    """Thread pool running Jobs; ``max_workers`` jobs run at the same time"""
+
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="geoid-job")
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, label, fn, *args, **kwargs):
+        """Run ``fn(*args, log=..., progress=..., preview=..., **kwargs)`` in the background"""
+        with self._lock:
+            job = Job(next(self._ids), label)
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    @staticmethod
+    def _run(job, fn, args, kwargs):
+        if job.cancel_requested:
+            job.status = "cancelled"
+            return
+        job.status = "running"
+        job.started = time.time()
+        try:
+            job.result = fn(*args, log=job.log, progress=job.progress, preview=job.preview, **kwargs)
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.error = f"{e}\n\n{traceback.format_exc()}"
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id):
+        """Job by id, or None"""
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        """Every job that has not been forgotten, oldest first"""
+        return list(self._jobs.values())
+
+    def forget(self, job_id):
+        """Drop a finished job and its result"""
+        job = self._jobs.get(job_id)
+        if job is not None and not job.active:
+            del self._jobs[job_id]
@@ -0,0 +1,171 @@
+"""
+Persistent, content-addressed cache of correction results.
+
+Entries are named after a digest of everything the result depends on (the
+input grids plus every physical and computation parameter, see result_key),
+so identical runs from any session or user on the same server share one
+entry. Each entry is a single ``.npz`` file: the arrays are stored as npz
+members and the nesting (dicts, scalars, strings) as a JSON manifest, so
+loading never unpickles anything.
+
+The cache lives in ``GEOID_RESULT_CACHE_DIR`` (default ``~/.cache/geoid_results``)
+and is bounded to ``GEOID_RESULT_CACHE_MB`` megabytes (default 2048); the
+least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+def default_cache_dir():
+    """Directory of the shared result cache"""
+    return os.environ.get("GEOID_RESULT_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "geoid_results"))
+
+
+def default_max_bytes():
+    """Size bound of the shared result cache in bytes"""
+    return int(float(os.environ.get("GEOID_RESULT_CACHE_MB", 2048)) * 1024 ** 2)
+
+
+def result_key(arrays, params):
+    """Digest of the input arrays (values, dtype and shape) and a parameter dict"""
+    digest = hashlib.sha1()
+    for values in arrays:
+        values = np.ascontiguousarray(values)
+        digest.update(repr((values.dtype.str, values.shape)).encode())
+        digest.update(values.tobytes())
+    digest.update(repr(sorted((str(k), repr(v)) for k, v in params.items())).encode())
+    return digest.hexdigest()
+
+
+def _pack(value, arrays):
+    """JSON-able manifest of ``value`` with its arrays moved into ``arrays``"""
+    if isinstance(value, np.ndarray):
+        name = f"a{len(arrays)}"
+        arrays[name] = value
+        return {"__array__": name}
+    if isinstance(value, dict):
+        return {"__dict__": [[_pack(k, arrays), _pack(v, arrays)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return {"__list__": [_pack(v, arrays) for v in value]}
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f"Cannot cache values of type {type(value).__name__}")
+
+
+def _unpack(manifest, arrays):
+    if isinstance(manifest, dict):
+        if "__array__" in manifest:
+            return arrays[manifest["__array__"]]
+        if "__dict__" in manifest:
+            return {_unpack(k, arrays): _unpack(v, arrays) for k, v in manifest["__dict__"]}
+        return [_unpack(v, arrays) for v in manifest["__list__"]]
+    return manifest
+
+
+class ResultCache:
+    """Size-bounded LRU cache of result dicts (arrays, nested dicts and scalars) on disk"""
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = default_max_bytes() if max_bytes is None else int(max_bytes)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """Stored value of ``key`` or None; a hit marks the entry as recently used"""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files if name != "__manifest__"}
+                meta = json.loads(str(npz["__manifest__"]))
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return _unpack(meta["value"], arrays)
+
+    def put(self, key, value, label=""):
+        """Store ``value`` under ``key`` and evict old entries beyond the size bound"""
+        arrays = {}
+        meta = {"value": _pack(value, arrays), "label": label, "created": time.time()}
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz.tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, __manifest__=np.array(json.dumps(meta)), **arrays)
+            # Atomic rename: readers never see a partially written entry
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def entries(self):
+        """Entries as dicts (key, label, created, last_used, size), most recently used first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+                with np.load(path, allow_pickle=False) as npz:
+                    meta = json.loads(str(npz["__manifest__"]))
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append({"key": name[:-4], "label": meta.get("label", ""),
+                            "created": meta.get("created", info.st_mtime),
+                            "last_used": info.st_mtime, "size": info.st_size})
+        entries.sort(key=lambda entry: entry["last_used"], reverse=True)
+        return entries
+
+    def total_bytes(self):
+        """Disk space used by the entries"""
+        return sum(os.path.getsize(os.path.join(self.directory, name))
+                   for name in os.listdir(self.directory) if name.endswith(".npz"))
+
+    def remove(self, key):
+        """Delete one entry"""
+        if os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    def clear(self):
+        """Delete every entry"""
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits its size bound"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                try:
+                    info = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((info.st_mtime, info.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
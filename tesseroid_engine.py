@@ -0,0 +1,1816 @@
+"""
+Tesseroid potential engine used by the Geoid Corrections section of gui.py.
+
+The Numba kernels live at module level so that they are compiled once per
+process instead of once per Streamlit rerun, and ``cache=True`` stores the
+compiled machine code on disk (``__pycache__`` next to this file, or the
+directory given by ``NUMBA_CACHE_DIR``) so later server starts skip the
+compilation entirely. They are compiled with ``nogil=True``, so a correction
+running in a background thread does not hold up the server's other threads.
+"""
+import hashlib
+import math
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+from numba import get_num_threads, jit, prange
+
+# Gravitational constant (m^3 kg^-1 s^-2)
+G = 6.67430e-11
+
+# Wall time per batch aimed at by batch_size="auto" (s), and the size of its
+# calibration sample in observation-source pairs
+AUTO_BATCH_SECONDS = 0.5
+_CALIBRATION_PAIRS = 4e6
+
+
+# ==============================
+# NUMBA KERNELS
+# ==============================
+
+@jit(nopython=True, nogil=True, cache=True)
+def tesseroid_potential_contrib(lat_obs, lon_obs, r_obs, lat_t, lon_t, r1, r2, rho, dlat, dlon):
+    """Single tesseroid potential contribution (Heck & Seitz series expansion)"""
+    cos_psi = (math.sin(lat_obs) * math.sin(lat_t) +
+               math.cos(lat_obs) * math.cos(lat_t) * math.cos(lon_obs - lon_t))
+    if cos_psi > 1.0:
+        cos_psi = 1.0
+    elif cos_psi < -1.0:
+        cos_psi = -1.0
+    psi = math.acos(cos_psi)
+    r_t = 0.5 * (r1 + r2)
+    l0_sq = r_obs * r_obs + r_t * r_t - 2.0 * r_obs * r_t * cos_psi
+    if l0_sq <= 0.0:
+        return 0.0
+    l0 = math.sqrt(l0_sq)
+    if l0 < 1e-12:
+        l0 = 1e-12
+    K000 = 1.0 / l0
+    K200 = (3.0 * (r_obs - r_t * cos_psi) ** 2 - l0_sq) / (l0_sq ** 2.5)
+    sin_psi = math.sin(psi)
+    if sin_psi > 1e-12:
+        K020 = (3.0 * (r_t * psi) ** 2 - l0_sq) / (l0_sq ** 2.5)
+        K002 = (3.0 * (r_t * sin_psi) ** 2 - l0_sq) / (l0_sq ** 2.5)
+    else:
+        K020 = 0.0
+        K002 = 0.0
+    dr = r2 - r1
+    K = K000 + (dr * dr / 24.0) * K200 + (dlat * dlat / 24.0) * K020 + (dlon * dlon / 24.0) * K002
+    cos_lat_t = math.cos(lat_t)
+    if cos_lat_t < 0.0:
+        cos_lat_t = 0.0
+    dV = r_t * r_t * cos_lat_t * dr * dlat * dlon
+    return G * rho * dV * K
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def compute_potential_batch(obs_lats_rad, obs_lons_rad, obs_radii,
+                            src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho,
+                            dlat, dlon, cos_cutoff, results):
+    """Compute potential for a batch of observations"""
+    n_obs = len(obs_lats_rad)
+    n_src = len(src_lats_rad)
+    for ii in prange(n_obs):
+        ro = obs_radii[ii]
+        if np.isnan(ro):
+            results[ii] = np.nan
+            continue
+        lat_o = obs_lats_rad[ii]
+        lon_o = obs_lons_rad[ii]
+        pot_sum = 0.0
+        for ss in range(n_src):
+            r1 = src_r1[ss]
+            r2 = src_r2[ss]
+            rho = src_rho[ss]
+            if np.isnan(r1) or np.isnan(r2):
+                continue
+            cos_psi = (math.sin(lat_o) * math.sin(src_lats_rad[ss]) +
+                       math.cos(lat_o) * math.cos(src_lats_rad[ss]) * math.cos(lon_o - src_lons_rad[ss]))
+            if cos_psi < cos_cutoff:
+                continue
+            pot_sum += tesseroid_potential_contrib(lat_o, lon_o, ro, src_lats_rad[ss], src_lons_rad[ss],
+                                                   r1, r2, rho, dlat, dlon)
+        results[ii] = pot_sum
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _psi_terms(cos_psi):
+    """Clamped cos(psi), psi and sin(psi) for the lateral kernel terms (psi = 0 when sin(psi) ~ 0)"""
+    if cos_psi > 1.0:
+        cos_psi = 1.0
+    elif cos_psi < -1.0:
+        cos_psi = -1.0
+    # sin(acos(c)) == sqrt(1 - c^2), saves one transcendental call per pair
+    sin_psi = math.sqrt(1.0 - cos_psi * cos_psi)
+    psi = math.acos(cos_psi) if sin_psi > 1e-12 else 0.0
+    return cos_psi, psi, sin_psi
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _kernel_from_cos_psi(cos_psi, r_obs, r_t, dr2_24, dlat2_24, dlon2_24):
+    """Heck & Seitz kernel K for a precomputed cos(psi); matches tesseroid_potential_contrib"""
+    cos_psi, psi, sin_psi = _psi_terms(cos_psi)
+    return _kernel_from_geometry(cos_psi, psi, sin_psi, r_obs, r_t, dr2_24, dlat2_24, dlon2_24)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _kernel_from_geometry(cos_psi, psi, sin_psi, r_obs, r_t, dr2_24, dlat2_24, dlon2_24):
+    """Radial part of the kernel once the angular terms from _psi_terms are known"""
+    l0_sq = r_obs * r_obs + r_t * r_t - 2.0 * r_obs * r_t * cos_psi
+    if l0_sq <= 0.0:
+        return 0.0
+    l0 = math.sqrt(l0_sq)
+    if l0 < 1e-12:
+        l0 = 1e-12
+    # One division per pair: 1/l0^5 from powers of 1/l0
+    K000 = 1.0 / l0
+    inv_l0_2 = K000 * K000
+    inv_l0_5 = inv_l0_2 * inv_l0_2 * K000
+    second = dr2_24 * (3.0 * (r_obs - r_t * cos_psi) ** 2 - l0_sq)
+    if sin_psi > 1e-12:
+        second += (dlat2_24 * (3.0 * (r_t * psi) ** 2 - l0_sq) +
+                   dlon2_24 * (3.0 * (r_t * sin_psi) ** 2 - l0_sq))
+    return K000 + second * inv_l0_5
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _needs_split(ro, r_t, cos_psi, dr, cos_lat_t, dlat, dlon, split_ratio):
+    """True when the observation is closer than split_ratio x the largest tesseroid dimension"""
+    l0_sq = ro * ro + r_t * r_t - 2.0 * ro * r_t * cos_psi
+    size = max(dr, r_t * dlat, r_t * cos_lat_t * dlon)
+    return l0_sq < (split_ratio * size) ** 2
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _subdivided_potential(slo, clo, sino, coso, ro, sin_lat, cos_lat, sin_lon, cos_lon,
+                          r_mid, dr, dlat, dlon, grho, split_ratio, max_depth, stack):
+    """Potential of one tesseroid, recursively split near the observation.
+
+    A piece with any dimension (radial, latitude, longitude) longer than
+    distance / split_ratio is halved along all three, down to ``max_depth``
+    levels, and the pieces use the second-order kernel. Halving only the
+    long dimensions leaves elongated pieces whose lateral error can exceed
+    that of the whole tesseroid. ``stack`` is scratch space of at least
+    (7 * max_depth + 1, 9). Returns (potential, number of kernel evaluations).
+    """
+    stack[0, 0] = sin_lat
+    stack[0, 1] = cos_lat
+    stack[0, 2] = sin_lon
+    stack[0, 3] = cos_lon
+    stack[0, 4] = r_mid
+    stack[0, 5] = dr
+    stack[0, 6] = dlat
+    stack[0, 7] = dlon
+    stack[0, 8] = 0.0
+    top = 1
+    pot = 0.0
+    n_eval = 0
+    while top > 0:
+        top -= 1
+        s_la = stack[top, 0]
+        c_la = stack[top, 1]
+        s_lo = stack[top, 2]
+        c_lo = stack[top, 3]
+        r = stack[top, 4]
+        h = stack[top, 5]
+        a = stack[top, 6]
+        b = stack[top, 7]
+        depth = stack[top, 8]
+        cos_psi = slo * s_la + clo * c_la * (coso * c_lo + sino * s_lo)
+        lim = math.sqrt(max(ro * ro + r * r - 2.0 * ro * r * cos_psi, 0.0)) / split_ratio
+        if depth >= max_depth or max(h, r * a, r * c_la * b) <= lim:
+            weight = grho * r * r * max(c_la, 0.0) * h * a * b
+            pot += weight * _kernel_from_cos_psi(cos_psi, ro, r, h * h / 24.0,
+                                                 a * a / 24.0, b * b / 24.0)
+            n_eval += 1
+            continue
+        for ia in range(2):
+            off_a = (ia - 0.5) * 0.5 * a
+            so = math.sin(off_a)
+            co = math.cos(off_a)
+            s_la_c = s_la * co + c_la * so
+            c_la_c = c_la * co - s_la * so
+            for ib in range(2):
+                off_b = (ib - 0.5) * 0.5 * b
+                so = math.sin(off_b)
+                co = math.cos(off_b)
+                s_lo_c = s_lo * co + c_lo * so
+                c_lo_c = c_lo * co - s_lo * so
+                for ir in range(2):
+                    stack[top, 0] = s_la_c
+                    stack[top, 1] = c_la_c
+                    stack[top, 2] = s_lo_c
+                    stack[top, 3] = c_lo_c
+                    stack[top, 4] = r + (ir - 0.5) * 0.5 * h
+                    stack[top, 5] = 0.5 * h
+                    stack[top, 6] = 0.5 * a
+                    stack[top, 7] = 0.5 * b
+                    stack[top, 8] = depth + 1.0
+                    top += 1
+    return pot, n_eval
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def compute_potential_batch_trig(obs_lons_rad, obs_sin_lat, obs_cos_lat, obs_sin_lon, obs_cos_lon, obs_radii,
+                                 src_lons_rad, src_sin_lat, src_cos_lat, src_sin_lon, src_cos_lon,
+                                 src_r_mid, src_dr2_24, src_weight, src_dr, src_grho,
+                                 dlat, dlon, dlat2_24, dlon2_24, cos_cutoff,
+                                 split_ratio, max_depth, counts, results):
+    """Compute potential for a batch of observations from precomputed trig tables.
+
+    Sources closer than ``split_ratio`` times their size are subdivided (see
+    _subdivided_potential; ``split_ratio = 0`` disables it); ``counts[ii]``
+    receives the number of sources evaluated with a single kernel call, the
+    number of subdivided sources and the kernel evaluations spent on them.
+    """
+    n_obs = len(obs_radii)
+    n_src = len(src_r_mid)
+    refine = split_ratio > 0.0 and max_depth > 0
+    for ii in prange(n_obs):
+        ro = obs_radii[ii]
+        if np.isnan(ro):
+            results[ii] = np.nan
+            continue
+        lon_o = obs_lons_rad[ii]
+        slo = obs_sin_lat[ii]
+        clo = obs_cos_lat[ii]
+        sino = obs_sin_lon[ii]
+        coso = obs_cos_lon[ii]
+        stack = np.empty((7 * max_depth + 1 if refine else 1, 9))
+        n_pairs = 0
+        n_split = 0
+        n_eval = 0
+        pot_sum = 0.0
+        for ss in range(n_src):
+            # Same meridian: keep cos(0) == 1 exactly, as the direct kernel does;
+            # the coincident-cell term is very sensitive to the last bit of cos(psi)
+            if src_lons_rad[ss] == lon_o:
+                cos_dlon = 1.0
+            else:
+                cos_dlon = coso * src_cos_lon[ss] + sino * src_sin_lon[ss]
+            cos_psi = slo * src_sin_lat[ss] + clo * src_cos_lat[ss] * cos_dlon
+            if cos_psi < cos_cutoff:
+                continue
+            if refine and _needs_split(ro, src_r_mid[ss], cos_psi, src_dr[ss], src_cos_lat[ss],
+                                       dlat, dlon, split_ratio):
+                pot, n = _subdivided_potential(slo, clo, sino, coso, ro, src_sin_lat[ss], src_cos_lat[ss],
+                                               src_sin_lon[ss], src_cos_lon[ss], src_r_mid[ss], src_dr[ss],
+                                               dlat, dlon, src_grho[ss], split_ratio, max_depth, stack)
+                pot_sum += pot
+                n_split += 1
+                n_eval += n
+                continue
+            pot_sum += src_weight[ss] * _kernel_from_cos_psi(cos_psi, ro, src_r_mid[ss],
+                                                             src_dr2_24[ss], dlat2_24, dlon2_24)
+            n_pairs += 1
+        results[ii] = pot_sum
+        counts[ii, 0] = n_pairs
+        counts[ii, 1] = n_split
+        counts[ii, 2] = n_eval
+
+
+# ==============================
+# TRIGONOMETRY TABLES
+# ==============================
+
+@jit(nopython=True, nogil=True, cache=True)
+def _sin_cos(angles):
+    """sin/cos of an array with the same libm calls the kernels use"""
+    n = len(angles)
+    s = np.empty(n, dtype=np.float64)
+    c = np.empty(n, dtype=np.float64)
+    for i in range(n):
+        s[i] = math.sin(angles[i])
+        c[i] = math.cos(angles[i])
+    return s, c
+
+
+class SourceTable(NamedTuple):
+    """Per-source quantities precomputed once for the table-driven kernels"""
+    lat: np.ndarray
+    lon: np.ndarray
+    sin_lat: np.ndarray
+    cos_lat: np.ndarray
+    sin_lon: np.ndarray
+    cos_lon: np.ndarray
+    r_mid: np.ndarray
+    dr2_24: np.ndarray
+    weight: np.ndarray
+    cls: np.ndarray
+    dr: np.ndarray
+    grho: np.ndarray
+
+    def take(self, order):
+        """Return a copy of the table with the sources reordered/subset by ``order``"""
+        return SourceTable(*[np.ascontiguousarray(col[order]) for col in self])
+
+
+class ObservationTable(NamedTuple):
+    """Per-observation coordinates and sin/cos values"""
+    lat: np.ndarray
+    lon: np.ndarray
+    sin_lat: np.ndarray
+    cos_lat: np.ndarray
+    sin_lon: np.ndarray
+    cos_lon: np.ndarray
+
+    def slice(self, s, e):
+        """Observations s:e as a new table (views, no copies)"""
+        return ObservationTable(*[col[s:e] for col in self])
+
+    def take(self, idx):
+        """Observations ``idx`` as a new, contiguous table"""
+        return ObservationTable(*[np.ascontiguousarray(col[idx]) for col in self])
+
+
+def build_source_table(src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho, dlat, dlon,
+                       src_class=None):
+    """Precompute sin/cos and mass factors for every valid source tesseroid.
+
+    Sources with NaN radii are dropped, which is what compute_potential_batch
+    does for them on every observation. ``src_class`` tags each source with
+    the output column it contributes to (all zeros by default).
+    """
+    src_lats_rad = np.asarray(src_lats_rad, dtype=np.float64)
+    src_lons_rad = np.asarray(src_lons_rad, dtype=np.float64)
+    src_r1 = np.asarray(src_r1, dtype=np.float64)
+    src_r2 = np.asarray(src_r2, dtype=np.float64)
+    src_rho = np.asarray(src_rho, dtype=np.float64)
+    keep = np.isfinite(src_r1) & np.isfinite(src_r2)
+    lat = np.ascontiguousarray(src_lats_rad[keep])
+    lon = np.ascontiguousarray(src_lons_rad[keep])
+    r1 = src_r1[keep]
+    r2 = src_r2[keep]
+    r_mid = 0.5 * (r1 + r2)
+    dr = r2 - r1
+    sin_lat, cos_lat = _sin_cos(lat)
+    sin_lon, cos_lon = _sin_cos(lon)
+    weight = G * src_rho[keep] * (r_mid * r_mid * np.maximum(cos_lat, 0.0) * dr * dlat * dlon)
+    if src_class is None:
+        cls = np.zeros(len(lat), dtype=np.int64)
+    else:
+        cls = np.ascontiguousarray(np.asarray(src_class, dtype=np.int64)[keep])
+    return SourceTable(lat, lon, sin_lat, cos_lat, sin_lon, cos_lon,
+                       r_mid, dr * dr / 24.0, weight, cls, dr, G * src_rho[keep])
+
+
+def build_observation_table(obs_lats_rad, obs_lons_rad):
+    """Precompute sin/cos of latitude and longitude for observation points"""
+    obs_lats_rad = np.ascontiguousarray(obs_lats_rad, dtype=np.float64)
+    obs_lons_rad = np.ascontiguousarray(obs_lons_rad, dtype=np.float64)
+    sin_lat, cos_lat = _sin_cos(obs_lats_rad)
+    sin_lon, cos_lon = _sin_cos(obs_lons_rad)
+    return ObservationTable(obs_lats_rad, obs_lons_rad, sin_lat, cos_lat, sin_lon, cos_lon)
+
+
+# ==============================
+# SPATIAL INDEX
+# ==============================
+
+class SourceIndex(NamedTuple):
+    """Sources bucketed into latitude bands and sorted by longitude inside each band.
+
+    ``table`` holds the sources in index order, band ``b`` owns
+    ``table[band_start[b]:band_start[b + 1]]`` and ``lon_key`` is the source
+    longitude wrapped to [-pi, pi) used for the binary searches. Sources that
+    share a grid cell are adjacent; ``same_cell[k]`` is True when source ``k``
+    has the same position as source ``k - 1`` so kernels can reuse its geometry.
+    """
+    table: SourceTable
+    lon_key: np.ndarray
+    band_start: np.ndarray
+    band_lat0: float
+    band_width: float
+    same_cell: np.ndarray
+
+
+def wrap_longitude(lon_rad):
+    """Wrap longitudes (radians) to [-pi, pi)"""
+    return (np.asarray(lon_rad, dtype=np.float64) + np.pi) % (2.0 * np.pi) - np.pi
+
+
+def build_source_index(table, cutoff_rad, dlat=0.0):
+    """Bucket a SourceTable into latitude bands for cap queries of radius ``cutoff_rad``.
+
+    Bands are about cutoff/16 wide (never thinner than one grid row) so a query
+    touches ~32 bands and, inside each, only the longitude range of the cap.
+    """
+    band_width = max(cutoff_rad / 16.0, dlat, 1e-6)
+    n_src = len(table.lat)
+    if n_src == 0:
+        return SourceIndex(table, np.empty(0, dtype=np.float64),
+                           np.zeros(1, dtype=np.int64), 0.0, band_width, np.zeros(0, dtype=np.bool_))
+    band_lat0 = float(table.lat.min())
+    band = np.floor((table.lat - band_lat0) / band_width).astype(np.int64)
+    lon_key = wrap_longitude(table.lon)
+    order = np.lexsort((table.lat, lon_key, band))
+    band = band[order]
+    n_bands = int(band[-1]) + 1
+    band_start = np.searchsorted(band, np.arange(n_bands + 1)).astype(np.int64)
+    table = table.take(order)
+    same_cell = np.zeros(n_src, dtype=np.bool_)
+    same_cell[1:] = (table.lat[1:] == table.lat[:-1]) & (table.lon[1:] == table.lon[:-1])
+    return SourceIndex(table, np.ascontiguousarray(lon_key[order]),
+                       band_start, band_lat0, band_width, same_cell)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _cap_lon_halfwidth(cos_lat_o, lat_o, cutoff_rad):
+    """Largest |delta lon| of a point within ``cutoff_rad`` of latitude ``lat_o`` (pi if the cap holds a pole)"""
+    if abs(lat_o) + cutoff_rad >= 0.5 * math.pi or cos_lat_o <= 0.0:
+        return math.pi
+    s = math.sin(cutoff_rad) / cos_lat_o
+    if s >= 1.0:
+        return math.pi
+    return math.asin(s) + 1e-9
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _band_segments(lon_key, s0, s1, lon_c, half):
+    """Index ranges of a band's sorted longitudes inside [lon_c - half, lon_c + half] (wrapped)
+
+    Returns up to two (start, end) pairs; unused pairs are empty.
+    """
+    if half >= math.pi:
+        return s0, s1, s1, s1
+    lo = lon_c - half
+    hi = lon_c + half
+    band = lon_key[s0:s1]
+    a0 = s0 + np.searchsorted(band, max(lo, -math.pi), side='left')
+    a1 = s0 + np.searchsorted(band, min(hi, math.pi), side='right')
+    b0 = s1
+    b1 = s1
+    if lo < -math.pi:
+        b0 = s0 + np.searchsorted(band, lo + 2.0 * math.pi, side='left')
+    elif hi >= math.pi:
+        b0 = s0
+        b1 = s0 + np.searchsorted(band, hi - 2.0 * math.pi, side='right')
+    return a0, a1, b0, b1
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def compute_potential_batch_indexed(obs_lats_rad, obs_lons_rad, obs_sin_lat, obs_cos_lat,
+                                    obs_sin_lon, obs_cos_lon, obs_radii,
+                                    lon_key, band_start, band_lat0, band_width, same_cell,
+                                    src_lons_rad, src_sin_lat, src_cos_lat, src_sin_lon, src_cos_lon,
+                                    src_r_mid, src_dr2_24, src_weight, src_class, src_dr, src_grho,
+                                    dlat, dlon, dlat2_24, dlon2_24, cutoff_rad, cos_cutoffs,
+                                    split_ratio, max_depth, counts, results):
+    """Table-driven kernel that only visits sources in the latitude bands/longitude
+    ranges that can fall inside the cutoff cap of each observation.
+
+    Each source adds to column ``src_class[ss]`` of ``results`` (n_obs x n_classes)
+    and is tested against that class's cutoff ``cos_cutoffs[src_class[ss]]``;
+    ``cutoff_rad`` is the largest of the class cutoffs. Evaluating several
+    source sets in one call shares the observation geometry between them, and
+    sources on the same cell (``same_cell``) reuse cos(psi), psi and sin(psi).
+    Near-field subdivision and ``counts`` work as in compute_potential_batch_trig.
+    """
+    n_obs = len(obs_radii)
+    n_bands = len(band_start) - 1
+    n_classes = results.shape[1]
+    cutoff_min_cos = cos_cutoffs.min()
+    refine = split_ratio > 0.0 and max_depth > 0
+    for ii in prange(n_obs):
+        ro = obs_radii[ii]
+        if np.isnan(ro):
+            for cc in range(n_classes):
+                results[ii, cc] = np.nan
+            continue
+        lat_o = obs_lats_rad[ii]
+        lon_o = obs_lons_rad[ii]
+        slo = obs_sin_lat[ii]
+        clo = obs_cos_lat[ii]
+        sino = obs_sin_lon[ii]
+        coso = obs_cos_lon[ii]
+        b_lo = int(math.floor((lat_o - cutoff_rad - band_lat0) / band_width))
+        b_hi = int(math.floor((lat_o + cutoff_rad - band_lat0) / band_width))
+        if b_lo < 0:
+            b_lo = 0
+        if b_hi > n_bands - 1:
+            b_hi = n_bands - 1
+        half = _cap_lon_halfwidth(clo, lat_o, cutoff_rad)
+        lon_c = (lon_o + math.pi) % (2.0 * math.pi) - math.pi
+        for cc in range(n_classes):
+            results[ii, cc] = 0.0
+        stack = np.empty((7 * max_depth + 1 if refine else 1, 9))
+        n_pairs = 0
+        n_split = 0
+        n_eval = 0
+        for bb in range(b_lo, b_hi + 1):
+            a0, a1, c0, c1 = _band_segments(lon_key, band_start[bb], band_start[bb + 1], lon_c, half)
+            for seg in range(2):
+                if seg == 0:
+                    s0 = a0
+                    s1 = a1
+                else:
+                    s0 = c0
+                    s1 = c1
+                cos_psi = 0.0
+                c_psi = 0.0
+                psi = 0.0
+                sin_psi = 0.0
+                for ss in range(s0, s1):
+                    if ss == s0 or not same_cell[ss]:
+                        if src_lons_rad[ss] == lon_o:
+                            cos_dlon = 1.0
+                        else:
+                            cos_dlon = coso * src_cos_lon[ss] + sino * src_sin_lon[ss]
+                        cos_psi = slo * src_sin_lat[ss] + clo * src_cos_lat[ss] * cos_dlon
+                        if cos_psi >= cutoff_min_cos:
+                            c_psi, psi, sin_psi = _psi_terms(cos_psi)
+                    cls = src_class[ss]
+                    if cos_psi < cos_cutoffs[cls]:
+                        continue
+                    if refine and _needs_split(ro, src_r_mid[ss], cos_psi, src_dr[ss], src_cos_lat[ss],
+                                               dlat, dlon, split_ratio):
+                        pot, n = _subdivided_potential(slo, clo, sino, coso, ro, src_sin_lat[ss],
+                                                       src_cos_lat[ss], src_sin_lon[ss], src_cos_lon[ss],
+                                                       src_r_mid[ss], src_dr[ss], dlat, dlon, src_grho[ss],
+                                                       split_ratio, max_depth, stack)
+                        results[ii, cls] += pot
+                        n_split += 1
+                        n_eval += n
+                        continue
+                    results[ii, cls] += src_weight[ss] * _kernel_from_geometry(
+                        c_psi, psi, sin_psi, ro, src_r_mid[ss], src_dr2_24[ss], dlat2_24, dlon2_24)
+                    n_pairs += 1
+        counts[ii, 0] = n_pairs
+        counts[ii, 1] = n_split
+        counts[ii, 2] = n_eval
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def count_cap_candidates(obs_lats_rad, obs_lons_rad, obs_cos_lat, lon_key, band_start, band_lat0,
+                         band_width, cutoff_rad, out):
+    """Number of sources compute_potential_batch_indexed visits for every observation"""
+    n_bands = len(band_start) - 1
+    for ii in prange(len(obs_lats_rad)):
+        lat_o = obs_lats_rad[ii]
+        b_lo = int(math.floor((lat_o - cutoff_rad - band_lat0) / band_width))
+        b_hi = int(math.floor((lat_o + cutoff_rad - band_lat0) / band_width))
+        if b_lo < 0:
+            b_lo = 0
+        if b_hi > n_bands - 1:
+            b_hi = n_bands - 1
+        half = _cap_lon_halfwidth(obs_cos_lat[ii], lat_o, cutoff_rad)
+        lon_c = (obs_lons_rad[ii] + math.pi) % (2.0 * math.pi) - math.pi
+        n = 0
+        for bb in range(b_lo, b_hi + 1):
+            a0, a1, c0, c1 = _band_segments(lon_key, band_start[bb], band_start[bb + 1], lon_c, half)
+            n += (a1 - a0) + (c1 - c0)
+        out[ii] = n
+
+
+# ==============================
+# REGULAR-GRID MODE
+# ==============================
+
+def _kernel_terms(cos_psi, r_obs, r_t, dlat2_24, dlon2_24):
+    """Vectorised _kernel_from_cos_psi split into the dr-independent part and K200.
+
+    Returns (A, B) with K = A + dr^2/24 * B.
+    """
+    cos_psi = np.clip(cos_psi, -1.0, 1.0)
+    l0_sq = r_obs * r_obs + r_t * r_t - 2.0 * r_obs * r_t * cos_psi
+    ok = l0_sq > 0.0
+    l0_sq = np.where(ok, l0_sq, 1.0)
+    l0 = np.maximum(np.sqrt(l0_sq), 1e-12)
+    l0_5 = l0_sq * l0_sq * l0
+    sin_psi = np.sqrt(1.0 - cos_psi * cos_psi)
+    psi = np.arccos(cos_psi)
+    lateral = sin_psi > 1e-12
+    K020 = np.where(lateral, (3.0 * (r_t * psi) ** 2 - l0_sq) / l0_5, 0.0)
+    K002 = np.where(lateral, (3.0 * (r_t * sin_psi) ** 2 - l0_sq) / l0_5, 0.0)
+    A = np.where(ok, 1.0 / l0 + dlat2_24 * K020 + dlon2_24 * K002, 0.0)
+    B = np.where(ok, (3.0 * (r_obs - r_t * cos_psi) ** 2 - l0_sq) / l0_5, 0.0)
+    return A, B
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _near_field_regular(lats_rad, lons_rad, obs_radii, has_src, r_mid, dr2_24, weight, dr, grho,
+                        near_cells, periodic, dlat, dlon, dlat2_24, dlon2_24, cos_cutoff,
+                        split_ratio, max_depth, counts, out):
+    """Exact kernel over the (2n+1)x(2n+1) cells around every observation cell,
+    with near-field subdivision as in compute_potential_batch_trig"""
+    nlat, nlon = obs_radii.shape
+    refine = split_ratio > 0.0 and max_depth > 0
+    for i in prange(nlat):
+        slo = math.sin(lats_rad[i])
+        clo = math.cos(lats_rad[i])
+        stack = np.empty((7 * max_depth + 1 if refine else 1, 9))
+        for j in range(nlon):
+            ro = obs_radii[i, j]
+            if np.isnan(ro):
+                continue
+            pot_sum = 0.0
+            for di in range(-near_cells, near_cells + 1):
+                k = i + di
+                if k < 0 or k >= nlat:
+                    continue
+                sls = math.sin(lats_rad[k])
+                cls = math.cos(lats_rad[k])
+                for dj in range(-near_cells, near_cells + 1):
+                    m = j + dj
+                    if periodic:
+                        m = m % nlon
+                    elif m < 0 or m >= nlon:
+                        continue
+                    if not has_src[k, m]:
+                        continue
+                    cos_psi = slo * sls + clo * cls * math.cos(lons_rad[j] - lons_rad[m])
+                    if cos_psi < cos_cutoff:
+                        continue
+                    if refine and _needs_split(ro, r_mid[k, m], cos_psi, dr[k, m], cls, dlat, dlon, split_ratio):
+                        dlon_o = lons_rad[j] - lons_rad[m]
+                        pot, n = _subdivided_potential(slo, clo, math.sin(dlon_o), math.cos(dlon_o), ro,
+                                                       sls, cls, 0.0, 1.0, r_mid[k, m], dr[k, m],
+                                                       dlat, dlon, grho[k, m], split_ratio, max_depth, stack)
+                        pot_sum += pot
+                        counts[i, j, 1] += 1
+                        counts[i, j, 2] += n
+                        continue
+                    pot_sum += weight[k, m] * _kernel_from_cos_psi(cos_psi, ro, r_mid[k, m],
+                                                                   dr2_24[k, m], dlat2_24, dlon2_24)
+                    counts[i, j, 0] += 1
+            out[i, j] += pot_sum
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _convolve_rows_direct(mass, mass_dr, A, B, offsets, periodic, out_row):
+    """out_row[j] += sum_k sum_t A[k,t]*mass[k,j-offsets[t]] + B[k,t]*mass_dr[k,j-offsets[t]]"""
+    n_rows, nlon = mass.shape
+    for k in range(n_rows):
+        for t in range(len(offsets)):
+            a = A[k, t]
+            b = B[k, t]
+            if a == 0.0 and b == 0.0:
+                continue
+            off = offsets[t]
+            for j in range(nlon):
+                jj = j - off
+                if periodic:
+                    jj = jj % nlon
+                elif jj < 0 or jj >= nlon:
+                    continue
+                out_row[j] += a * mass[k, jj] + b * mass_dr[k, jj]
+
+
+def compute_potential_regular_grid(lats_rad, lons_rad, obs_radii_grid,
+                                   src_rows, src_cols, src_r1, src_r2, src_rho,
+                                   dlat, dlon, cos_cutoff, near_cells=2,
+                                   progress_callback=None, split_ratio=0.0, max_depth=3, counts=None):
+    """Potential on a regular lon/lat grid using the longitude invariance of the geometry.
+
+    On a regular grid cos(psi) between an observation row and a source row only
+    depends on the longitude offset, so each (obs-row, src-row, delta-lon)
+    kernel is evaluated once and applied as a 1-D convolution along longitude
+    (FFT or direct, whichever is cheaper for the cap width). The far-field
+    kernel uses one reference radius per row (mean observation radius, mean
+    source mid-radius); cells within ``near_cells`` rows/columns of the
+    observation are evaluated exactly per source, so the approximation only
+    affects distant sources, where the relative error is of order
+    (height difference / distance)^2. Sources must sit on grid cells, at most
+    one per cell. Near-field cells are subdivided as in compute_potential;
+    ``counts`` is an optional (nlat, nlon, 3) int64 array for the near-field
+    statistics (see compute_potential_batch_trig).
+
+    ``progress_callback(done_rows, n_rows)`` is called after every observation row.
+    Returns the (nlat, nlon) potential grid (NaN where the radius is NaN).
+    """
+    lats_rad = np.ascontiguousarray(lats_rad, dtype=np.float64)
+    lons_rad = np.ascontiguousarray(lons_rad, dtype=np.float64)
+    obs_radii_grid = np.ascontiguousarray(obs_radii_grid, dtype=np.float64)
+    nlat, nlon = obs_radii_grid.shape
+    dlat2_24 = dlat * dlat / 24.0
+    dlon2_24 = dlon * dlon / 24.0
+    cutoff_rad = math.acos(min(1.0, max(-1.0, cos_cutoff)))
+    lon_step = (lons_rad[-1] - lons_rad[0]) / (nlon - 1) if nlon > 1 else dlon
+    periodic = nlon > 1 and abs(nlon * lon_step - 2.0 * np.pi) < 0.5 * lon_step
+
+    # Scatter sources onto the grid
+    src_rows = np.asarray(src_rows, dtype=np.int64)
+    src_cols = np.asarray(src_cols, dtype=np.int64)
+    src_r1 = np.asarray(src_r1, dtype=np.float64)
+    src_r2 = np.asarray(src_r2, dtype=np.float64)
+    keep = np.isfinite(src_r1) & np.isfinite(src_r2)
+    src_rows, src_cols = src_rows[keep], src_cols[keep]
+    r1, r2 = src_r1[keep], src_r2[keep]
+    rho = np.asarray(src_rho, dtype=np.float64)[keep]
+    has_src = np.zeros((nlat, nlon), dtype=np.bool_)
+    has_src[src_rows, src_cols] = True
+    if has_src.sum() != len(src_rows):
+        raise ValueError("Regular-grid mode needs at most one source tesseroid per grid cell")
+    r_mid = np.zeros((nlat, nlon))
+    dr2_24 = np.zeros((nlat, nlon))
+    weight = np.zeros((nlat, nlon))
+    dr_grid = np.zeros((nlat, nlon))
+    grho = np.zeros((nlat, nlon))
+    r_mid[src_rows, src_cols] = 0.5 * (r1 + r2)
+    dr = r2 - r1
+    dr_grid[src_rows, src_cols] = dr
+    grho[src_rows, src_cols] = G * rho
+    dr2_24[src_rows, src_cols] = dr * dr / 24.0
+    cos_lat_src = np.maximum(np.cos(lats_rad[src_rows]), 0.0)
+    weight[src_rows, src_cols] = G * rho * (r_mid[src_rows, src_cols] ** 2 * cos_lat_src * dr * dlat * dlon)
+    mass_dr = weight * dr2_24
+
+    potentials = np.zeros((nlat, nlon))
+    if counts is None:
+        counts = np.zeros((nlat, nlon, 3), dtype=np.int64)
+    _near_field_regular(lats_rad, lons_rad, obs_radii_grid, has_src, r_mid, dr2_24, weight, dr_grid, grho,
+                        int(near_cells), periodic, dlat, dlon, dlat2_24, dlon2_24, cos_cutoff,
+                        float(split_ratio), int(max_depth), counts, potentials)
+
+    # Row reference radii for the far field
+    src_count = has_src.sum(axis=1)
+    src_rows_used = np.nonzero(src_count)[0]
+    ref_src = np.zeros(nlat)
+    ref_src[src_rows_used] = r_mid[src_rows_used].sum(axis=1) / src_count[src_rows_used]
+    with np.errstate(all='ignore'):
+        ref_obs = np.nanmean(obs_radii_grid, axis=1)
+
+    if periodic:
+        L = nlon
+        offsets = np.arange(nlon)
+        col_dist = np.minimum(offsets, nlon - offsets)
+    else:
+        L = 2 * nlon - 1
+        offsets = np.concatenate([np.arange(nlon), np.arange(-(nlon - 1), 0)])
+        col_dist = np.abs(offsets)
+    # rfft of the source rows, computed once and reused for every observation row
+    n_fft = L if periodic else _next_fast_len(L)
+    mass_f = None
+    mass_dr_f = None
+    cos_dlon = np.cos(offsets * lon_step)
+    sin_lat = np.sin(lats_rad)
+    cos_lat = np.cos(lats_rad)
+
+    for i in range(nlat):
+        if not np.isfinite(ref_obs[i]) or len(src_rows_used) == 0:
+            if progress_callback is not None:
+                progress_callback(i + 1, nlat)
+            continue
+        band = src_rows_used[np.abs(lats_rad[src_rows_used] - lats_rad[i]) <= cutoff_rad + 1e-12]
+        if len(band):
+            cos_psi = (sin_lat[i] * sin_lat[band, None] +
+                       cos_lat[i] * cos_lat[band, None] * cos_dlon[None, :])
+            A, B = _kernel_terms(cos_psi, ref_obs[i], ref_src[band, None], dlat2_24, dlon2_24)
+            far = (cos_psi >= cos_cutoff) & ~((np.abs(band - i)[:, None] <= near_cells) &
+                                              (col_dist[None, :] <= near_cells))
+            A = np.where(far, A, 0.0)
+            B = np.where(far, B, 0.0)
+            active = np.nonzero(far.any(axis=0))[0]
+            taps = len(active)
+            if taps and taps <= 4 * math.log2(max(n_fft, 2)):
+                row = np.zeros(nlon)
+                _convolve_rows_direct(_take_rows(weight, band), _take_rows(mass_dr, band),
+                                      np.ascontiguousarray(A[:, active]),
+                                      np.ascontiguousarray(B[:, active]),
+                                      offsets[active].astype(np.int64), periodic, row)
+                potentials[i] += row
+            elif taps:
+                if mass_f is None:
+                    mass_f = np.fft.rfft(weight, n=n_fft, axis=1)
+                    mass_dr_f = np.fft.rfft(mass_dr, n=n_fft, axis=1)
+                kern_a = np.zeros((len(band), n_fft))
+                kern_b = np.zeros((len(band), n_fft))
+                kern_a[:, offsets % n_fft] = A
+                kern_b[:, offsets % n_fft] = B
+                spec = (np.fft.rfft(kern_a, axis=1) * mass_f[band] +
+                        np.fft.rfft(kern_b, axis=1) * mass_dr_f[band]).sum(axis=0)
+                potentials[i] += np.fft.irfft(spec, n=n_fft)[:nlon]
+        if progress_callback is not None:
+            progress_callback(i + 1, nlat)
+
+    potentials[np.isnan(obs_radii_grid)] = np.nan
+    return potentials
+
+
+def _take_rows(grid, rows):
+    """Contiguous copy of the selected grid rows"""
+    return np.ascontiguousarray(grid[rows])
+
+
+def _next_fast_len(n):
+    """Smallest 2^a 3^b 5^c >= n (a fast FFT length)"""
+    best = 1 << max(0, int(n - 1).bit_length())
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+# ==============================
+# TREECODE FAR FIELD
+# ==============================
+
+class SourceTree(NamedTuple):
+    """Quadtree of source blocks for the Barnes-Hut far-field kernel.
+
+    Sources are sorted along a Morton (Z-order) curve of their grid cells, so
+    every node owns the contiguous range ``table[start:end]``. Nodes are
+    stored level by level from the roots down; ``child0:child1`` are the
+    node's children (``child0 == -1`` for leaves). Per node, ``centre`` is the
+    |mass|-weighted centroid (Cartesian, metres), ``direction`` its unit
+    vector, ``mass``, ``dipole`` and ``quadrupole`` (xx, yy, zz, xy, xz, yz)
+    the multipole moments about the centroid (already multiplied by G; the
+    quadrupole includes the extent of each tesseroid, which is what the
+    second-order terms of the exact kernel describe), ``radius`` bounds the
+    distance from the centroid to any point of its tesseroids and
+    ``ang_radius`` the angle between ``direction`` and any source centre.
+    """
+    table: SourceTable
+    start: np.ndarray
+    end: np.ndarray
+    child0: np.ndarray
+    child1: np.ndarray
+    roots: np.ndarray
+    n_levels: int
+    centre: np.ndarray
+    direction: np.ndarray
+    mass: np.ndarray
+    dipole: np.ndarray
+    quadrupole: np.ndarray
+    radius: np.ndarray
+    ang_radius: np.ndarray
+
+
+def _spread_bits(v):
+    """Interleave zeros between the bits of 32-bit unsigned integers (Morton encoding)"""
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _tree_node_moments(start, end, src_x, src_y, src_z, src_extent, src_second, src_weight,
+                       centre, direction, mass, dipole, quadrupole, radius, ang_radius):
+    """Multipole moments and bounding radii of every node from its member sources.
+
+    ``src_second`` holds the second moments of each tesseroid about its own
+    centre (xx, yy, zz, xy, xz, yz, per unit mass).
+    """
+    for nd in prange(len(start)):
+        s = start[nd]
+        e = end[nd]
+        m = 0.0
+        wsum = 0.0
+        cx = 0.0
+        cy = 0.0
+        cz = 0.0
+        for k in range(s, e):
+            w = abs(src_weight[k])
+            m += src_weight[k]
+            wsum += w
+            cx += w * src_x[k]
+            cy += w * src_y[k]
+            cz += w * src_z[k]
+        if wsum > 0.0:
+            cx /= wsum
+            cy /= wsum
+            cz /= wsum
+        else:
+            for k in range(s, e):
+                cx += src_x[k]
+                cy += src_y[k]
+                cz += src_z[k]
+            cx /= e - s
+            cy /= e - s
+            cz /= e - s
+        norm = math.sqrt(cx * cx + cy * cy + cz * cz)
+        ux = cx / norm
+        uy = cy / norm
+        uz = cz / norm
+        px = 0.0
+        py = 0.0
+        pz = 0.0
+        sxx = 0.0
+        syy = 0.0
+        szz = 0.0
+        sxy = 0.0
+        sxz = 0.0
+        syz = 0.0
+        rad = 0.0
+        min_cos = 1.0
+        for k in range(s, e):
+            dx = src_x[k] - cx
+            dy = src_y[k] - cy
+            dz = src_z[k] - cz
+            px += src_weight[k] * dx
+            py += src_weight[k] * dy
+            pz += src_weight[k] * dz
+            w = src_weight[k]
+            sxx += w * (dx * dx + src_second[k, 0])
+            syy += w * (dy * dy + src_second[k, 1])
+            szz += w * (dz * dz + src_second[k, 2])
+            sxy += w * (dx * dy + src_second[k, 3])
+            sxz += w * (dx * dz + src_second[k, 4])
+            syz += w * (dy * dz + src_second[k, 5])
+            rk = math.sqrt(dx * dx + dy * dy + dz * dz) + src_extent[k]
+            if rk > rad:
+                rad = rk
+            rn = math.sqrt(src_x[k] * src_x[k] + src_y[k] * src_y[k] + src_z[k] * src_z[k])
+            c = (ux * src_x[k] + uy * src_y[k] + uz * src_z[k]) / rn
+            if c < min_cos:
+                min_cos = c
+        centre[nd, 0] = cx
+        centre[nd, 1] = cy
+        centre[nd, 2] = cz
+        direction[nd, 0] = ux
+        direction[nd, 1] = uy
+        direction[nd, 2] = uz
+        mass[nd] = m
+        dipole[nd, 0] = px
+        dipole[nd, 1] = py
+        dipole[nd, 2] = pz
+        # Traceless quadrupole Q = 3 S - tr(S) I
+        trace = sxx + syy + szz
+        quadrupole[nd, 0] = 3.0 * sxx - trace
+        quadrupole[nd, 1] = 3.0 * syy - trace
+        quadrupole[nd, 2] = 3.0 * szz - trace
+        quadrupole[nd, 3] = 3.0 * sxy
+        quadrupole[nd, 4] = 3.0 * sxz
+        quadrupole[nd, 5] = 3.0 * syz
+        radius[nd] = rad
+        ang_radius[nd] = math.acos(max(-1.0, min(1.0, min_cos)))
+
+
+def build_source_tree(table, dlat, dlon, leaf_level=1, max_roots=64):
+    """Build the SourceTree of a SourceTable on a (roughly) regular lat/lon grid.
+
+    Leaves are blocks of up to 2**leaf_level x 2**leaf_level cells; levels are
+    merged 2x2 at a time until at most ``max_roots`` blocks remain.
+    """
+    n_src = len(table.lat)
+    lat_idx = np.rint((table.lat - (table.lat.min() if n_src else 0.0)) / max(dlat, 1e-12)).astype(np.int64)
+    lon_key = wrap_longitude(table.lon)
+    lon_idx = np.rint((lon_key - (lon_key.min() if n_src else 0.0)) / max(dlon, 1e-12)).astype(np.int64)
+    morton = _spread_bits(lat_idx) | (_spread_bits(lon_idx) << np.uint64(1))
+    order = np.argsort(morton, kind="stable")
+    morton = morton[order]
+    table = table.take(order)
+
+    # Node ranges per level, leaves first
+    levels = []
+    level = leaf_level
+    while True:
+        keys = morton >> np.uint64(2 * level)
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if n_src else np.zeros(0, dtype=np.int64)
+        levels.append(starts.astype(np.int64))
+        if len(starts) <= max_roots or (n_src and keys[-1] == keys[0]):
+            break
+        level += 1
+
+    # Store roots first so that node ids of a level are contiguous
+    levels = levels[::-1]
+    offsets = np.cumsum([0] + [len(s) for s in levels])
+    start = np.concatenate(levels) if levels else np.zeros(0, dtype=np.int64)
+    end = np.concatenate([np.r_[s[1:], n_src] for s in levels]).astype(np.int64)
+    child0 = np.full(len(start), -1, dtype=np.int64)
+    child1 = np.full(len(start), -1, dtype=np.int64)
+    for lv in range(len(levels) - 1):
+        parent = slice(offsets[lv], offsets[lv + 1])
+        children = levels[lv + 1]
+        child0[parent] = offsets[lv + 1] + np.searchsorted(children, start[parent])
+        child1[parent] = offsets[lv + 1] + np.searchsorted(children, end[parent])
+
+    src_x = table.r_mid * table.cos_lat * table.cos_lon
+    src_y = table.r_mid * table.cos_lat * table.sin_lon
+    src_z = table.r_mid * table.sin_lat
+    # Half diagonal of each tesseroid: lumping it into a point is part of the far-field error
+    src_extent = 0.5 * np.sqrt((table.r_mid * dlat) ** 2 + (table.r_mid * table.cos_lat * dlon) ** 2 +
+                               24.0 * table.dr2_24)
+    # Radial second moment of each tesseroid (uniform box: dr^2 / 12) rotated
+    # to Cartesian coordinates. Only the radial axis is kept: the lateral
+    # second-order terms of the exact kernel are negligible next to it, and
+    # adding box moments along north/east would move the far field away from
+    # what the leaves evaluate.
+    s_r = 2.0 * table.dr2_24
+    e_r = np.stack([table.cos_lat * table.cos_lon, table.cos_lat * table.sin_lon, table.sin_lat])
+    src_second = np.empty((n_src, 6), dtype=np.float64)
+    for col, (a, b) in enumerate(((0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2))):
+        src_second[:, col] = s_r * e_r[a] * e_r[b]
+
+    n_nodes = len(start)
+    centre = np.empty((n_nodes, 3), dtype=np.float64)
+    direction = np.empty((n_nodes, 3), dtype=np.float64)
+    mass = np.empty(n_nodes, dtype=np.float64)
+    dipole = np.empty((n_nodes, 3), dtype=np.float64)
+    quadrupole = np.empty((n_nodes, 6), dtype=np.float64)
+    radius = np.empty(n_nodes, dtype=np.float64)
+    ang_radius = np.empty(n_nodes, dtype=np.float64)
+    _tree_node_moments(start, end, src_x, src_y, src_z, src_extent, src_second, table.weight,
+                       centre, direction, mass, dipole, quadrupole, radius, ang_radius)
+    roots = np.arange(offsets[1] if levels else 0, dtype=np.int64)
+    return SourceTree(table, start, end, child0, child1, roots, len(levels),
+                      centre, direction, mass, dipole, quadrupole, radius, ang_radius)
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def compute_potential_batch_tree(obs_lons_rad, obs_sin_lat, obs_cos_lat, obs_sin_lon, obs_cos_lon, obs_radii,
+                                 node_start, node_end, node_child0, node_child1, roots,
+                                 node_centre, node_direction, node_mass, node_dipole, node_quadrupole,
+                                 node_radius, node_ang_radius,
+                                 src_lons_rad, src_sin_lat, src_cos_lat, src_sin_lon, src_cos_lon,
+                                 src_r_mid, src_dr2_24, src_weight, src_dr, src_grho,
+                                 dlat, dlon, dlat2_24, dlon2_24, cutoff_rad, cos_cutoff, tolerance, stack,
+                                 split_ratio, max_depth, counts, results):
+    """Barnes-Hut potential for a batch of observations.
+
+    A node entirely inside the cutoff cap is replaced by its multipole
+    expansion (up to the quadrupole) when (radius / distance)^3 <= tolerance,
+    the order of the relative error of that block; otherwise it is opened, down to the leaves whose
+    sources use the exact kernel. Nodes entirely outside the cap are skipped.
+    ``stack`` is scratch space of shape (n_obs, len(roots) + 4 * n_levels).
+    Near-field subdivision and ``counts`` work as in compute_potential_batch_trig.
+    """
+    n_obs = len(obs_radii)
+    refine = split_ratio > 0.0 and max_depth > 0
+    for ii in prange(n_obs):
+        ro = obs_radii[ii]
+        if np.isnan(ro):
+            results[ii] = np.nan
+            continue
+        lon_o = obs_lons_rad[ii]
+        slo = obs_sin_lat[ii]
+        clo = obs_cos_lat[ii]
+        sino = obs_sin_lon[ii]
+        coso = obs_cos_lon[ii]
+        ux = clo * coso
+        uy = clo * sino
+        uz = slo
+        ox = ro * ux
+        oy = ro * uy
+        oz = ro * uz
+        pot_sum = 0.0
+        split_stack = np.empty((7 * max_depth + 1 if refine else 1, 9))
+        n_pairs = 0
+        n_split = 0
+        n_eval = 0
+        top = 0
+        for k in range(len(roots)):
+            stack[ii, top] = roots[k]
+            top += 1
+        while top > 0:
+            top -= 1
+            nd = stack[ii, top]
+            c = ux * node_direction[nd, 0] + uy * node_direction[nd, 1] + uz * node_direction[nd, 2]
+            psi = math.acos(max(-1.0, min(1.0, c)))
+            a = node_ang_radius[nd]
+            if psi - a > cutoff_rad:
+                continue
+            if psi + a <= cutoff_rad:
+                lx = ox - node_centre[nd, 0]
+                ly = oy - node_centre[nd, 1]
+                lz = oz - node_centre[nd, 2]
+                l2 = lx * lx + ly * ly + lz * lz
+                rad = node_radius[nd]
+                if rad * rad * rad <= tolerance * l2 * math.sqrt(l2):
+                    inv_l = 1.0 / math.sqrt(l2)
+                    inv_l3 = inv_l * inv_l * inv_l
+                    dip = node_dipole[nd, 0] * lx + node_dipole[nd, 1] * ly + node_dipole[nd, 2] * lz
+                    quad = (node_quadrupole[nd, 0] * lx * lx + node_quadrupole[nd, 1] * ly * ly +
+                            node_quadrupole[nd, 2] * lz * lz +
+                            2.0 * (node_quadrupole[nd, 3] * lx * ly + node_quadrupole[nd, 4] * lx * lz +
+                                   node_quadrupole[nd, 5] * ly * lz))
+                    pot_sum += node_mass[nd] * inv_l + dip * inv_l3 + 0.5 * quad * inv_l3 * inv_l * inv_l
+                    continue
+            if node_child0[nd] >= 0:
+                for ch in range(node_child0[nd], node_child1[nd]):
+                    stack[ii, top] = ch
+                    top += 1
+                continue
+            for ss in range(node_start[nd], node_end[nd]):
+                if src_lons_rad[ss] == lon_o:
+                    cos_dlon = 1.0
+                else:
+                    cos_dlon = coso * src_cos_lon[ss] + sino * src_sin_lon[ss]
+                cos_psi = slo * src_sin_lat[ss] + clo * src_cos_lat[ss] * cos_dlon
+                if cos_psi < cos_cutoff:
+                    continue
+                if refine and _needs_split(ro, src_r_mid[ss], cos_psi, src_dr[ss], src_cos_lat[ss],
+                                           dlat, dlon, split_ratio):
+                    pot, n = _subdivided_potential(slo, clo, sino, coso, ro, src_sin_lat[ss], src_cos_lat[ss],
+                                                   src_sin_lon[ss], src_cos_lon[ss], src_r_mid[ss], src_dr[ss],
+                                                   dlat, dlon, src_grho[ss], split_ratio, max_depth, split_stack)
+                    pot_sum += pot
+                    n_split += 1
+                    n_eval += n
+                    continue
+                pot_sum += src_weight[ss] * _kernel_from_cos_psi(cos_psi, ro, src_r_mid[ss],
+                                                                 src_dr2_24[ss], dlat2_24, dlon2_24)
+                n_pairs += 1
+        results[ii] = pot_sum
+        counts[ii, 0] = n_pairs
+        counts[ii, 1] = n_split
+        counts[ii, 2] = n_eval
+
+
+# ==============================
+# BATCH DRIVER
+# ==============================
+
+# Kernel variants selectable from the GUI
+ENGINE_METHODS = {
+    "direct": "Direct (reference kernel)",
+    "trig": "Precomputed trigonometry tables",
+    "indexed": "Trigonometry tables + spatial index",
+    "regular": "Regular grid: exact near field + longitude convolution (approx. far field)",
+    "tree": "Treecode: exact near field + multipole far-field blocks (approx. far field)",
+}
+
+# Storage precision of the source tables (trig, indexed and tree methods).
+# The kernels accumulate in float64 either way; float32 coefficient columns
+# cut the memory traffic of the source sweep.
+MIXED_COLUMNS = ("weight", "dr2_24", "dr", "grho")
+PRECISIONS = {
+    "float64": "float64 (reference)",
+    "mixed": "Mixed: float32 source coefficients, float64 geometry and accumulation",
+}
+
+
+def grid_cell_indices(lats_rad, lons_rad, src_lats_rad, src_lons_rad):
+    """Row/column of every source on the regular grid given by the axes (radians)"""
+    lats_rad = np.asarray(lats_rad, dtype=np.float64)
+    lons_rad = np.asarray(lons_rad, dtype=np.float64)
+    dlat_axis = (lats_rad[-1] - lats_rad[0]) / max(len(lats_rad) - 1, 1)
+    dlon_axis = (lons_rad[-1] - lons_rad[0]) / max(len(lons_rad) - 1, 1)
+    rows = np.rint((np.asarray(src_lats_rad) - lats_rad[0]) / (dlat_axis or 1.0)).astype(np.int64)
+    cols = np.rint((np.asarray(src_lons_rad) - lons_rad[0]) / (dlon_axis or 1.0)).astype(np.int64)
+    if (rows.size and (rows.min() < 0 or rows.max() >= len(lats_rad) or
+                       cols.min() < 0 or cols.max() >= len(lons_rad) or
+                       np.abs(lats_rad[rows] - src_lats_rad).max() > 1e-9 or
+                       np.abs(lons_rad[cols] - src_lons_rad).max() > 1e-9)):
+        raise ValueError("Sources are not on the observation grid; regular-grid mode is not applicable")
+    return rows, cols
+
+
+def compute_potential(obs_lats_rad, obs_lons_rad, obs_radii,
+                      src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho,
+                      dlat, dlon, cos_cutoff, batch_size=5000, method="indexed",
+                      progress_callback=None, grid_shape=None, near_cells=2, tolerance=1e-3,
+                      split_ratio=0.0, max_depth=3, stats=None, checkpoint=None, precision="float64"):
+    """Compute the potential at every observation point, batch by batch.
+
+    ``progress_callback(done_batches, n_batches)`` is called after every batch.
+    ``batch_size="auto"`` times a small sample of the observations first and
+    picks the batch size with auto_batch_size (reported in ``stats``).
+    The ``regular`` method needs ``grid_shape=(nlat, nlon)``: the observations
+    must be the row-major flattened grid and the sources must sit on its cells;
+    ``near_cells`` sets its exactly evaluated neighbourhood. The ``tree``
+    method lumps a source block into a multipole when (block radius /
+    distance)^3 <= ``tolerance``.
+
+    With ``split_ratio > 0`` every tesseroid closer to an observation than
+    split_ratio x its largest dimension is split recursively (at most
+    ``max_depth`` levels) instead of using a single kernel evaluation; the
+    ``direct`` reference kernel is never refined. If ``stats`` is a dict it
+    receives ``kernel_evaluations`` (unsplit observation-source pairs),
+    ``refined_sources`` (pairs that were split) and ``refined_evaluations``
+    (kernel evaluations spent on them); ``direct`` reports no counts.
+
+    Batches hold ``batch_size`` valid observations each; NaN observations are
+    skipped instead of occupying kernel threads, and the ``indexed`` kernel
+    orders every batch by the number of sources in each observation's cap so
+    that Numba's equal per-thread blocks carry equal work. ``stats`` then also
+    gets ``thread_utilisation``: per thread, an estimate of the share of the
+    batch wall time it spent working, from its kernel evaluation counts
+    (not a measured busy time).
+
+    ``checkpoint`` (a checkpoints.BatchCheckpoint with one class) receives
+    every finished batch, and batches it already holds are not recomputed, so
+    an interrupted run resumes where it stopped. The ``regular`` method works
+    on whole grid rows and does not support it.
+    ``precision`` is one of PRECISIONS; "mixed" stores the coefficient
+    columns of the table-driven methods in float32 (see prepare_sources).
+    Returns a float64 array with one potential per observation (NaN where the
+    observation radius is NaN).
+    """
+    if method not in ENGINE_METHODS:
+        raise ValueError(f"Unknown engine method: {method}")
+    if precision != "float64" and method in ("direct", "regular"):
+        raise ValueError(f"Engine method {method!r} only runs in float64")
+
+    if method == "regular":
+        if grid_shape is None:
+            raise ValueError("The regular-grid method needs grid_shape=(nlat, nlon)")
+        if checkpoint is not None:
+            raise ValueError("The regular-grid method cannot resume from a checkpoint")
+        nlat, nlon = grid_shape
+        lats_axis = np.asarray(obs_lats_rad, dtype=np.float64).reshape(grid_shape)[:, 0]
+        lons_axis = np.asarray(obs_lons_rad, dtype=np.float64).reshape(grid_shape)[0, :]
+        rows, cols = grid_cell_indices(lats_axis, lons_axis, src_lats_rad, src_lons_rad)
+        counts = np.zeros((nlat, nlon, 3), dtype=np.int64)
+        potentials = compute_potential_regular_grid(
+            lats_axis, lons_axis, np.asarray(obs_radii, dtype=np.float64).reshape(grid_shape),
+            rows, cols, src_r1, src_r2, src_rho, dlat, dlon, cos_cutoff,
+            near_cells=near_cells, progress_callback=progress_callback,
+            split_ratio=split_ratio, max_depth=max_depth, counts=counts
+        )
+        _refinement_stats(counts.reshape(-1, 3), stats)
+        return potentials.ravel()
+
+    if method != "direct":
+        prepared = prepare_sources(src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho,
+                                   dlat, dlon, [cos_cutoff], method=method, precision=precision)
+        return compute_prepared(prepared, obs_lats_rad, obs_lons_rad, obs_radii,
+                                batch_size=batch_size, progress_callback=progress_callback,
+                                tolerance=tolerance, split_ratio=split_ratio, max_depth=max_depth,
+                                stats=stats, checkpoint=checkpoint)[:, 0].copy()
+
+    obs_radii = np.asarray(obs_radii, dtype=np.float64)
+    n_obs = len(obs_radii)
+    obs_lats_rad = np.asarray(obs_lats_rad, dtype=np.float64)
+    obs_lons_rad = np.asarray(obs_lons_rad, dtype=np.float64)
+    if batch_size == "auto":
+        valid_idx = np.flatnonzero(np.isfinite(obs_radii))
+
+        def run_sample(idx):
+            idx = valid_idx[idx]
+            compute_potential_batch(obs_lats_rad[idx], obs_lons_rad[idx], obs_radii[idx],
+                                    src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho,
+                                    dlat, dlon, cos_cutoff, np.full(len(idx), np.nan, dtype=np.float64))
+        batch_size = auto_batch_size(run_sample, len(valid_idx), len(src_lats_rad), stats)
+    batch_size = max(1, int(batch_size))
+    potentials = np.full(n_obs, np.nan, dtype=np.float64)
+    batches = _valid_batches(obs_radii, batch_size)
+    for b, (s, e) in enumerate(batches):
+        if checkpoint is not None and checkpoint.is_done(s, e):
+            potentials[s:e] = checkpoint.values[s:e, 0]
+        else:
+            # Every valid observation visits every source, so compacting them balances the threads
+            idx = s + np.flatnonzero(np.isfinite(obs_radii[s:e]))
+            results_batch = np.full(len(idx), np.nan, dtype=np.float64)
+            compute_potential_batch(
+                obs_lats_rad[idx], obs_lons_rad[idx], obs_radii[idx],
+                src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho,
+                dlat, dlon, cos_cutoff, results_batch
+            )
+            potentials[idx] = results_batch
+            if checkpoint is not None:
+                checkpoint.store(s, e, potentials[s:e])
+        if progress_callback is not None:
+            progress_callback(b + 1, len(batches))
+    return potentials
+
+
+class PreparedSources(NamedTuple):
+    """Source structures of one table-driven method, built once per run.
+
+    ``table`` is the SourceTable in the order the kernel expects; ``index``
+    (indexed) or ``tree`` (tree) hold the method's search structure and are
+    None otherwise. ``cos_cutoffs`` has one cutoff cosine per source class.
+    """
+    method: str
+    table: SourceTable
+    index: Optional[SourceIndex]
+    tree: Optional[SourceTree]
+    cos_cutoffs: np.ndarray
+    dlat: float
+    dlon: float
+
+
+def prepare_sources(src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho, dlat, dlon, cos_cutoffs,
+                    method="indexed", src_class=None, precision="float64"):
+    """Build the source table and the spatial index / tree of ``method`` once.
+
+    Only ``indexed`` supports several source classes (``src_class`` with one
+    entry of ``cos_cutoffs`` per class); ``trig`` and ``tree`` take a single
+    cutoff. With ``precision="mixed"`` the per-source coefficients of the
+    table (weight, dr2_24, dr, grho) are stored as float32; the geometry
+    columns, the index and the tree stay float64.
+    The result can be evaluated for any set of observations with
+    compute_prepared, e.g. tile by tile.
+    """
+    if method not in ("trig", "indexed", "tree"):
+        raise ValueError(f"Engine method {method!r} does not use prepared sources")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}")
+    cos_cutoffs = np.ascontiguousarray(np.atleast_1d(cos_cutoffs), dtype=np.float64)
+    if method != "indexed" and len(cos_cutoffs) != 1:
+        raise ValueError(f"Engine method {method!r} supports a single source class")
+    table = build_source_table(src_lats_rad, src_lons_rad, src_r1, src_r2, src_rho, dlat, dlon, src_class)
+    index = None
+    tree = None
+    if method == "indexed":
+        cutoff_rad = math.acos(min(1.0, max(-1.0, float(cos_cutoffs.min()))))
+        index = build_source_index(table, cutoff_rad, dlat)
+        table = index.table
+    elif method == "tree":
+        tree = build_source_tree(table, dlat, dlon)
+        table = tree.table
+    if precision == "mixed":
+        # The geometry stays float64. r_mid in float32 is quantised to 0.5 m
+        # at Earth radius, and float32 sin/cos put cos(psi) 1e-7 off, i.e.
+        # kilometres; both wreck the distance to sources near an observation.
+        # The coefficients only scale each term, so float32 costs ~1e-7.
+        table = table._replace(**{name: getattr(table, name).astype(np.float32) for name in MIXED_COLUMNS})
+    return PreparedSources(method, table, index, tree, cos_cutoffs, float(dlat), float(dlon))
+
+
+def _evaluate_prepared(prepared, obs, obs_radii, tolerance, split_ratio, max_depth, counts, out):
+    """Run the kernel of ``prepared`` for the ObservationTable ``obs``, writing into ``out``/``counts``"""
+    tab = prepared.table
+    cos_cutoffs = prepared.cos_cutoffs
+    dlat = prepared.dlat
+    dlon = prepared.dlon
+    dlat2_24 = dlat * dlat / 24.0
+    dlon2_24 = dlon * dlon / 24.0
+    cutoff_rad = math.acos(min(1.0, max(-1.0, float(cos_cutoffs.min()))))
+    n = len(obs_radii)
+    if prepared.method == "indexed":
+        index = prepared.index
+        compute_potential_batch_indexed(
+            obs.lat, obs.lon, obs.sin_lat, obs.cos_lat, obs.sin_lon, obs.cos_lon, obs_radii,
+            index.lon_key, index.band_start, index.band_lat0, index.band_width, index.same_cell,
+            tab.lon, tab.sin_lat, tab.cos_lat, tab.sin_lon, tab.cos_lon,
+            tab.r_mid, tab.dr2_24, tab.weight, tab.cls, tab.dr, tab.grho,
+            dlat, dlon, dlat2_24, dlon2_24, cutoff_rad, cos_cutoffs,
+            split_ratio, max_depth, counts, out
+        )
+    elif prepared.method == "tree":
+        tree = prepared.tree
+        results_batch = np.full(n, np.nan, dtype=np.float64)
+        stack = np.empty((n, len(tree.roots) + 4 * tree.n_levels), dtype=np.int64)
+        compute_potential_batch_tree(
+            obs.lon, obs.sin_lat, obs.cos_lat, obs.sin_lon, obs.cos_lon, obs_radii,
+            tree.start, tree.end, tree.child0, tree.child1, tree.roots,
+            tree.centre, tree.direction, tree.mass, tree.dipole, tree.quadrupole,
+            tree.radius, tree.ang_radius,
+            tab.lon, tab.sin_lat, tab.cos_lat, tab.sin_lon, tab.cos_lon,
+            tab.r_mid, tab.dr2_24, tab.weight, tab.dr, tab.grho,
+            dlat, dlon, dlat2_24, dlon2_24, cutoff_rad, cos_cutoffs[0], tolerance, stack,
+            split_ratio, max_depth, counts, results_batch
+        )
+        out[:, 0] = results_batch
+    else:
+        results_batch = np.full(n, np.nan, dtype=np.float64)
+        compute_potential_batch_trig(
+            obs.lon, obs.sin_lat, obs.cos_lat, obs.sin_lon, obs.cos_lon, obs_radii,
+            tab.lon, tab.sin_lat, tab.cos_lat, tab.sin_lon, tab.cos_lon,
+            tab.r_mid, tab.dr2_24, tab.weight, tab.dr, tab.grho,
+            dlat, dlon, dlat2_24, dlon2_24, cos_cutoffs[0],
+            split_ratio, max_depth, counts, results_batch
+        )
+        out[:, 0] = results_batch
+
+
+def auto_batch_size(run_batch, n_obs, n_sources, stats=None):
+    """Batch size for which one batch takes about AUTO_BATCH_SECONDS.
+
+    ``run_batch(idx)`` evaluates the observations ``idx``; it is timed on an
+    evenly spread sample sized from ``n_sources`` (about _CALIBRATION_PAIRS
+    observation-source pairs). The result is a multiple of the Numba thread
+    count and at least 32 observations per thread, so every batch keeps all
+    threads busy. ``stats`` (if given) receives ``batch_size`` and
+    ``calibration_seconds``. Without observations there is nothing to time
+    and one thread-sized batch is returned.
+    """
+    n_threads = get_num_threads()
+    if n_obs == 0:
+        return 32 * n_threads
+    n_sample = int(min(n_obs, max(8 * n_threads, min(4096, _CALIBRATION_PAIRS / max(1, n_sources)))))
+    idx = np.unique(np.linspace(0, n_obs - 1, max(1, n_sample)).astype(np.int64))
+    # A single observation first, so loading the compiled kernel is not timed
+    run_batch(idx[:1])
+    t0 = time.perf_counter()
+    run_batch(idx)
+    seconds = time.perf_counter() - t0
+    size = AUTO_BATCH_SECONDS * len(idx) / seconds if seconds > 0 else n_obs
+    size = max(32 * n_threads, min(n_obs, int(size)))
+    size = min(max(n_obs, 1), -(-size // n_threads) * n_threads)
+    if stats is not None:
+        stats['batch_size'] = size
+        stats['calibration_seconds'] = seconds
+    return size
+
+
+def _valid_batches(obs_radii, batch_size):
+    """(s, e) observation ranges that each hold ``batch_size`` observations with a finite radius.
+
+    Masked and NaN observations cost nothing, so counting only the valid ones
+    keeps the work per batch even over coastlines and masked regions.
+    """
+    n_obs = len(obs_radii)
+    if n_obs == 0:
+        return []
+    valid_idx = np.flatnonzero(np.isfinite(obs_radii))
+    starts = [0] + valid_idx[batch_size::batch_size].tolist()
+    return list(zip(starts, starts[1:] + [n_obs]))
+
+
+def _balanced_order(costs, n_threads):
+    """Order of a batch in which every thread's share of the prange loop costs about the same.
+
+    Numba hands each thread one contiguous, equally long block of the loop;
+    dealing the observations, most expensive first, to the blocks in snake
+    order evens out the block totals.
+    """
+    n = len(costs)
+    if n_threads <= 1 or n <= n_threads:
+        return np.arange(n)
+    n_rows = -(-n // n_threads)
+    deal = np.full(n_rows * n_threads, -1, dtype=np.int64)
+    deal[:n] = np.argsort(costs, kind="stable")[::-1]
+    deal = deal.reshape(n_rows, n_threads)
+    deal[1::2] = deal[1::2, ::-1].copy()
+    blocks = [column[column >= 0] for column in deal.T]
+    blocks.sort(key=len, reverse=True)
+    return np.concatenate(blocks)
+
+
+def _thread_loads(work, n_threads):
+    """Work of each thread's contiguous block of a prange loop over ``work``"""
+    bounds = np.linspace(0, len(work), n_threads + 1).astype(np.int64)
+    cumulative = np.concatenate(([0], np.cumsum(work)))
+    return cumulative[bounds[1:]] - cumulative[bounds[:-1]]
+
+
+def compute_prepared(prepared, obs_lats_rad, obs_lons_rad, obs_radii, batch_size=5000,
+                     progress_callback=None, tolerance=1e-3, split_ratio=0.0, max_depth=3, stats=None,
+                     checkpoint=None):
+    """Potentials of prepared sources at the given observations, batch by batch.
+
+    Options are as in compute_potential. Returns an (n_obs, n_classes) array.
+    """
+    obs_tab = build_observation_table(obs_lats_rad, obs_lons_rad)
+    obs_radii = np.ascontiguousarray(obs_radii, dtype=np.float64)
+    n_classes = len(prepared.cos_cutoffs)
+    split_ratio = float(split_ratio)
+    max_depth = int(max_depth)
+
+    n_obs = len(obs_radii)
+    if batch_size == "auto":
+        valid_idx = np.flatnonzero(np.isfinite(obs_radii))
+
+        def run_sample(idx):
+            idx = valid_idx[idx]
+            _evaluate_prepared(prepared, obs_tab.take(idx), obs_radii[idx],
+                               tolerance, split_ratio, max_depth, np.zeros((len(idx), 3), dtype=np.int64),
+                               np.full((len(idx), n_classes), np.nan, dtype=np.float64))
+        batch_size = auto_batch_size(run_sample, len(valid_idx), len(prepared.table.lon), stats)
+    batch_size = max(1, int(batch_size))
+    potentials = np.full((n_obs, n_classes), np.nan, dtype=np.float64)
+    counts = np.zeros((n_obs, 3), dtype=np.int64)
+    n_threads = get_num_threads()
+    busy = np.zeros(n_threads)
+    span = 0.0
+    batches = _valid_batches(obs_radii, batch_size)
+    for b, (s, e) in enumerate(batches):
+        if checkpoint is not None and checkpoint.is_done(s, e):
+            potentials[s:e] = checkpoint.values[s:e]
+            counts[s:e] = checkpoint.counts[s:e]
+            if progress_callback is not None:
+                progress_callback(b + 1, len(batches))
+            continue
+        # Only the valid observations, ordered so that the threads share the work evenly
+        idx = s + np.flatnonzero(np.isfinite(obs_radii[s:e]))
+        if len(idx):
+            obs = obs_tab.take(idx)
+            if prepared.method == "indexed" and n_threads > 1:
+                index = prepared.index
+                cutoff_rad = math.acos(min(1.0, max(-1.0, float(prepared.cos_cutoffs.min()))))
+                candidates = np.empty(len(idx), dtype=np.int64)
+                count_cap_candidates(obs.lat, obs.lon, obs.cos_lat, index.lon_key, index.band_start,
+                                     index.band_lat0, index.band_width, cutoff_rad, candidates)
+                order = _balanced_order(candidates, n_threads)
+                idx = idx[order]
+                obs = ObservationTable(*[col[order] for col in obs])
+            batch_counts = np.zeros((len(idx), 3), dtype=np.int64)
+            batch_potentials = np.full((len(idx), n_classes), np.nan, dtype=np.float64)
+            _evaluate_prepared(prepared, obs, obs_radii[idx], tolerance, split_ratio, max_depth,
+                               batch_counts, batch_potentials)
+            potentials[idx] = batch_potentials
+            counts[idx] = batch_counts
+            loads = _thread_loads(batch_counts[:, 0] + batch_counts[:, 2], n_threads)
+            busy += loads
+            span += loads.max()
+        if checkpoint is not None:
+            checkpoint.store(s, e, potentials[s:e], counts[s:e])
+        if progress_callback is not None:
+            progress_callback(b + 1, len(batches))
+
+    _refinement_stats(counts, stats)
+    if stats is not None and span > 0:
+        stats['thread_utilisation'] = (busy / span).tolist()
+    return potentials
+
+
+def _refinement_stats(counts, stats):
+    """Fill ``stats`` (if given) from per-observation kernel counts"""
+    if stats is not None:
+        stats['kernel_evaluations'] = int(counts[:, 0].sum())
+        stats['refined_sources'] = int(counts[:, 1].sum())
+        stats['refined_evaluations'] = int(counts[:, 2].sum())
+
+
+class SourceSet(NamedTuple):
+    """Source tesseroids of one correction kind (radians, metres, kg/m^3)"""
+    lat: np.ndarray
+    lon: np.ndarray
+    r1: np.ndarray
+    r2: np.ndarray
+    rho: np.ndarray
+
+
+def compute_potentials_fused(obs_lats_rad, obs_lons_rad, obs_radii, source_sets, cos_cutoffs,
+                             dlat, dlon, batch_size=5000, progress_callback=None,
+                             split_ratio=0.0, max_depth=3, stats=None, checkpoint=None, precision="float64"):
+    """Potentials of several source sets in a single pass over the observations.
+
+    ``source_sets`` is a list of SourceSet and ``cos_cutoffs`` the matching
+    cosines of their angular cutoffs. The observation trig tables, the spatial
+    index and the per-observation band/longitude search are shared, so e.g.
+    topography, crust and sediments cost one sweep instead of three.
+    ``split_ratio``, ``max_depth``, ``stats``, ``checkpoint`` (with one
+    class per source set) and ``precision`` are as in compute_potential.
+    Returns one potential array per source set, in order.
+    """
+    if len(source_sets) != len(cos_cutoffs):
+        raise ValueError("Need one cutoff per source set")
+    src_class = np.concatenate([np.full(len(s.lat), k, dtype=np.int64)
+                                for k, s in enumerate(source_sets)])
+    prepared = prepare_sources(
+        np.concatenate([s.lat for s in source_sets]),
+        np.concatenate([s.lon for s in source_sets]),
+        np.concatenate([s.r1 for s in source_sets]),
+        np.concatenate([s.r2 for s in source_sets]),
+        np.concatenate([s.rho for s in source_sets]),
+        dlat, dlon, cos_cutoffs, method="indexed", src_class=src_class, precision=precision
+    )
+    potentials = compute_prepared(prepared, obs_lats_rad, obs_lons_rad, obs_radii,
+                                  batch_size=batch_size, progress_callback=progress_callback,
+                                  split_ratio=split_ratio, max_depth=max_depth, stats=stats,
+                                  checkpoint=checkpoint)
+    return [potentials[:, k].copy() for k in range(len(source_sets))]
+
+
+# ==============================
+# SOURCE BUILDERS
+# ==============================
+
+def topographic_sources(lats, lons, elev_grid, geoid_safe, ell_radii, min_thickness, rho_rock, rho_water):
+    """Topographic tesseroids of every cell with |H| > min_thickness.
+
+    ``lats``/``lons`` are the grid axes (degrees), ``geoid_safe`` the geoid
+    heights with NaN replaced by 0 and ``ell_radii`` the ellipsoidal radius of
+    every row. Each tesseroid spans the ellipsoid to ellipsoid + H + N, with
+    rock density above sea level and water density below. Returns the
+    SourceSet (cells in row-major order) and the boolean rock mask.
+    """
+    rows, cols = np.nonzero(np.isfinite(elev_grid) & (np.abs(elev_grid) > min_thickness))
+    H = elev_grid[rows, cols]
+    r_top = ell_radii[rows] + H + geoid_safe[rows, cols]
+    r_bottom = ell_radii[rows]
+    is_rock = H >= 0
+    sources = SourceSet(np.radians(lats[rows]), np.radians(lons[cols]),
+                        np.minimum(r_top, r_bottom), np.maximum(r_top, r_bottom),
+                        np.where(is_rock, float(rho_rock), float(rho_water)))
+    return sources, is_rock
+
+
+def crustal_sources(lats, lons, crustal_grid, elev_safe, geoid_safe, ell_radii,
+                    reference_thickness, min_thickness, delta_rho):
+    """Moho-undulation tesseroids between the Moho and the reference Moho (metres).
+
+    Cells whose thickness differs from ``reference_thickness`` by less than
+    ``min_thickness``, whose Moho or reference Moho radius is not positive,
+    or whose layer is thinner than 1e-6 m are skipped. Density is +delta_rho
+    where the crust is thinner than the reference and -delta_rho elsewhere.
+    Returns the SourceSet and the boolean thin-crust mask.
+    """
+    rows, cols = np.nonzero(np.isfinite(crustal_grid))
+    ct = crustal_grid[rows, cols]
+    keep = ~(np.abs(ct - reference_thickness) < min_thickness)
+    rows, cols, ct = rows[keep], cols[keep], ct[keep]
+    r_surface = ell_radii[rows] + elev_safe[rows, cols] + geoid_safe[rows, cols]
+    r_m = r_surface - ct
+    r_ref = r_surface - reference_thickness
+    keep = ~((r_m <= 0) | (r_ref <= 0) | (np.abs(r_ref - r_m) < 1e-6))
+    rows, cols, ct, r_m, r_ref = rows[keep], cols[keep], ct[keep], r_m[keep], r_ref[keep]
+    is_thin = ct < reference_thickness
+    sources = SourceSet(np.radians(lats[rows]), np.radians(lons[cols]),
+                        np.minimum(r_m, r_ref), np.maximum(r_m, r_ref),
+                        np.where(is_thin, float(delta_rho), -float(delta_rho)))
+    return sources, is_thin
+
+
+def sedimentary_sources(lats, lons, sed_grid, elev_safe, geoid_safe, ell_radii, min_thickness, rho_contrast):
+    """Sediment tesseroids from the surface down by the sediment thickness (metres).
+
+    Only cells thicker than ``min_thickness`` with a finite, non-empty layer
+    are kept; all carry ``rho_contrast``.
+    """
+    rows, cols = np.nonzero(sed_grid > min_thickness)
+    r_top = ell_radii[rows] + elev_safe[rows, cols] + geoid_safe[rows, cols]
+    r_bottom = r_top - sed_grid[rows, cols]
+    keep = (r_bottom < r_top) & np.isfinite(r_bottom) & np.isfinite(r_top)
+    rows, cols = rows[keep], cols[keep]
+    return SourceSet(np.radians(lats[rows]), np.radians(lons[cols]),
+                     r_bottom[keep], r_top[keep], np.full(len(rows), float(rho_contrast)))
+
+
+# ==============================
+# UNIT-DENSITY POTENTIALS
+# ==============================
+
+def unit_source_set(source_set):
+    """Copy of a SourceSet with density 1 kg/m^3 everywhere"""
+    return source_set._replace(rho=np.ones(len(source_set.lat), dtype=np.float64))
+
+
+def unit_potential_key(obs_lats_rad, obs_lons_rad, obs_radii, source_set, cos_cutoff,
+                       dlat, dlon, method="indexed", **settings):
+    """Digest of everything a unit-density potential depends on.
+
+    The densities are deliberately left out: the potential is linear in rho,
+    so a stored unit-density potential stays valid for any density as long as
+    the observation points, the source geometry and the kernel settings
+    (``method`` plus the keyword options passed to compute_potential) match.
+    """
+    digest = hashlib.sha1()
+    for values in (obs_lats_rad, obs_lons_rad, obs_radii,
+                   source_set.lat, source_set.lon, source_set.r1, source_set.r2):
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    digest.update(repr((float(cos_cutoff), float(dlat), float(dlon), method, sorted(settings.items()))).encode())
+    return digest.hexdigest()
+
+
+def combine_unit_potentials(unit_potentials, densities):
+    """Potential of a density model from unit-density potentials.
+
+    ``unit_potentials`` maps a source class to its potential for
+    rho = 1 kg/m^3 and ``densities`` maps the classes to include to their
+    (signed) densities; the result is sum(rho_c * U_c).
+    """
+    total = None
+    for name, rho in densities.items():
+        term = rho * unit_potentials[name]
+        total = term if total is None else total + term
+    return total
+
+
+# ==============================
+# WARM-UP
+# ==============================
+
+def warmup_kernels():
+    """Compile (or load from the on-disk cache) every kernel on a tiny problem.
+
+    Returns the elapsed wall time in seconds so callers can report it.
+    """
+    t0 = time.time()
+    problem = list(make_synthetic_problem(n_side=4))
+    problem[2] = problem[2].copy()
+    problem[2][0] = np.nan
+    cos_cutoff = math.cos(math.radians(5.0))
+    for method in ENGINE_METHODS:
+        compute_potential(*problem, cos_cutoff, method=method, grid_shape=(4, 4))
+        compute_potential(*problem, cos_cutoff, method=method, grid_shape=(4, 4), split_ratio=1.0)
+        if method not in ("direct", "regular"):
+            compute_potential(*problem, cos_cutoff, method=method, precision="mixed")
+            compute_potential(*problem, cos_cutoff, method=method, split_ratio=1.0, precision="mixed")
+    sources = SourceSet(*problem[3:8])
+    compute_potentials_fused(*problem[:3], [sources, sources], [cos_cutoff, cos_cutoff], *problem[8:])
+    return time.time() - t0
+
+
+# ==============================
+# BENCHMARK
+# ==============================
+
+def make_synthetic_problem(n_side=60, spacing_deg=0.25, lat0=20.0, lon0=70.0, seed=0):
+    """Regular n_side x n_side grid with random topography-like sources.
+
+    Returns (obs_lats_rad, obs_lons_rad, obs_radii, src_lats_rad, src_lons_rad,
+    src_r1, src_r2, src_rho, dlat, dlon) for an all-cells-are-sources problem.
+    """
+    rng = np.random.default_rng(seed)
+    lats = lat0 + spacing_deg * np.arange(n_side)
+    lons = lon0 + spacing_deg * np.arange(n_side)
+    lat_flat = np.radians(np.repeat(lats, n_side))
+    lon_flat = np.radians(np.tile(lons, n_side))
+    r_ref = 6371000.0
+    height = rng.normal(500.0, 800.0, lat_flat.size)
+    obs_radii = r_ref + np.maximum(height, 0.0) + 1.0
+    src_r1 = r_ref + np.minimum(height, 0.0)
+    src_r2 = r_ref + np.maximum(height, 0.0)
+    src_rho = np.where(height >= 0, 2670.0, 1030.0)
+    d = math.radians(spacing_deg)
+    return lat_flat, lon_flat, obs_radii, lat_flat, lon_flat, src_r1, src_r2, src_rho, d, d
+
+
+def benchmark_kernels(n_side=60, cutoff_deg=12.0, batch_size=5000, methods=None, repeat=3):
+    """Time every engine method against the direct kernel on a synthetic grid.
+
+    Returns a list of dicts with the best wall time, the speed-up over
+    ``direct`` and the maximum relative difference to the ``direct`` result.
+    """
+    problem = make_synthetic_problem(n_side=n_side)
+    cos_cutoff = math.cos(math.radians(cutoff_deg))
+    methods = list(methods or ENGINE_METHODS)
+    if "direct" not in methods:
+        methods.insert(0, "direct")
+    warmup_kernels()
+
+    reference = None
+    rows = []
+    for method in methods:
+        best = np.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            pot = compute_potential(*problem, cos_cutoff, batch_size=batch_size, method=method,
+                                    grid_shape=(n_side, n_side))
+            best = min(best, time.perf_counter() - t0)
+        if reference is None:
+            reference = pot
+            ref_time = best
+        scale = np.nanmax(np.abs(reference))
+        rows.append({
+            'method': method,
+            'seconds': best,
+            'speedup': ref_time / best,
+            'max_rel_diff': float(np.nanmax(np.abs(pot - reference)) / scale),
+        })
+    return rows
+
+
+def benchmark_fused(n_side=120, cutoffs_deg=(12.0, 4.0, 12.0), batch_size=5000):
+    """Time three separate indexed sweeps against one fused sweep over the same sources.
+
+    Returns (separate_seconds, fused_seconds, max_rel_diff).
+    """
+    problem = make_synthetic_problem(n_side=n_side)
+    obs, src, (dlat, dlon) = problem[:3], SourceSet(*problem[3:8]), problem[8:]
+    cos_cutoffs = [math.cos(math.radians(c)) for c in cutoffs_deg]
+    warmup_kernels()
+
+    t0 = time.perf_counter()
+    separate = [compute_potential(*obs, *src, dlat, dlon, cc, batch_size=batch_size, method="indexed")
+                for cc in cos_cutoffs]
+    t_separate = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fused = compute_potentials_fused(*obs, [src] * len(cos_cutoffs), cos_cutoffs, dlat, dlon,
+                                     batch_size=batch_size)
+    t_fused = time.perf_counter() - t0
+    diff = max(np.nanmax(np.abs(a - b)) / np.nanmax(np.abs(a)) for a, b in zip(separate, fused))
+    return t_separate, t_fused, float(diff)
+
+
+def benchmark_tree(n_side=120, spacing_deg=1.0, cutoff_deg=40.0, tolerances=(1e-2, 1e-3, 1e-4),
+                   batch_size=5000):
+    """Time the treecode against the indexed kernel for a wide area and a large cutoff.
+
+    Returns (indexed_seconds, rows) where every row has the tolerance, the
+    wall time and the maximum difference as relative value and as geoid
+    height in millimetres (V / 9.8).
+    """
+    problem = make_synthetic_problem(n_side=n_side, spacing_deg=spacing_deg,
+                                     lat0=-0.5 * n_side * spacing_deg, lon0=0.0)
+    cos_cutoff = math.cos(math.radians(cutoff_deg))
+    warmup_kernels()
+
+    t0 = time.perf_counter()
+    reference = compute_potential(*problem, cos_cutoff, batch_size=batch_size, method="indexed")
+    t_indexed = time.perf_counter() - t0
+    rows = []
+    for tolerance in tolerances:
+        t0 = time.perf_counter()
+        pot = compute_potential(*problem, cos_cutoff, batch_size=batch_size, method="tree",
+                                tolerance=tolerance)
+        diff = np.nanmax(np.abs(pot - reference))
+        rows.append({
+            'tolerance': tolerance,
+            'seconds': time.perf_counter() - t0,
+            'max_rel_diff': float(diff / np.nanmax(np.abs(reference))),
+            'max_geoid_mm': float(diff / 9.8 * 1000.0),
+        })
+    return t_indexed, rows
+
+
+if __name__ == "__main__":
+    for n_side, cutoff_deg, repeat in [(60, 12.0, 3), (120, 4.0, 1)]:
+        print(f"Benchmark: {n_side}x{n_side} grid (0.25 deg), every cell a source, {cutoff_deg:g} deg cutoff")
+        for row in benchmark_kernels(n_side=n_side, cutoff_deg=cutoff_deg, repeat=repeat):
+            print(f"{row['method']:>10s}  {row['seconds']:8.3f} s  x{row['speedup']:6.2f}  "
+                  f"max rel diff {row['max_rel_diff']:.2e}")
+    t_separate, t_fused, diff = benchmark_fused()
+    print(f"Fused topo/crust/sed sweep (120x120 grid): separate {t_separate:.3f} s, "
+          f"fused {t_fused:.3f} s (x{t_separate / t_fused:.2f}), max rel diff {diff:.2e}")
+    t_indexed, rows = benchmark_tree()
+    print(f"Treecode, 120x120 grid (1 deg), 40 deg cutoff: indexed {t_indexed:.3f} s")
+    for row in rows:
+        print(f"  tolerance {row['tolerance']:g}  {row['seconds']:8.3f} s  x{t_indexed / row['seconds']:6.2f}  "
+              f"max rel diff {row['max_rel_diff']:.2e} ({row['max_geoid_mm']:.3f} mm)")
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from correction_engine import EngineSettings, Grid, compute_correction
+
+
+@pytest.fixture(scope="module")
+def grids():
+    lons = np.linspace(70.0, 73.0, 13)
+    lats = np.linspace(20.0, 23.0, 13)
+    lon, lat = np.meshgrid(lons, lats)
+    rng = np.random.default_rng(1)
+    geoid = Grid(lons, lats, 30.0 + np.sin(lon) + np.cos(lat))
+    topography = Grid(lons, lats, rng.normal(200.0, 1500.0, lon.shape))
+    crust = Grid(lons, lats, rng.normal(35.0, 5.0, lon.shape))
+    return geoid, topography, crust
+
+
+def run(grids, method):
+    messages = []
+    results = compute_correction("4", *grids, engine=EngineSettings(method=method),
+                                 log=lambda level, message: messages.append(message))
+    return results, [message for message in messages if message.startswith("Computing")]
+
+
+def test_unfused_methods_merge_the_classes_of_each_correction(grids):
+    fused, fused_passes = run(grids, "indexed")
+    merged, merged_passes = run(grids, "trig")
+    assert len(fused_passes) == 1
+    assert len(merged_passes) == 2
+    np.testing.assert_allclose(merged['total_correction'], fused['total_correction'], rtol=1e-10, atol=1e-12)
+    assert 'unit_corrections' in fused and 'unit_corrections' not in merged
+
+
+@pytest.mark.parametrize("method", ["linear", "nearest"])
+def test_grid_interpolate_matches_griddata(method):
+    from scipy.interpolate import griddata
+    lons = np.linspace(10.0, 12.0, 5)
+    lats = np.linspace(40.0, 41.0, 3)
+    lon, lat = np.meshgrid(lons, lats)
+    grid = Grid(lons, lats, lon + 10.0 * lat)
+    # Target nodes inside and beyond every edge of the grid
+    xi = np.linspace(9.5, 12.5, 13)
+    yi = np.linspace(39.8, 41.2, 8)
+    expected = griddata((lon.ravel(), lat.ravel()), grid.values.ravel(), tuple(np.meshgrid(xi, yi)), method=method)
+    np.testing.assert_allclose(grid.interpolate(xi, yi, method), expected, equal_nan=True)
@@ -0,0 +1,8 @@
+from cost_model import ThroughputModel
+
+
+def test_throughput_key_separates_precision():
+    plain = ThroughputModel.key("indexed", {})
+    assert plain == ThroughputModel.key("indexed", {"precision": "float64"})
+    assert ThroughputModel.key("indexed", {"precision": "mixed"}) != plain
+    assert ThroughputModel.key("indexed", {"split_ratio": 1.0, "precision": "mixed"}) == "indexed/split/mixed"
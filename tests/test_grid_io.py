@@ -0,0 +1,93 @@
+import io
+
+import numpy as np
+import pytest
+
+from correction_engine import Grid
+from grid_io import detect_grid, read_delimited, read_icgem_gdf, sniff_format, sniff_grid_format
+
+LONS = np.array([10.0, 10.5, 11.0, 11.5])
+LATS = np.array([40.0, 40.5, 41.0])
+
+
+def xyz_rows():
+    lon, lat = np.meshgrid(LONS, LATS)
+    return np.column_stack([lon.ravel(), lat.ravel(), (lon + 10 * lat).ravel()])
+
+
+def to_bytes(rows, delimiter, header=None):
+    lines = [header] if header else []
+    lines += [delimiter.join(f"{v:g}" for v in row) for row in rows]
+    return io.BytesIO(("\n".join(lines) + "\n").encode())
+
+
+@pytest.mark.parametrize("delimiter,header", [(",", "lon,lat,height"), (",", None),
+                                              ("  ", None), ("\t", "lon\tlat\theight")])
+def test_read_delimited_round_trip(delimiter, header):
+    rows = xyz_rows()
+    stats = {}
+    df = read_delimited(to_bytes(rows, delimiter, header), stats)
+    assert list(df.columns) == (["lon", "lat", "height"] if header else ["longitude", "latitude", "value"])
+    np.testing.assert_allclose(df.to_numpy(), rows)
+    assert stats['rows'] == len(rows)
+    assert stats['delimiter'] == ("whitespace" if delimiter.isspace() and delimiter != "\t" else delimiter)
+
+
+def test_sniff_format_detects_header():
+    assert sniff_format(["x;y;z", "1;2;3"]) == (";", True)
+    assert sniff_format(["1 2 3", "4 5 6"]) == (None, False)
+
+
+def test_detect_grid_from_points():
+    rows = xyz_rows()[1:]
+    labels, grid = detect_grid(read_delimited(to_bytes(rows, ",", "lon,lat,height")))
+    assert labels == ["lon", "lat", "height"]
+    np.testing.assert_allclose(grid.lons, LONS)
+    np.testing.assert_allclose(grid.lats, LATS)
+    assert np.isnan(grid.values[0, 0])
+    assert grid.values[2, 3] == pytest.approx(11.5 + 410.0)
+
+
+def test_from_regular_points_rejects_scattered():
+    rng = np.random.default_rng(0)
+    assert Grid.from_regular_points(rng.uniform(0, 1, 50), rng.uniform(0, 1, 50), np.zeros(50)) is None
+
+
+ICGEM = b"""generating_institute     gfz-potsdam
+product_type             gravity_field
+functional               geoid
+latlimit_north           41.0
+latlimit_south           40.0
+longlimit_west           10.0
+longlimit_east           11.5
+gridstep                 0.5
+latitude_parallels       3
+longitude_parallels      4
+gapvalue                 9999.0
+    long     lat    geoid
+end_of_head ==============
+"""
+
+
+def test_read_icgem_gdf_with_header():
+    rows = xyz_rows()
+    rows[0, 2] = 9999.0
+    body = "".join(f"{lon:8.3f} {lat:8.3f} {value:10.4f}\n" for lon, lat, value in rows)
+    source = io.BytesIO(ICGEM + body.encode())
+    assert sniff_grid_format(source) == "icgem"
+    info = {}
+    grid = read_icgem_gdf(source, info)
+    assert info['header']['product_type'] == "gravity_field"
+    np.testing.assert_allclose(grid.lons, LONS)
+    np.testing.assert_allclose(grid.lats, LATS)
+    assert np.isnan(grid.values[0, 0])
+    np.testing.assert_allclose(grid.values.ravel()[1:], rows[1:, 2])
+
+
+def test_sniff_grid_format():
+    assert sniff_grid_format(io.BytesIO(b"CDF\x01rest")) == "netcdf3"
+    assert sniff_grid_format(io.BytesIO(b"\x89HDF\r\n\x1a\nrest")) == "netcdf4"
+    assert sniff_grid_format(io.BytesIO(b"II*\x00rest")) == "geotiff"
+    # A headerless .gdf is plain XYZ text
+    assert sniff_grid_format(to_bytes(xyz_rows(), " ")) == "text"
+    assert sniff_grid_format(io.BytesIO(b"\x00\x01\x02")) is None
@@ -0,0 +1,126 @@
+import math
+
+import numpy as np
+import pytest
+
+from tesseroid_engine import (G, SourceSet, compute_potential, compute_potentials_fused, compute_prepared,
+                              make_synthetic_problem, prepare_sources)
+from tile_runner import compute_potentials_tiled
+
+COS_CUTOFF = math.cos(math.radians(3.0))
+
+
+@pytest.fixture(scope="module")
+def problem():
+    return make_synthetic_problem(n_side=12)
+
+
+@pytest.fixture(scope="module")
+def reference(problem):
+    return compute_potential(*problem, COS_CUTOFF, method="direct")
+
+
+def max_rel_diff(pot, reference):
+    return np.max(np.abs(pot - reference) / np.abs(reference))
+
+
+@pytest.mark.parametrize("method", ["trig", "indexed"])
+def test_exact_methods_match_direct(problem, reference, method):
+    pot = compute_potential(*problem, COS_CUTOFF, method=method)
+    assert max_rel_diff(pot, reference) < 1e-10
+
+
+def test_regular_approximates_direct(problem, reference):
+    pot = compute_potential(*problem, COS_CUTOFF, method="regular", grid_shape=(12, 12))
+    assert max_rel_diff(pot, reference) < 1e-3
+
+
+@pytest.mark.parametrize("method", ["indexed", "tree"])
+def test_split_modes_match_trig(problem, method):
+    trig = compute_potential(*problem, COS_CUTOFF, method="trig", split_ratio=1.0)
+    pot = compute_potential(*problem, COS_CUTOFF, method=method, split_ratio=1.0, tolerance=1e-6)
+    assert max_rel_diff(pot, trig) < 1e-6
+
+
+def quadrature_potential(lat_o, lon_o, r_o, lat, lon, r1, r2, rho, dlat, dlon, n=12, parts=4):
+    """Converged potential of one tesseroid by composite Gauss-Legendre quadrature"""
+    x, w = np.polynomial.legendre.leggauss(n)
+
+    def nodes(low, high):
+        edges = np.linspace(low, high, parts + 1)
+        half = 0.5 * np.diff(edges)[:, None]
+        return (half * x + 0.5 * (edges[1:] + edges[:-1])[:, None]).ravel(), (half * w).ravel()
+
+    (rr, wr), (la, wa), (lo, wo) = (nodes(r1, r2), nodes(lat - dlat / 2, lat + dlat / 2),
+                                    nodes(lon - dlon / 2, lon + dlon / 2))
+    r, la, lo = np.meshgrid(rr, la, lo, indexing="ij")
+    weights = wr[:, None, None] * wa[None, :, None] * wo[None, None, :]
+    cos_psi = math.sin(lat_o) * np.sin(la) + math.cos(lat_o) * np.cos(la) * np.cos(lon_o - lo)
+    dist = np.sqrt(r_o * r_o + r * r - 2.0 * r_o * r * cos_psi)
+    return G * rho * np.sum(weights * r * r * np.cos(la) / dist)
+
+
+@pytest.mark.parametrize("offset", [(0, 0), (0, 1), (1, 0), (1, 1), (0, 2), (2, 0), (2, 2), (0, 3), (3, 0)])
+def test_subdivision_never_loses_accuracy(offset):
+    # 0.25 x 0.25 degree x 1 km tesseroid, observed 1 km above its top, 0-3 cells away
+    d = math.radians(0.25)
+    lat, lon, r2 = math.radians(30.0), math.radians(60.0), 6371000.0
+    source = [np.array([v]) for v in (lat, lon, r2 - 1000.0, r2, 2670.0)]
+    obs = [np.array([v]) for v in (lat + offset[0] * d, lon + offset[1] * d, r2 + 1000.0)]
+    reference = quadrature_potential(*[o[0] for o in obs], *[s[0] for s in source], d, d)
+    errors = [abs(compute_potential(*obs, *source, d, d, -1.0, method="trig", split_ratio=ratio,
+                                    max_depth=depth)[0] / reference - 1.0)
+              for ratio, depth in ((0.0, 0), (1.0, 1), (2.0, 2), (2.0, 4), (3.0, 1), (4.0, 4))]
+    assert all(err <= errors[0] * (1 + 1e-9) for err in errors[1:])
+    assert errors[-1] < 2e-3
+
+
+def test_prepared_matches_direct(problem, reference):
+    prepared = prepare_sources(*problem[3:10], [COS_CUTOFF], method="indexed")
+    pot = compute_prepared(prepared, *problem[:3], batch_size=17)
+    assert pot.shape == (len(reference), 1)
+    assert max_rel_diff(pot[:, 0], reference) < 1e-10
+
+
+def test_fused_matches_separate_passes(problem, reference):
+    sources = SourceSet(*problem[3:8])
+    near_cutoff = math.cos(math.radians(1.0))
+    near = compute_potential(*problem, near_cutoff, method="direct")
+    fused = compute_potentials_fused(*problem[:3], [sources, sources], [COS_CUTOFF, near_cutoff],
+                                     *problem[8:10], batch_size=50)
+    assert max_rel_diff(fused[0], reference) < 1e-10
+    assert max_rel_diff(fused[1], near) < 1e-10
+
+
+@pytest.mark.parametrize("method", ["indexed", "tree"])
+def test_tiled_matches_direct(problem, reference, method):
+    sources = SourceSet(*problem[3:8])
+    pot, = compute_potentials_tiled(*problem[:3], [sources], [COS_CUTOFF], *problem[8:10], method=method,
+                                    n_workers=2, threads_per_worker=1, tile_size=40, tolerance=1e-6)
+    assert max_rel_diff(pot, reference) < 1e-6
+
+
+@pytest.mark.parametrize("method", ["direct", "indexed"])
+def test_auto_batch_size_without_valid_observations(problem, method):
+    obs_lats, obs_lons, obs_radii, *sources = problem
+    stats = {}
+    pot = compute_potential(obs_lats, obs_lons, np.full_like(obs_radii, np.nan), *sources, COS_CUTOFF,
+                            batch_size="auto", method=method, stats=stats)
+    assert pot.shape == obs_radii.shape
+    assert np.isnan(pot).all()
+    assert 'batch_size' not in stats
+
+
+@pytest.mark.parametrize("tolerance", [1e-2, 1e-3, 1e-4])
+def test_tree_matches_direct_within_tolerance(tolerance):
+    problem = make_synthetic_problem(n_side=24)
+    cos_cutoff = math.cos(math.radians(12.0))
+    reference = compute_potential(*problem, cos_cutoff, method="direct")
+    pot = compute_potential(*problem, cos_cutoff, method="tree", tolerance=tolerance)
+    assert max_rel_diff(pot, reference) <= tolerance
+
+
+@pytest.mark.parametrize("method", ["trig", "indexed", "tree"])
+def test_mixed_precision_matches_direct(problem, reference, method):
+    pot = compute_potential(*problem, COS_CUTOFF, method=method, precision="mixed")
+    assert max_rel_diff(pot, reference) < 1e-6
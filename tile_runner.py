@@ -0,0 +1,240 @@
+"""
+Multiprocess tiled executor for the tesseroid engine.
+
+The observation points are cut into tiles that run in a pool of worker
+processes. The source structures (source table plus spatial index or tree,
+see tesseroid_engine.prepare_sources) are built once in the calling process
+and placed in ``multiprocessing.shared_memory`` blocks together with the
+observation arrays, so every worker maps the same pages instead of receiving
+a pickled copy, and each tile writes its potentials straight into a shared
+output array. Only small descriptors travel through the pool's pipes.
+
+Workers are separate processes with their own Numba thread pools, so the run
+can spread over several NUMA nodes / sockets, and the calling process (e.g.
+the Streamlit server) only waits on futures while the kernels run elsewhere.
+"""
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+
+from tesseroid_engine import compute_prepared, prepare_sources
+
+# Engine methods that can be evaluated tile by tile from prepared sources
+TILED_METHODS = ("trig", "indexed", "tree")
+
+# Kernel counts reported in ``stats``, in the column order of the checkpoint counts
+_STAT_KEYS = ("kernel_evaluations", "refined_sources", "refined_evaluations")
+
+
+class _SharedArray(NamedTuple):
+    """Descriptor of a numpy array stored in a shared memory block"""
+    name: str
+    shape: tuple
+    dtype: str
+
+
+class _SharedTuple(NamedTuple):
+    """Descriptor of a NamedTuple whose array fields live in shared memory"""
+    cls: type
+    fields: tuple
+
+
+def _export(value, blocks, memo):
+    """Copy the arrays of ``value`` (recursing into NamedTuples) into shared memory"""
+    if isinstance(value, np.ndarray):
+        if id(value) not in memo:
+            shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+            blocks.append(shm)
+            np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[...] = value
+            memo[id(value)] = _SharedArray(shm.name, value.shape, value.dtype.str)
+        return memo[id(value)]
+    if isinstance(value, tuple) and hasattr(value, "_fields"):
+        return _SharedTuple(type(value), tuple(_export(v, blocks, memo) for v in value))
+    return value
+
+
+def _attach(desc, handles):
+    """Rebuild the value described by ``desc`` on top of the shared memory blocks"""
+    if isinstance(desc, _SharedArray):
+        try:
+            shm = shared_memory.SharedMemory(name=desc.name, track=False)
+        except TypeError:
+            # Python < 3.13 registers the block again with the resource tracker,
+            # which workers share with the creating process; its unlink clears it
+            shm = shared_memory.SharedMemory(name=desc.name)
+        handles.append(shm)
+        return np.ndarray(desc.shape, dtype=np.dtype(desc.dtype), buffer=shm.buf)
+    if isinstance(desc, _SharedTuple):
+        return desc.cls(*(_attach(v, handles) for v in desc.fields))
+    return desc
+
+
+def _init_worker(n_threads):
+    """Give every worker its share of the cores"""
+    import numba
+    numba.set_num_threads(max(1, min(n_threads, numba.config.NUMBA_NUM_THREADS)))
+
+
+def _run_tile(shared, s, e, batch_size, options):
+    """Evaluate observations s:e in a worker and write them to the shared output"""
+    handles = []
+    try:
+        prepared, obs_lats, obs_lons, obs_radii, out = (_attach(desc, handles) for desc in shared)
+        stats = {}
+        out[s:e] = compute_prepared(prepared, obs_lats[s:e], obs_lons[s:e], obs_radii[s:e],
+                                    batch_size=batch_size, stats=stats, **options)
+        return stats
+    finally:
+        # Drop the views before unmapping the blocks
+        prepared = obs_lats = obs_lons = obs_radii = out = None
+        for shm in handles:
+            shm.close()
+
+
+_POOLS = {}
+
+
+def get_pool(n_workers, threads_per_worker):
+    """Process pool for the given layout, created once and reused between runs.
+
+    Workers are started with ``spawn`` so they never inherit the threads of a
+    running server; the first tile in each worker loads the kernels from the
+    Numba on-disk cache.
+    """
+    key = (int(n_workers), int(threads_per_worker))
+    if key not in _POOLS:
+        _POOLS[key] = ProcessPoolExecutor(max_workers=key[0],
+                                          mp_context=multiprocessing.get_context("spawn"),
+                                          initializer=_init_worker, initargs=(key[1],))
+    return _POOLS[key]
+
+
+def shutdown_pools():
+    """Stop every worker process started by get_pool"""
+    for pool in _POOLS.values():
+        pool.shutdown(wait=True, cancel_futures=True)
+    _POOLS.clear()
+
+
+def default_layout(n_workers=None):
+    """(n_workers, threads_per_worker) that together use every available core"""
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    n_workers = max(1, int(n_workers or n_cores))
+    return n_workers, max(1, n_cores // n_workers)
+
+
+def compute_potentials_tiled(obs_lats_rad, obs_lons_rad, obs_radii, source_sets, cos_cutoffs,
+                             dlat, dlon, method="indexed", n_workers=None, threads_per_worker=None,
+                             tile_size=None, batch_size=5000, progress_callback=None, stats=None,
+                             checkpoint=None, precision="float64", **options):
+    """Potentials of one or more source sets, computed tile by tile in worker processes.
+
+    Takes the same inputs as tesseroid_engine.compute_potentials_fused plus the
+    engine ``method`` (one of TILED_METHODS) and the pool layout; ``options``
+    are the kernel options of compute_potential (tolerance, split_ratio,
+    max_depth) and ``precision`` is as in compute_potential. With ``indexed``
+    all source sets share one pass; ``trig`` and ``tree`` run one pass per
+    set. ``tile_size`` defaults to four tiles per worker.
+    ``progress_callback(done_tiles, n_tiles)`` is called as tiles
+    finish and ``stats`` receives the summed kernel counts. Finished tiles
+    are stored in ``checkpoint`` (see compute_potentials_fused) and the tiles
+    it already holds are skipped; it needs a single pass, i.e. ``indexed`` or
+    one source set.
+    Returns one potential array per source set, in order.
+    """
+    if method not in TILED_METHODS:
+        raise ValueError(f"Engine method {method!r} cannot run tiled; use one of {TILED_METHODS}")
+    if len(source_sets) != len(cos_cutoffs):
+        raise ValueError("Need one cutoff per source set")
+    if method != "indexed" and len(source_sets) > 1:
+        if checkpoint is not None:
+            raise ValueError(f"Engine method {method!r} runs one pass per source set and cannot use a checkpoint")
+        passes = []
+        for k, (sources, cos_cutoff) in enumerate(zip(source_sets, cos_cutoffs)):
+            pass_stats = {}
+            passes.append(compute_potentials_tiled(
+                obs_lats_rad, obs_lons_rad, obs_radii, [sources], [cos_cutoff], dlat, dlon, method,
+                n_workers, threads_per_worker, tile_size, batch_size, None, pass_stats, None, precision,
+                **options)[0])
+            if stats is not None:
+                for key, value in pass_stats.items():
+                    stats[key] = stats.get(key, 0) + value
+            if progress_callback is not None:
+                progress_callback(k + 1, len(source_sets))
+        return passes
+
+    default_workers, default_threads = default_layout(n_workers)
+    n_workers = default_workers
+    threads_per_worker = int(threads_per_worker or default_threads)
+    obs_radii = np.ascontiguousarray(obs_radii, dtype=np.float64)
+    n_obs = len(obs_radii)
+    tile_size = max(1, int(tile_size or math.ceil(n_obs / (4 * n_workers))))
+
+    src_class = np.concatenate([np.full(len(s.lat), k, dtype=np.int64) for k, s in enumerate(source_sets)])
+    prepared = prepare_sources(
+        np.concatenate([s.lat for s in source_sets]),
+        np.concatenate([s.lon for s in source_sets]),
+        np.concatenate([s.r1 for s in source_sets]),
+        np.concatenate([s.r2 for s in source_sets]),
+        np.concatenate([s.rho for s in source_sets]),
+        dlat, dlon, cos_cutoffs, method=method, src_class=src_class, precision=precision
+    )
+    out = np.full((n_obs, len(source_sets)), np.nan, dtype=np.float64)
+
+    blocks = []
+    out_shared = None
+    try:
+        memo = {}
+        shared = (_export(prepared, blocks, memo),
+                  _export(np.ascontiguousarray(obs_lats_rad, dtype=np.float64), blocks, memo),
+                  _export(np.ascontiguousarray(obs_lons_rad, dtype=np.float64), blocks, memo),
+                  _export(obs_radii, blocks, memo),
+                  _export(out, blocks, memo))
+        # Tiles write into the shared copy of ``out``
+        out_shared = np.ndarray(out.shape, dtype=out.dtype, buffer=blocks[-1].buf)
+
+        pool = get_pool(n_workers, threads_per_worker)
+        tiles = [(s, min(s + tile_size, n_obs)) for s in range(0, n_obs, tile_size)]
+        totals = {}
+        pending = []
+        for s, e in tiles:
+            if checkpoint is not None and checkpoint.is_done(s, e):
+                out[s:e] = checkpoint.values[s:e]
+                for key, value in zip(_STAT_KEYS, checkpoint.counts[s:e].sum(axis=0)):
+                    totals[key] = totals.get(key, 0) + int(value)
+            else:
+                pending.append((s, e))
+        futures = {pool.submit(_run_tile, shared, s, e, batch_size, options): (s, e) for s, e in pending}
+        n_done = len(tiles) - len(pending)
+        try:
+            for done, future in enumerate(as_completed(futures), start=n_done + 1):
+                tile_stats = future.result()
+                for key, value in tile_stats.items():
+                    # Kernel counts add up; e.g. the automatic batch size is per tile
+                    totals[key] = totals.get(key, 0) + value if key in _STAT_KEYS else value
+                if checkpoint is not None:
+                    s, e = futures[future]
+                    checkpoint.store(s, e, out_shared[s:e], [tile_stats.get(key, 0) for key in _STAT_KEYS])
+                if progress_callback is not None:
+                    progress_callback(done, len(tiles))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        for s, e in pending:
+            out[s:e] = out_shared[s:e]
+    finally:
+        # Drop the view before unmapping the blocks
+        out_shared = None
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    if stats is not None:
+        stats.update(totals)
+    return [out[:, k].copy() for k in range(len(source_sets))]